@@ -3,12 +3,16 @@ from houseagent.utils.config import Config
 from houseagent import config_file
 from houseagent.core.coordinator import Coordinator
 from houseagent.core.events import EventHandler
-from houseagent.core.history import HistoryCollector, HistoryAggregator
+from houseagent.core.history import HistoryCollector, HistoryAggregator, HistoryRetention
 from houseagent.core.web import Web
 from houseagent.core.database import Database
 from houseagent.core.databaseflash import DatabaseFlash
+from houseagent.core.segmentlog import SegmentLog
+from houseagent.core.backup import BackupManager
 from twisted.internet import reactor
 from houseagent.plugins import pluginapi
+from houseagent.utils.zmqoptions import SocketOptions
+from houseagent.utils.dbprofile import StorageProfile
           
 class MainWrapper():
     '''
@@ -20,15 +24,39 @@ class MainWrapper():
         self.log = pluginapi.Logging("Main")
         
         self.log.debug("Starting HouseAgent database layer...")
+        profile = StorageProfile(config.database.profile, config.database.synchronous,
+                                 config.database.cache_size, config.database.mmap_size,
+                                 config.database.temp_store, config.database.read_connections,
+                                 config.database.write_group, config.database.write_delay)
+        
         if config.embedded.enabled:
-            database = DatabaseFlash(self.log, config.general.dbfile, config.embedded.db_save_interval)
+            segments = None
+            if config.embedded.storage == 'log':
+                segment_dir = config.embedded.segment_dir or os.path.join(os.path.dirname(config.general.dbfile), 'segments')
+                segments = SegmentLog(segment_dir, config.embedded.segment_size * 1024,
+                                      config.embedded.sync_interval, self.log)
+            database = DatabaseFlash(self.log, config.general.dbfile, config.embedded.db_save_interval, profile, segments)
         else:
-            database = Database(self.log, config.general.dbfile)
+            database = Database(self.log, config.general.dbfile, profile)
         
+        backup_dir = config.backup.directory or os.path.join(os.path.dirname(config.general.dbfile), 'backups')
+        backups = BackupManager(config.general.dbfile, backup_dir, config.backup.interval, config.backup.keep, self.log)
+
         self.log.debug("Starting HouseAgent coordinator...")
-        coordinator = Coordinator(self.log, database)
+        coordinator = Coordinator(self.log, database, config.ingestion.flush_size, 
+                                  config.ingestion.flush_interval / 1000.0,
+                                  config.ingestion.max_queue, config.ingestion.overload_policy)
+        
+        socket_options = SocketOptions(config.zmq.sndhwm, config.zmq.rcvhwm, config.zmq.linger,
+                                       config.zmq.tcp_keepalive, config.zmq.tcp_keepalive_idle,
+                                       config.zmq.tcp_keepalive_interval, config.zmq.tcp_keepalive_count)
 
-        coordinator.init_broker(config.zmq.broker_host, config.zmq.broker_port)
+        coordinator.init_broker(config.zmq.broker_host, config.zmq.broker_port, 
+                                config.zmq.rpc_timeout, config.zmq.rpc_max_in_flight,
+                                config.zmq.heartbeat_interval, config.zmq.missed_heartbeats,
+                                config.zmq.pub_port, config.zmq.capture_file,
+                                config.zmq.telemetry_quantum, socket_options,
+                                config.zmq.telemetry_queue)
         
         self.log.debug("Starting HouseAgent event handler...")
         event_handler = EventHandler(self.log, coordinator, database)
@@ -39,9 +67,13 @@ class MainWrapper():
         self.log.debug("Starting Houseagent history collector")
         HistoryCollector(database, histagg)
 
+        self.log.debug("Starting Houseagent history retention")
+        HistoryRetention(database, config.retention.interval, config.retention.batch_size,
+                         config.retention.batch_pause / 1000.0, config.retention.vacuum_pages)
+
         self.log.debug("Starting HouseAgent web server...")
         Web(self.log, config.webserver.host, config.webserver.port,\
-            config.webserver.backlog, coordinator, event_handler, database)
+            config.webserver.backlog, coordinator, event_handler, database, backups)
         
         if os.name == 'nt':
             reactor.run(installSignalHandlers=0)
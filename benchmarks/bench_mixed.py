@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+'''
+Mixed read/write database benchmark.
+
+Runs the value ingestion stage against a temporary database at a fixed update rate and,
+at the same time, issues the queries behind the web pages (query_values, query_devices)
+at a fixed rate. Reported are the read latencies under ingestion pressure and the write
+throughput, for each storage profile. Every profile runs in its own process on a fresh
+copy of the database.
+
+Usage: python benchmarks/bench_mixed.py [options], see --help
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+# Paths given on the command line are relative to the directory the tool was started from
+CWD = os.getcwd()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, task
+from bench_registry import NullLog
+from benchstats import percentiles, git_revision
+from loadgen import prepare_database
+
+# Queries issued by the simulated web clients, in turn
+READS = ('query_values', 'query_devices')
+
+def run_profile(options):
+    '''
+    Child process: run the mixed load against one storage profile.
+    '''
+    from houseagent.core.database import Database
+    from houseagent.core.ingestion import ValueIngestor
+    from houseagent.utils.dbprofile import StorageProfile
+
+    if options.profile == 'wal':
+        profile = StorageProfile('wal', options.synchronous, options.cache_size, options.mmap_size,
+                                 options.temp_store, options.read_connections)
+    else:
+        profile = StorageProfile()
+
+    log = NullLog()
+    database = Database(log, options.db, profile)
+    state = {'committed': 0, 'offered': 0, 'reads': 0}
+    samples = dict((name, []) for name in READS)
+
+    def committed(values):
+        if measuring():
+            state['committed'] += len(values)
+
+    ingestor = ValueIngestor(log, database, committed, options.flush_size, options.flush_interval / 1000.0)
+
+    window_start = time.time() + options.warmup
+    window_end = window_start + options.duration
+    measuring = lambda: window_start <= time.time() < window_end
+
+    def write():
+        # Catch up with the number of updates that should have been queued by now
+        due = int((time.time() - started) * options.rate)
+        updates = []
+        while state['offered'] < due:
+            n = state['offered']
+            updates.append(('Power', str(n), 1 + n % options.plugins, 'dev-%d' % (n / options.plugins % options.devices), None))
+            state['offered'] += 1
+        ingestor.put_many(updates)
+
+    def read():
+        name = READS[state['reads'] % len(READS)]
+        state['reads'] += 1
+        issued = time.time()
+
+        def done(result):
+            if window_start <= issued < window_end:
+                samples[name].append(time.time() - issued)
+
+        getattr(database, name)().addCallback(done)
+
+    def finish():
+        writer.stop()
+        reader.stop()
+        results = {'profile': options.profile,
+                   'pragmas': profile.pragmas(),
+                   'write_throughput': state['committed'] / options.duration,
+                   'reads': dict((name, percentiles(samples[name])) for name in READS)}
+        with open(options.report, 'w') as report:
+            json.dump(results, report)
+        reactor.stop()
+
+    started = time.time()
+    writer = task.LoopingCall(write)
+    writer.start(0.005)
+    reader = task.LoopingCall(read)
+    reader.start(1.0 / options.read_rate)
+    reactor.callLater(options.warmup + options.duration, finish)
+    reactor.run()
+
+def main():
+    parser = OptionParser(usage="python benchmarks/bench_mixed.py [options]")
+    parser.add_option('--profiles', default='default,wal', help="comma separated storage profiles to compare [%default]")
+    parser.add_option('--plugins', type='int', default=20, help="number of plugins in the database [%default]")
+    parser.add_option('--devices', type='int', default=50, help="number of devices per plugin [%default]")
+    parser.add_option('--rate', type='float', default=5000, help="value updates per second [%default]")
+    parser.add_option('--read-rate', type='float', default=20, help="web queries per second [%default]")
+    parser.add_option('--flush-size', type='int', default=500, help="ingestion flush size [%default]")
+    parser.add_option('--flush-interval', type='int', default=5, help="ingestion flush interval [%default ms]")
+    parser.add_option('--synchronous', default='normal', help="synchronous pragma of the wal profile [%default]")
+    parser.add_option('--cache-size', type='int', default=-8000, help="cache_size pragma of the wal profile [%default]")
+    parser.add_option('--mmap-size', type='int', default=0, help="mmap_size pragma of the wal profile [%default]")
+    parser.add_option('--temp-store', default='memory', help="temp_store pragma of the wal profile [%default]")
+    parser.add_option('--read-connections', type='int', default=3, help="reader connections of the wal profile [%default]")
+    parser.add_option('--duration', type='float', default=20, help="measurement time in seconds [%default]")
+    parser.add_option('--warmup', type='float', default=3, help="warm-up time in seconds [%default]")
+    parser.add_option('--output', default='mixed-results.json', help="file to write the results to [%default]")
+    # Internal options, used to start the process running a profile
+    parser.add_option('--profile')
+    parser.add_option('--db')
+    parser.add_option('--report')
+    options, args = parser.parse_args()
+
+    if options.profile:
+        run_profile(options)
+        return
+
+    runs = []
+    for profile in options.profiles.split(','):
+        workdir = tempfile.mkdtemp(prefix='houseagent-mixed-')
+        try:
+            db = os.path.join(workdir, 'houseagent.db')
+            report = os.path.join(workdir, 'report.json')
+            prepare_database(db, options.plugins, options.devices)
+
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), '--profile', profile, '--db', db,
+                                   '--report', report] + sys.argv[1:])
+
+            with open(report) as f:
+                runs.append(json.load(f))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {'revision': git_revision(),
+               'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'config': {'plugins': options.plugins, 'devices': options.devices, 'rate': options.rate,
+                          'read_rate': options.read_rate, 'flush_size': options.flush_size,
+                          'flush_interval': options.flush_interval, 'duration': options.duration},
+               'runs': runs}
+
+    with open(os.path.join(CWD, options.output), 'w') as output:
+        json.dump(results, output, indent=2)
+
+    for run in runs:
+        print "%s profile: committed %.0f updates/s" % (run['profile'], run['write_throughput'])
+        for name in READS:
+            latency = run['reads'][name]
+            if latency['count']:
+                print "  %-15s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  max %8.2f ms" % (name, latency['p50'], latency['p95'],
+                                                                                          latency['p99'], latency['max'])
+    print "Results written to %s" % options.output
+
+if __name__ == '__main__':
+    main()
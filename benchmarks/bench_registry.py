@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''
+Micro-benchmark for the coordinator plugin registry.
+
+Measures the per-message dispatch cost of ready, heartbeat and value update
+messages, and of the plugin lookup helpers, for a growing number of plugins.
+With the indexed PluginRegistry the cost per message should stay flat.
+
+Usage: python benchmarks/bench_registry.py [messages per run]
+'''
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import defer
+from houseagent.core.coordinator import Coordinator
+
+class NullLog(object):
+    '''
+    Logger that discards everything, so logging doesn't dominate the measurements.
+    '''
+    def debug(self, message): pass
+    def info(self, message): pass
+    def warning(self, message): pass
+    def error(self, message): pass
+    def critical(self, message): pass
+
+class FakeDatabase(object):
+    '''
+    Minimal database stand-in that answers instantly.
+    '''
+    def __init__(self, plugin_count):
+        self.coordinator = None
+        self.rows = [('plugin%d' % i, 'guid-%d' % i, i, None, None) for i in range(plugin_count)]
+
+    def query_plugins(self):
+        return defer.succeed(self.rows)
+
+    def update_or_add_values(self, updates):
+        return defer.succeed([1] * len(updates))
+
+class FakeBroker(object):
+    def send(self, message):
+        pass
+
+def timed(count, fnc, *args):
+    start = time.time()
+    for i in xrange(count):
+        fnc(*args)
+    return (time.time() - start) / count * 1e6
+
+def run(plugin_count, messages):
+    coordinator = Coordinator(NullLog(), FakeDatabase(plugin_count))
+    coordinator.broker = FakeBroker()
+
+    # Bring every plugin online with its own routing identity
+    for i in range(plugin_count):
+        coordinator.handle_plugin_ready('route-%d' % i, ['guid-%d' % i, 'type-%d' % (i % 10), json.dumps([])])
+
+    # Pick the last plugin, which is the worst case for a linear scan
+    last = plugin_count - 1
+    routing_info = 'route-%d' % last
+    update = [json.dumps({'address': 'dev1', 'values': {'Temperature': '21.5'}, 'time': time.time()})]
+    ready = ['guid-%d' % last, 'type-%d' % (last % 10), json.dumps([])]
+
+    return {'ready': timed(messages, coordinator.handle_plugin_ready, routing_info, ready),
+            'heartbeat': timed(messages, coordinator.handle_plugin_heartbeat, routing_info, []),
+            'value_update': timed(messages, coordinator.handle_plugin_value_update, routing_info, update),
+            'plugin_by_guid': timed(messages, coordinator.plugin_by_guid, 'guid-%d' % last),
+            'plugin_guid_by_id': timed(messages, coordinator.plugin_guid_by_id, last)}
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    columns = ['ready', 'heartbeat', 'value_update', 'plugin_by_guid', 'plugin_guid_by_id']
+
+    print "Per-message dispatch cost in microseconds (%d messages per run)" % messages
+    print "%8s " % 'plugins' + ' '.join('%17s' % c for c in columns)
+    for plugin_count in (10, 100, 1000, 10000):
+        result = run(plugin_count, messages)
+        print "%8d " % plugin_count + ' '.join('%17.2f' % result[c] for c in columns)
+
+if __name__ == '__main__':
+    main()
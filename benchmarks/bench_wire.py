@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+Benchmark for the plugin wire formats.
+
+Compares JSON and the compact bin1 format for the messages exchanged between
+plugins and the coordinator: the number of messages per second that can be
+encoded and decoded, and the number of bytes sent on the wire per message.
+
+Usage: python benchmarks/bench_wire.py [messages per run]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from houseagent.utils.codec import MessageCodec
+
+def value_update(i):
+    return {'address': 'meter-01',
+            'values': {'Power': '%d' % (1200 + i % 300), 'Energy': '%.3f' % (10234.5 + i / 1000.0),
+                       'Voltage': '230.1'},
+            'time': time.time(),
+            'plugin_id': '0f1ba1c7-9c30-4e8a-a3e1-3a5e0b8d1c11'}
+
+def rpc_request(i):
+    return {'type': 'dim', 'address': 'dimmer-%d' % (i % 10), 'level': '%d' % (i % 100), 'value_id': i}
+
+def crud_update(i):
+    return {'type': 'device', 'action': 'update',
+            'parameters': {'id': i, 'name': 'Living room', 'address': 'dev-%d' % i, 'plugin_id': 3}}
+
+def run(format, intern, messages, factory):
+    # Encode and decode sides each keep their own intern tables, like a real connection
+    encoder = MessageCodec(format, intern)
+    decoder = MessageCodec()
+    content = [factory(i) for i in xrange(messages)]
+
+    start = time.time()
+    encoded = [encoder.encode(c) for c in content]
+    encode_time = time.time() - start
+
+    start = time.time()
+    for e in encoded:
+        decoder.decode(e)
+    decode_time = time.time() - start
+
+    assert decoder.decode(encoder.encode(content[0])) == content[0]
+
+    return {'encode': messages / encode_time,
+            'decode': messages / decode_time,
+            'bytes': sum(len(e) for e in encoded) / float(messages)}
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    print "Wire format comparison (%d messages per run)" % messages
+    print "%-14s %-6s %14s %14s %10s" % ('message', 'format', 'encode msg/s', 'decode msg/s', 'bytes')
+    for name, factory, intern in (('value_update', value_update, True),
+                                  ('rpc_request', rpc_request, False),
+                                  ('crud_update', crud_update, False)):
+        for format in ('json', 'bin1'):
+            result = run(format, intern, messages, factory)
+            print "%-14s %-6s %14d %14d %10.1f" % (name, format, result['encode'], result['decode'], result['bytes'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+'''
+Latency and throughput statistics shared by the benchmark tools.
+'''
+import os
+import time
+import subprocess
+from collections import deque
+
+def percentiles(samples):
+    '''
+    @return: a dictionary with the p50, p95, p99 and max of the samples in milliseconds
+    '''
+    if not samples:
+        return {'count': 0}
+
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))] * 1000.0
+    return {'count': len(samples), 'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': samples[-1] * 1000.0}
+
+class LatencyProbe(object):
+    '''
+    Measures the latency of value updates through a running coordinator, from their origin
+    to the database commit and to the dispatch of matching event triggers.
+    '''
+
+    def __init__(self, coordinator, event_handler=None, origin=None, window=None):
+        '''
+        Attach a new probe to a coordinator.
+        @param coordinator: the coordinator to measure
+        @param event_handler: the event handler to measure, optional
+        @param origin: function returning the origin time of an update tuple as queued on the
+                       ingestion stage, by default the time the update was queued
+        @param window: a (start, end) tuple, only updates originating within this window are measured
+        '''
+        self.origin = origin
+        self.window = window
+        self.commit_samples = []
+        self.event_samples = []
+        self.cpu_start = self.cpu_end = None
+
+        self._queued = {}
+        self._flushed = deque()
+        self._batch = {}
+
+        ingestor = coordinator.ingestor
+        self._put_many = ingestor.put_many
+        ingestor.put_many = self._probe_put_many
+
+        # Origins are looked up when a batch is written, updates dropped or replaced by the
+        # overload policy never make it there. They travel along with the batch, so they stay
+        # aligned with the committed values, even when a batch fails
+        self._write = ingestor.db.update_or_add_values
+        ingestor.db = _DatabaseProbe(ingestor.db, self._probe_write)
+
+        self._committed = ingestor.committed
+        ingestor.committed = self._probe_committed
+
+        if event_handler:
+            self._value_triggered = event_handler._value_triggered
+            event_handler._value_triggered = self._probe_triggered
+
+    def start_cpu(self):
+        self.cpu_start = sum(os.times()[:2])
+
+    def stop_cpu(self):
+        self.cpu_end = sum(os.times()[:2])
+
+    def results(self):
+        '''
+        @return: a dictionary with the measured statistics
+        '''
+        results = {'commit_latency': percentiles(self.commit_samples),
+                   'event_latency': percentiles(self.event_samples),
+                   'committed': len(self.commit_samples)}
+        if self.cpu_end is not None:
+            results['cpu_seconds'] = self.cpu_end - self.cpu_start
+        return results
+
+    def _measured(self, origin):
+        return origin is not None and (not self.window or self.window[0] <= origin < self.window[1])
+
+    def _probe_put_many(self, updates):
+        now = time.time()
+        for update in updates:
+            self._queued[id(update)] = self.origin(update) if self.origin else now
+        self._put_many(updates)
+
+    def _probe_write(self, batch):
+        origins = [self._queued.pop(id(update), None) for update in batch]
+
+        def written(result):
+            self._flushed.append(origins)
+            return result
+
+        return self._write(batch).addCallback(written)
+
+    def _probe_committed(self, values):
+        now = time.time()
+        origins = self._flushed.popleft()
+
+        self._batch = {}
+        for (value_id, value), origin in zip(values, origins):
+            if self._measured(origin):
+                self.commit_samples.append(now - origin)
+            if value_id:
+                self._batch[int(value_id)] = origin
+
+        self._committed(values)
+        self._batch = {}
+
+    def _probe_triggered(self, trigger, value, number):
+        origin = self._batch.get(int(trigger.current_value_id))
+        if self._measured(origin):
+            self.event_samples.append(time.time() - origin)
+        return self._value_triggered(trigger, value, number)
+
+class _DatabaseProbe(object):
+    '''
+    Database wrapper which intercepts batch writes and passes everything else through.
+    '''
+    def __init__(self, database, update_or_add_values):
+        self._database = database
+        self.update_or_add_values = update_or_add_values
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+def print_results(results, duration):
+    '''
+    Print the statistics of a benchmark run.
+    @param results: a dictionary as returned by LatencyProbe.results, with the throughput added
+    @param duration: the measured time in seconds
+    '''
+    print "Committed %.0f updates/s" % results['throughput']
+    for name in ('commit_latency', 'event_latency'):
+        latency = results[name]
+        if latency['count']:
+            print "%-15s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  max %8.2f ms" % (name, latency['p50'], latency['p95'],
+                                                                                    latency['p99'], latency['max'])
+    if 'cpu_seconds' in results:
+        print "Coordinator CPU time: %.2f s (%.0f%% of one core)" % (results['cpu_seconds'],
+                                                                     100.0 * results['cpu_seconds'] / duration)
+
+def git_revision():
+    '''
+    @return: the abbreviated git revision of the working tree, to tell results of different versions apart
+    '''
+    try:
+        return subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        return 'unknown'
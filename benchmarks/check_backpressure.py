@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+'''
+Backpressure check for the broker.
+
+A plugin floods the broker with value updates over a real ZeroMQ connection, first while
+telemetry is handled as it arrives, then while it's held, like the ingestion stage does with the
+block overload policy. In both runs the telemetry lane of the dispatcher must never hold more
+than its limit, the broker has to stop reading instead. Heartbeats sent while telemetry is held
+must still be handled, and after telemetry is released every update must arrive, in order.
+
+The exit status is the number of failures.
+
+Usage: python benchmarks/check_backpressure.py [messages, defaults to 3000] [limit, defaults to 100]
+'''
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import zmq
+from twisted.internet import reactor, task
+from txzmq import ZmqFactory, ZmqEndpoint, ZmqEndpointType
+from bench_registry import NullLog
+from houseagent.core.coordinator import Broker
+
+class FakeCoordinator(object):
+    '''
+    Just enough of a coordinator for the broker, it records the messages it handles.
+    '''
+    def __init__(self):
+        self.log = NullLog()
+        self.updates = []
+        self.heartbeats = 0
+        self.plugin_cmds = {'\x02': self.heartbeat, '\x03': self.update}
+
+    def heartbeat(self, routing_info, payload):
+        self.heartbeats += 1
+
+    def update(self, routing_info, payload):
+        self.updates.append(int(payload[0]))
+
+def flood(port, messages, heartbeats=0):
+    '''
+    Send value updates from a single plugin connection, in a thread since sending blocks on the
+    high-water mark once the broker stops reading.
+    '''
+    def send():
+        socket = zmq.Context.instance().socket(zmq.DEALER)
+        socket.setsockopt(zmq.IDENTITY, 'flood')
+        socket.connect('tcp://127.0.0.1:%d' % port)
+        for i in xrange(heartbeats):
+            socket.send_multipart(['', '\x02'])
+        for i in xrange(messages):
+            socket.send_multipart(['', '\x03', str(i)])
+        socket.close(linger=-1)
+
+    thread = threading.Thread(target=send)
+    thread.daemon = True
+    thread.start()
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    port = 23501
+    failures = []
+
+    coordinator = FakeCoordinator()
+    broker = Broker(ZmqFactory(), coordinator, ZmqEndpoint(ZmqEndpointType.bind, 'tcp://127.0.0.1:%d' % port),
+                    telemetry_queue=limit)
+    dispatcher = broker.dispatcher
+    lane = dispatcher.lanes['telemetry']
+
+    def wait(condition, timeout=30.0):
+        calls = [0]
+        def poll():
+            calls[0] += 1
+            if condition() or calls[0] * 0.01 > timeout:
+                return True
+            return task.deferLater(reactor, 0.01, poll)
+        return task.deferLater(reactor, 0.01, poll)
+
+    def check(name, ok, detail):
+        print "%s %s: %s" % ('ok  ' if ok else 'FAIL', name, detail)
+        if not ok:
+            failures.append(name)
+
+    def flowing(_):
+        flood(port, messages)
+        return wait(lambda: len(coordinator.updates) >= messages)
+
+    def flowing_done(_):
+        check('flowing', len(coordinator.updates) == messages and lane.max_depth <= limit,
+              "%d/%d updates handled, max lane depth %d (limit %d), %d overflows" %
+              (len(coordinator.updates), messages, lane.max_depth, limit, lane.overflows))
+
+        del coordinator.updates[:]
+        lane.max_depth = 0
+        dispatcher.hold_telemetry()
+        flood(port, messages, heartbeats=1)
+        return wait(lambda: broker.paused and coordinator.heartbeats, 10.0)
+
+    def held(_):
+        check('held', broker.paused and len(lane.queue) <= limit and lane.max_depth <= limit and coordinator.heartbeats == 1,
+              "broker paused %s, lane depth %d, max lane depth %d (limit %d), %d heartbeat handled" %
+              (broker.paused, len(lane.queue), lane.max_depth, limit, coordinator.heartbeats))
+
+        dispatcher.release_telemetry()
+        return wait(lambda: len(coordinator.updates) >= messages)
+
+    def released(_):
+        check('released', coordinator.updates == range(messages) and lane.max_depth <= limit,
+              "%d/%d updates handled in order %s, max lane depth %d (limit %d)" %
+              (len(coordinator.updates), messages, coordinator.updates == range(messages), lane.max_depth, limit))
+
+    def failed(failure):
+        failures.append(failure.getErrorMessage())
+        print "FAIL %s" % failure.getErrorMessage()
+
+    d = task.deferLater(reactor, 0.2, lambda: None)
+    d.addCallback(flowing)
+    d.addCallback(flowing_done)
+    d.addCallback(held)
+    d.addCallback(released)
+    d.addErrback(failed)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+    print "%d failures" % len(failures)
+    sys.exit(len(failures))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+'''
+Query plan check for the database layer.
+
+Collects the SQL statements of every method of Database and DatabaseArchive, by calling the
+methods against a pool that records the statements instead of running them. Every statement
+is then explained (EXPLAIN QUERY PLAN) against a copy of the database upgraded to the current
+schema, and against a new archive database with the main database attached.
+
+A statement with a WHERE clause has to be answered through an index or the rowid: any full
+table scan in its plan is reported as a failure, unless the statement is listed in ALLOWED.
+The exit status is the number of failures, so this can be run after schema changes.
+
+Usage: python benchmarks/check_query_plans.py [database, defaults to houseagent.db]
+'''
+import os
+import re
+import sys
+import new
+import shutil
+import sqlite3
+import inspect
+import tempfile
+
+# Paths given on the command line are relative to the directory the tool was started from
+CWD = os.getcwd()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import defer
+from bench_registry import NullLog
+from houseagent.core.database import Database
+from houseagent.core.history import DatabaseArchive
+from houseagent.core.idcache import IdCache
+
+# Full scans that are expected, by (class name, method name) and table name
+ALLOWED = {
+    # A handful of rows
+    ('Database', 'save_retention_policy'): ('history_retention',),
+    # The policies of the default retention pass, read once into a list
+    ('Database', 'delete_history_values'): ('history_retention',),
+}
+
+# Statements that don't read data
+SKIP = re.compile(r'^\s*(PRAGMA|ATTACH|DETACH|ANALYZE|CREATE|DROP|ALTER|BEGIN|COMMIT|SAVEPOINT|RELEASE)\b', re.I)
+
+# Fake row returned for every query, so callbacks indexing into results carry on
+ROW = (1, 1, 1, 1, 1, 1, 1, 1, 1)
+
+class RecordingCursor(object):
+    '''
+    Cursor stand-in for interactions, it records statements and returns a fake row.
+    '''
+    def __init__(self, statements):
+        self.statements = statements
+        self.lastrowid = 1
+        self.rowcount = 1
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, params))
+        return self
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        if rows:
+            self.statements.append((sql, rows[0]))
+        return self
+
+    def fetchall(self):
+        return [ROW]
+
+    def fetchone(self):
+        return ROW
+
+class RecordingPool(object):
+    '''
+    Connection pool stand-in that records statements instead of running them.
+    '''
+    def __init__(self):
+        self.statements = []
+
+    def runQuery(self, sql, params=()):
+        self.statements.append((sql, params))
+        return defer.succeed([ROW])
+
+    def runOperation(self, sql, params=()):
+        self.statements.append((sql, params))
+        return defer.succeed(None)
+
+    def runInteraction(self, interaction, *args, **kw):
+        return defer.maybeDeferred(interaction, RecordingCursor(self.statements), *args, **kw)
+
+class Null(object):
+    '''
+    Stand-in for the objects the database notifies (value view, history collector), their
+    methods accept anything and pass on the first argument.
+    '''
+    def __getattr__(self, name):
+        return lambda result=None, *args, **kw: result
+
+# An event, as posted by the event editor
+EVENT = {'name': u'event', 'enabled': 1, 'conditions': [{'condition_type': 1, 'parameters': {'name': 'value'}}],
+         'actions': [{'action_type': 1, 'parameters': {'name': 'value'}}],
+         'trigger': {'trigger_type': 1, 'conditions': 1, 'parameters': {'name': 'value'}}}
+
+# Arguments for methods that don't take plain ids, or of which the signature is hidden by a decorator
+ARGUMENTS = {
+    'Database.update_or_add_value': (u'value', u'1', 1, u'address'),
+    'Database.update_or_add_values': ([(u'value', u'1', 1, u'address', None)],),
+    'Database.query_history_values': ('2012-01-01 00:00:00', '2012-01-02 00:00:00'),
+    'Database.add_event': (u'event', 1, [{'trigger_type': 1, 'parameters': {'name': 'value'}}]),
+    'Database.add_event2': (EVENT['name'], EVENT['enabled'], EVENT['conditions'], EVENT['actions'], EVENT['trigger']),
+    'Database.update_event': (1, EVENT['name'], EVENT['enabled'], EVENT['conditions'], EVENT['actions'], EVENT['trigger']),
+    'Database.import_events': ([EVENT],),
+    'Database.add_trigger': (1, 1, 1, {'name': 'value'}),
+    'Database.delete_history_values': ('2012-01-01 00:00:00', 1000, 1),
+    'DatabaseArchive.aggregate_day': (1, 'GAUGE'),
+}
+
+# Methods that build different statements depending on their arguments, called once more for every
+# additional set of arguments
+ALTERNATIVES = {
+    # The default retention pass, for every value without a policy of its own
+    'Database.delete_history_values': [('2012-01-01 00:00:00', 1000, None)],
+}
+
+# Methods that don't issue queries of their own
+IGNORED = ('updatedb', 'check_plugin_auth', 'insert_result', 'cb_device_crud', 'cb_plugin_crud',
+           'attach_main_db', 'attach_archive_db', 'check_archive_db', 'create_archive_db',
+           'prepare_archive_db', 'close')
+
+def collect(cls, instance):
+    '''
+    Call every public method of a database class with dummy arguments.
+
+    @return: a list of (method name, sql, parameters) tuples
+    '''
+    statements = []
+    for name, method in sorted(inspect.getmembers(cls, inspect.ismethod)):
+        if name.startswith('_') or name in IGNORED:
+            continue
+
+        pool = RecordingPool()
+        instance.dbpool = instance.readpool = pool
+        args = ARGUMENTS.get('%s.%s' % (cls.__name__, name))
+        if args is None:
+            args = (1,) * (len(inspect.getargspec(method).args) - 1 - len(inspect.getargspec(method).defaults or ()))
+
+        for args in [args] + ALTERNATIVES.get('%s.%s' % (cls.__name__, name), []):
+            d = defer.maybeDeferred(getattr(instance, name), *args)
+            d.addErrback(lambda failure, name=name: sys.stderr.write("%s: %s\n" % (name, failure.getErrorMessage())))
+
+        statements.extend((name, sql, params) for sql, params in pool.statements)
+
+    return statements
+
+def check(connection, classname, statements):
+    '''
+    Explain the statements and report full scans.
+
+    @return: the number of failures
+    '''
+    failures = 0
+    for name, sql, params in statements:
+        sql = ' '.join(sql.split())
+        if SKIP.match(sql):
+            continue
+
+        try:
+            plan = [row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        except sqlite3.Error, err:
+            print "WARN %s.%s: statement does not prepare (%s)\n     %s" % (classname, name, err, sql)
+            continue
+
+        allowed = ALLOWED.get((classname, name), ())
+        scans = [step for step in plan if re.match(r'SCAN (TABLE )?\w', step)
+                 and not re.match(r'SCAN (TABLE )?(\w+\.)?(%s)\b' % '|'.join(allowed or ('-',)), step)]
+
+        if ' WHERE ' in sql.upper() and scans:
+            failures += 1
+            print "FAIL %s.%s: %s\n     %s" % (classname, name, '; '.join(scans), sql)
+        else:
+            print "ok   %s.%s: %s" % (classname, name, '; '.join(plan))
+
+    return failures
+
+def main():
+    source = os.path.join(CWD, sys.argv[1]) if len(sys.argv) > 1 else 'houseagent.db'
+    workdir = tempfile.mkdtemp(prefix='houseagent-plans-')
+    try:
+        db_location = os.path.join(workdir, 'houseagent.db')
+        shutil.copy(source, db_location)
+
+        # Upgrade the copy to the current schema
+        database = new.instance(Database, {'log': NullLog(), '_db_location': db_location, 'ids': IdCache(),
+                                           'view': Null(), 'histcollector': Null(), 'coordinator': None})
+        connection = sqlite3.connect(db_location)
+        database._updatedb(connection.cursor(), '0.6')
+        connection.commit()
+
+        failures = check(connection, 'Database', collect(Database, database))
+        connection.close()
+
+        # A new archive, with the main database attached like DatabaseArchive does
+        archive = new.instance(DatabaseArchive, {'log': NullLog()})
+        connection = sqlite3.connect(os.path.join(workdir, 'archive.db'))
+        archive._prepare_archive_db(connection.cursor())
+        connection.execute("ATTACH DATABASE '%s' AS houseagent;" % db_location)
+
+        failures += check(connection, 'DatabaseArchive', collect(DatabaseArchive, archive))
+        connection.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print "%d statements with full scans" % failures
+    sys.exit(failures)
+
+if __name__ == '__main__':
+    main()
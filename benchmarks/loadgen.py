@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+'''
+End-to-end ingestion benchmark using simulated plugins.
+
+Starts a coordinator with the event engine in a child process, backed by a temporary
+copy of houseagent.db, or by the in-memory storage engine loaded from it. The simulated plugins are PluginAPI instances in this process,
+each with a number of devices, sending value updates at a fixed rate. Every device value
+gets a "Device value change" trigger, so each update goes through the event engine.
+
+The value of each update is its send time, which gives the latency from send to database
+commit and from send to event trigger dispatch. Updates sent during the warm-up period
+are not measured.
+
+Reported: sustained throughput, p50/p95/p99 latencies and the CPU time used by the
+coordinator process. The results are written as JSON so runs can be compared.
+
+Usage: python benchmarks/loadgen.py [options], see --help
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+# Paths given on the command line are relative to the directory the tool was started from
+CWD = os.getcwd()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, task
+from bench_registry import NullLog
+from benchstats import LatencyProbe, print_results, git_revision
+
+def prepare_database(path, plugins, devices):
+    '''
+    Create the simulated plugins, their devices, device values and triggers.
+    '''
+    shutil.copy('houseagent.db', path)
+
+    connection = sqlite3.connect(path)
+    trigger_type = connection.execute("SELECT id FROM trigger_types WHERE name='Device value change'").fetchone()[0]
+
+    for p in range(plugins):
+        plugin_id = connection.execute("INSERT INTO plugins (name, authcode, location_id) VALUES (?, ?, NULL)",
+                                       ('loadgen-%d' % p, 'loadgen-%d' % p)).lastrowid
+        for d in range(devices):
+            device_id = connection.execute("INSERT INTO devices (name, address, plugin_id) VALUES (?, ?, ?)",
+                                           ('device %d' % d, 'dev-%d' % d, plugin_id)).lastrowid
+            value_id = connection.execute("INSERT INTO current_values (name, value, device_id) VALUES ('Power', '', ?)",
+                                          (device_id,)).lastrowid
+            event_id = connection.execute("INSERT INTO events (name, enabled) VALUES (?, 1)", ('loadgen %d' % value_id,)).lastrowid
+            trigger_id = connection.execute("INSERT INTO triggers (trigger_types_id, events_id, conditions) VALUES (?, ?, 0)",
+                                            (trigger_type, event_id)).lastrowid
+            connection.executemany("INSERT INTO trigger_parameters (name, value, triggers_id) VALUES (?, ?, ?)",
+                                   [('current_value_id', str(value_id), trigger_id), ('condition', 'ne', trigger_id),
+                                    ('condition_value', '', trigger_id)])
+
+    connection.commit()
+    connection.close()
+
+def run_coordinator(options):
+    '''
+    Child process: run the coordinator and the event engine, and collect latency samples.
+    '''
+    from houseagent.core.coordinator import Coordinator
+    from houseagent.core.database import Database
+    from houseagent.core.databasememory import MemoryDatabase
+    from houseagent.core.events import EventHandler
+
+    log = NullLog()
+    if options.engine == 'memory':
+        database = MemoryDatabase(log, options.db)
+    else:
+        database = Database(log, options.db)
+    coordinator = Coordinator(log, database)
+    coordinator.init_broker('127.0.0.1', options.port)
+    event_handler = EventHandler(log, coordinator, database)
+
+    window_start = options.start + options.warmup
+    window_end = window_start + options.duration
+    
+    # The value of each update is its send time
+    probe = LatencyProbe(coordinator, event_handler, lambda update: float(update[1]), (window_start, window_end))
+
+    def finish():
+        probe.stop_cpu()
+        results = probe.results()
+        results['rpc'] = coordinator.get_stats()['rpc']
+        with open(options.report, 'w') as report:
+            json.dump(results, report)
+        reactor.stop()
+
+    reactor.callLater(window_start - time.time(), probe.start_cpu)
+    reactor.callLater(window_end + options.drain - time.time(), finish)
+    reactor.run()
+
+def run_plugins(options):
+    '''
+    Send value updates from the simulated plugins at the configured rate.
+
+    @return: the number of updates sent during the measurement window
+    '''
+    from houseagent.plugins.pluginapi import PluginAPI
+
+    plugins = [PluginAPI('loadgen-%d' % p, 'loadgen', '127.0.0.1', options.port, batch_size=options.batch)
+               for p in range(options.plugins)]
+    for plugin in plugins:
+        plugin.ready()
+
+    window_start = options.start + options.warmup
+    window_end = window_start + options.duration
+    state = {'sent': 0, 'measured': 0}
+
+    def tick():
+        now = time.time()
+        if now >= window_end:
+            sender.stop()
+            for plugin in plugins:
+                plugin.flush_value_updates()
+            reactor.callLater(1, reactor.stop)
+            return
+
+        # Catch up with the number of updates that should have been sent by now
+        due = int((now - options.start) * options.rate)
+        while state['sent'] < due:
+            device = 'dev-%d' % (state['sent'] % options.devices)
+            for plugin in plugins:
+                sent = time.time()
+                plugin.value_update(device, {'Power': repr(sent)})
+                if sent >= window_start:
+                    state['measured'] += 1
+            state['sent'] += 1
+
+    sender = task.LoopingCall(tick)
+    reactor.callLater(options.start - time.time(), sender.start, 0.005)
+    reactor.run()
+
+    return state['measured']
+
+def main():
+    parser = OptionParser(usage="python benchmarks/loadgen.py [options]")
+    parser.add_option('--plugins', type='int', default=10, help="number of simulated plugins [%default]")
+    parser.add_option('--devices', type='int', default=10, help="number of devices per plugin [%default]")
+    parser.add_option('--rate', type='float', default=50, help="value updates per second per plugin [%default]")
+    parser.add_option('--batch', type='int', default=0, help="plugin side batch size, 0 disables batching [%default]")
+    parser.add_option('--duration', type='float', default=30, help="measurement time in seconds [%default]")
+    parser.add_option('--warmup', type='float', default=5, help="warm-up time in seconds [%default]")
+    parser.add_option('--drain', type='float', default=3, help="time to wait for outstanding updates [%default]")
+    parser.add_option('--port', type='int', default=23001, help="broker port [%default]")
+    parser.add_option('--engine', default='sqlite', help="storage engine of the coordinator, sqlite or memory [%default]")
+    parser.add_option('--output', default='loadgen-results.json', help="file to write the results to [%default]")
+    # Internal options, used to start the coordinator process
+    parser.add_option('--coordinator', action='store_true', help="run the coordinator process")
+    parser.add_option('--db')
+    parser.add_option('--report')
+    parser.add_option('--start', type='float')
+    options, args = parser.parse_args()
+
+    if options.coordinator:
+        run_coordinator(options)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='houseagent-loadgen-')
+    try:
+        options.db = os.path.join(workdir, 'houseagent.db')
+        options.report = os.path.join(workdir, 'report.json')
+        prepare_database(options.db, options.plugins, options.devices)
+
+        # Leave the coordinator some time to start and load its triggers
+        options.start = time.time() + 3
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--coordinator',
+                                  '--db', options.db, '--report', options.report, '--port', str(options.port),
+                                  '--engine', options.engine,
+                                  '--start', repr(options.start), '--warmup', str(options.warmup),
+                                  '--duration', str(options.duration), '--drain', str(options.drain)])
+
+        sent = run_plugins(options)
+        child.wait()
+
+        with open(options.report) as report:
+            coordinator = json.load(report)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {'revision': git_revision(),
+               'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'config': {'plugins': options.plugins, 'devices': options.devices, 'rate': options.rate,
+                          'batch': options.batch, 'duration': options.duration, 'warmup': options.warmup,
+                          'engine': options.engine},
+               'sent': sent,
+               'throughput': coordinator['committed'] / options.duration,
+               'offered': sent / options.duration,
+               'lost': sent - coordinator['committed']}
+    results.update(coordinator)
+
+    with open(os.path.join(CWD, options.output), 'w') as output:
+        json.dump(results, output, indent=2)
+
+    print "Offered %.0f updates/s, %d updates lost" % (results['offered'], results['lost'])
+    print_results(results, options.duration + options.drain)
+    print "Results written to %s" % options.output
+
+    # Every simulated value has a trigger that matches any update, committed updates without
+    # event samples mean the event engine or the probe is broken
+    if results['committed'] and not results['event_latency']['count']:
+        print "No event samples were collected for %d committed updates" % results['committed']
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
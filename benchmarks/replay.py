@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+'''
+Replay captured broker traffic into a fresh coordinator.
+
+Captures are recorded by setting capturefile in the [zmq] section of HouseAgent.conf.
+The captured messages are fed into the broker of a coordinator running in this process,
+backed by a temporary copy of the database, at the original speed, N times faster or as
+fast as possible. The event engine runs on the same database, so triggers fire like they
+did in production.
+
+The coordinator only accepts value updates from plugins it has seen a ready message from,
+so start capturing before the plugins connect (or restart them once capturing).
+
+Reported are the same statistics as benchmarks/loadgen.py, with the latencies measured from
+the moment a message is fed into the broker. The results are written as JSON.
+
+Usage: python benchmarks/replay.py [options] capturefile, see --help
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+# Paths given on the command line are relative to the directory the tool was started from
+CWD = os.getcwd()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor
+from bench_registry import NullLog
+from benchstats import LatencyProbe, print_results, git_revision
+from houseagent.utils.capture import CaptureReader
+
+# Number of messages fed in one go when replaying at maximum speed, before the reactor
+# gets the chance to handle database results
+CHUNK_SIZE = 500
+
+class Replayer(object):
+    '''
+    Feeds the messages of a capture into a broker, time-scaled.
+    '''
+
+    def __init__(self, reader, broker, speed, done):
+        '''
+        @param reader: a CaptureReader
+        @param broker: the broker to feed the messages into
+        @param speed: the replay speed, 1 is the original speed, 0 replays as fast as possible
+        @param done: function called when all messages have been fed
+        '''
+        self.records = iter(reader)
+        self.broker = broker
+        self.speed = speed
+        self.done = done
+        self.messages = 0
+
+        self._next = None
+        self._start = None
+        self._first = None
+
+    def start(self):
+        self._start = time.time()
+        self._next = next(self.records, None)
+        if self._next:
+            self._first = self._next[0]
+        self._feed()
+
+    def _feed(self):
+        count = 0
+        now = time.time()
+
+        while self._next:
+            timestamp, frames = self._next
+
+            if self.speed:
+                due = self._start + (timestamp - self._first) / self.speed
+                if due > now:
+                    reactor.callLater(due - now, self._feed)
+                    return
+            elif count >= CHUNK_SIZE:
+                reactor.callLater(0, self._feed)
+                return
+
+            self.broker.messageReceived(frames)
+            self.messages += 1
+            count += 1
+            self._next = next(self.records, None)
+
+        self.done()
+
+def main():
+    parser = OptionParser(usage="python benchmarks/replay.py [options] capturefile")
+    parser.add_option('--speed', type='float', default=1, help="replay speed, 1 is the original speed, 0 is as fast as possible [%default]")
+    parser.add_option('--db', default='houseagent.db', help="database the capture was recorded with, it is copied first [%default]")
+    parser.add_option('--port', type='int', default=23001, help="broker port [%default]")
+    parser.add_option('--output', default='replay-results.json', help="file to write the results to [%default]")
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("specify the capture file to replay")
+
+    from houseagent.core.coordinator import Coordinator
+    from houseagent.core.database import Database
+    from houseagent.core.events import EventHandler
+
+    reader = CaptureReader(os.path.join(CWD, args[0]))
+    workdir = tempfile.mkdtemp(prefix='houseagent-replay-')
+    shutil.copy(os.path.join(CWD, options.db), os.path.join(workdir, 'houseagent.db'))
+
+    log = NullLog()
+    database = Database(log, os.path.join(workdir, 'houseagent.db'))
+    coordinator = Coordinator(log, database)
+    coordinator.init_broker('127.0.0.1', options.port)
+    event_handler = EventHandler(log, coordinator, database)
+    probe = LatencyProbe(coordinator, event_handler)
+    state = {}
+
+    def drain():
+        # Wait until the ingestion stage wrote everything
+        ingestor = coordinator.ingestor
+        if ingestor.stats()['queued'] or ingestor._flushing:
+            ingestor.flush()
+            reactor.callLater(0.05, drain)
+        else:
+            probe.stop_cpu()
+            state['end'] = time.time()
+            reactor.stop()
+
+    def start():
+        probe.start_cpu()
+        state['start'] = time.time()
+        replayer.start()
+
+    replayer = Replayer(reader, coordinator.broker, options.speed, drain)
+
+    # Leave the event engine some time to load its triggers
+    reactor.callLater(1, start)
+    try:
+        reactor.run()
+    finally:
+        reader.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    duration = state['end'] - state['start']
+    stats = probe.results()
+    results = {'revision': git_revision(),
+               'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'config': {'capture': args[0], 'speed': options.speed},
+               'messages': replayer.messages,
+               'duration': duration,
+               'throughput': stats['committed'] / duration}
+    results.update(stats)
+
+    with open(os.path.join(CWD, options.output), 'w') as output:
+        json.dump(results, output, indent=2)
+
+    print "Replayed %d messages in %.2f s (%.0f messages/s)" % (replayer.messages, duration, replayer.messages / duration)
+    print_results(results, duration)
+    print "Results written to %s" % options.output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import datetime
+import os
+import re
+import shutil
+import sqlite3
+from twisted.internet import defer, threads
+from twisted.internet.task import LoopingCall
+
+# Snapshots taken by BackupManager, named after the time they were taken
+_SNAPSHOT = re.compile(r'^houseagent-\d{8}-\d{6}-\d{6}\.db$')
+
+def snapshot(db_location, path):
+    '''
+    Write a consistent copy of a database, while it's in use.
+
+    The copy is made with VACUUM INTO on a connection of its own, SQLite versions before 3.27
+    don't have it and copy the file instead. Either way the database is read in a single read
+    transaction, so writes committed meanwhile are left out rather than torn into the copy.
+    With write-ahead logging writers carry on while the copy is made, with the rollback journal
+    they wait for the read transaction to finish. The database writer retries its commits
+    meanwhile, so writes are delayed rather than lost.
+    The copy is written next to path and renamed once complete, so path never holds a partial
+    copy. This blocks, run it in a thread.
+    @param db_location: the location of the database file
+    @param path: the location of the copy, it must not exist yet
+    '''
+    temp = path + '.part'
+    if os.path.exists(temp):
+        os.remove(temp)
+
+    connection = sqlite3.connect(db_location)
+    try:
+        if sqlite3.sqlite_version_info >= (3, 27, 0):
+            connection.execute("VACUUM INTO ?", (temp,))
+        else:
+            _copy(connection, db_location, temp)
+    finally:
+        connection.close()
+
+    os.rename(temp, path)
+
+def _copy(connection, db_location, path):
+    '''
+    Copy the database file within a read transaction, for SQLite versions without VACUUM INTO.
+    The read transaction keeps writers from changing the file with the rollback journal, and
+    from restarting the write-ahead log, which is copied along and folded into the copy.
+    '''
+    connection.isolation_level = None
+    connection.execute("BEGIN")
+    try:
+        connection.execute("SELECT COUNT(*) FROM sqlite_master").fetchall()
+        shutil.copyfile(db_location, path)
+        if os.path.exists(db_location + '-wal'):
+            shutil.copyfile(db_location + '-wal', path + '-wal')
+    finally:
+        connection.execute("ROLLBACK")
+
+    copy = sqlite3.connect(path)
+    try:
+        copy.execute("PRAGMA journal_mode=DELETE").fetchall()
+    finally:
+        copy.close()
+
+class BackupManager(object):
+    '''
+    Online backups of the HouseAgent database.
+
+    Snapshots are taken in a thread, one at a time, every interval seconds and on demand. Only
+    the last keep snapshots in the backup directory are kept.
+    '''
+
+    def __init__(self, db_location, directory, interval=0, keep=7, log=None):
+        '''
+        @param db_location: the location of the database file
+        @param directory: the directory the snapshots are written to, it is created when missing
+        @param interval: seconds between scheduled snapshots, 0 disables them
+        @param keep: the number of snapshots kept, 0 keeps all of them
+        @param log: logging object
+        '''
+        self.db_location = db_location
+        self.directory = directory
+        self.keep = keep
+        self.log = log
+
+        self._lock = defer.DeferredLock()
+
+        if interval > 0:
+            self._schedule = LoopingCall(self._scheduled)
+            self._schedule.start(interval, False)
+
+    def snapshot(self):
+        '''
+        Take a snapshot and drop the snapshots exceeding the retention.
+
+        @return: a Twisted deferred which fires with the path of the new snapshot
+        '''
+        return self._lock.run(threads.deferToThread, self._snapshot)
+
+    def snapshots(self):
+        '''
+        @return: the paths of the snapshots in the backup directory, oldest first
+        '''
+        if not os.path.isdir(self.directory):
+            return []
+
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                if _SNAPSHOT.match(name)]
+
+    def _snapshot(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        path = os.path.join(self.directory, datetime.datetime.now().strftime("houseagent-%Y%m%d-%H%M%S-%f.db"))
+        snapshot(self.db_location, path)
+
+        if self.keep > 0:
+            for old in self.snapshots()[:-self.keep]:
+                os.remove(old)
+
+        return path
+
+    def _scheduled(self):
+        def failed(failure):
+            # Keep the schedule running
+            if self.log:
+                self.log.error("Database backup failed (%s)" % failure.getErrorMessage())
+
+        def done(path):
+            if self.log:
+                self.log.info("Database backup written to %s" % path)
+
+        return self.snapshot().addCallbacks(done, failed)
@@ -0,0 +1,88 @@
+import time
+from collections import deque
+
+class ValueEvent(object):
+    '''
+    Skeleton class for a value change event.
+    '''
+    def __init__(self, seq, value_id, value, time):
+        self.seq = seq
+        self.value_id = value_id
+        self.value = value
+        self.time = time
+
+    def json(self):
+        return {'seq': self.seq, 'id': self.value_id, 'value': self.value, 'time': self.time}
+
+class ValueBus(object):
+    '''
+    In-process publish/subscribe bus for value changes.
+    Every change gets a sequence number which increases monotonically within a session. The most
+    recent events are kept in a ring buffer, so subscribers can resume after a reconnect.
+    '''
+
+    def __init__(self, history=1000):
+        '''
+        Initialize a new ValueBus.
+        @param history: the number of events kept for subscribers that resume
+        '''
+        # Sequence numbers restart with the coordinator, the session tells them apart
+        self.session = '%x' % int(time.time())
+        self.seq = 0
+
+        self._events = deque(maxlen=history)
+        self._values = {}
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        '''
+        Subscribe to value changes.
+        @param callback: function called with a list of ValueEvent objects
+        '''
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def publish(self, values):
+        '''
+        Publish a batch of committed values, values that didn't change are skipped.
+        @param values: a list of (value_id, value) tuples in arrival order
+
+        @return: the list of published events
+        '''
+        now = time.time()
+        events = []
+
+        for value_id, value in values:
+            if not value_id or self._values.get(value_id) == value:
+                continue
+
+            self._values[value_id] = value
+            self.seq += 1
+            event = ValueEvent(self.seq, value_id, value, now)
+            self._events.append(event)
+            events.append(event)
+
+        if events:
+            for callback in list(self._subscribers):
+                callback(events)
+
+        return events
+
+    def since(self, seq):
+        '''
+        Get the events published after a sequence number.
+        @param seq: the last sequence number seen by the subscriber
+
+        @return: a list of ValueEvent objects, or None if the events are no longer available
+        '''
+        if seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        if not self._events or self._events[0].seq > seq + 1:
+            return None
+
+        return [event for event in self._events if event.seq > seq]
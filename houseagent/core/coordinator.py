@@ -1,10 +1,23 @@
 import json
 import time
-from txzmq import ZmqFactory, ZmqEndpoint, ZmqEndpointType, ZmqConnection
+from txzmq import ZmqFactory, ZmqEndpoint, ZmqEndpointType, ZmqConnection, ZmqPubConnection
 from twisted.internet.defer import inlineCallbacks
-from twisted.internet.task import deferLater
+from twisted.internet.task import deferLater, LoopingCall
 from twisted.internet import reactor, defer
+from twisted.python import log
+from zmq import ZMQError
 from zmq.core import constants
+from houseagent.core.ingestion import ValueIngestor
+from houseagent.core.bus import ValueBus
+from houseagent.core.rpc import RPCManager
+from houseagent.core.scheduler import CommandScheduler
+from houseagent.core.dispatch import PriorityDispatcher
+from houseagent.utils.error import PluginOffline
+from houseagent.utils.codec import MessageCodec, negotiate, crud_topic
+from houseagent.utils.capture import CaptureWriter
+
+# Seconds between heartbeats of plugins that don't negotiate options in the ready handshake
+LEGACY_HEARTBEAT_INTERVAL = 30
 
 class Broker(ZmqConnection):
     '''
@@ -13,28 +26,63 @@ class Broker(ZmqConnection):
     '''
     socketType = constants.XREP
     
-    def __init__(self, factory, coordinator, *endpoints):
+    def __init__(self, factory, coordinator, *endpoints, **kwargs):
         '''
         Intializer
         @param factory: a ZmqFactory instance.
         @param coordinator: a Coordinator instance.
+        @param rpc_timeout: the number of seconds to wait for a RPC reply (keyword argument)
+        @param rpc_max_in_flight: the maximum number of outstanding RPC requests per plugin (keyword argument)
+        @param capture: a CaptureWriter all received messages are appended to (keyword argument)
+        @param telemetry_quantum: the maximum number of value updates handled before control messages 
+                                  get another turn (keyword argument)
+        @param telemetry_queue: the maximum number of queued value update messages, reading from the socket
+                                stops when it's reached (keyword argument)
+        @param socket_options: a SocketOptions instance (keyword argument)
         
         @return: Nothing
         '''
+        socket_options = kwargs.get('socket_options')
+        if socket_options:
+            socket_options.prepare(self)
+        
+        self.paused = False
         ZmqConnection.__init__(self, factory, *endpoints)
+        
+        if socket_options:
+            socket_options.apply(self)
+        
         self.coordinator = coordinator
-        self.message_id = 0
-        self.requests = {}
+        self.codec = MessageCodec()
+        self.rpc = RPCManager(self.send, kwargs.get('rpc_timeout', 10.0), kwargs.get('rpc_max_in_flight', 32))
+        self.capture = kwargs.get('capture')
+        self.dispatcher = PriorityDispatcher(self.dispatch, kwargs.get('telemetry_quantum', 256),
+                                             kwargs.get('telemetry_queue', 10000))
+        self.dispatcher.pause_reading = self.pause_reading
+        self.dispatcher.resume_reading = self.resume_reading
     
     def messageReceived(self, msg):
         '''
         This function is called when a ZMQ message has been received.
+        The message is queued by traffic class, control messages are handled before telemetry.
         @param msg: the raw message that has been received
         
         @return: Nothing
         '''
         self.coordinator.log.debug("Coordinator::Raw ZMQ message received: %r" % (msg))
         
+        if self.capture:
+            self.capture.write(time.time(), msg)
+        
+        self.dispatcher.put(msg)
+        
+    def dispatch(self, msg):
+        '''
+        This function handles a received message, called in order of priority.
+        @param msg: the raw message to handle
+        
+        @return: Nothing
+        '''
         routing_info = msg[0]
         type = msg[2]
         payload = msg[3:]
@@ -49,23 +97,59 @@ class Broker(ZmqConnection):
             except KeyError:
                 self.coordinator.log.error("Coordinator::Unhandled network response received: %r" % (msg))
     
-    def send_rpc(self, routing_info, message):       
+    def doRead(self):
+        '''
+        Read the messages waiting in the socket, like ZmqConnection.doRead, but stop as soon as
+        reading is paused. Otherwise a single read empties the socket into the dispatcher, no
+        matter how full its telemetry lane is.
+        '''
+        if self.read_scheduled is not None:
+            if not self.read_scheduled.called:
+                self.read_scheduled.cancel()
+            self.read_scheduled = None
+        
+        # txzmq also schedules reads after sending, these must wait while reading is paused
+        while not self.paused and self.factory is not None:
+            if not self.socket_get(constants.EVENTS) & constants.POLLIN:
+                return
+            
+            try:
+                message = self._readMultipart()
+            except ZMQError, e:
+                if e.errno == constants.EAGAIN:
+                    continue
+                raise
+            
+            log.callWithLogger(self, self.messageReceived, message)
+    
+    def pause_reading(self):
+        '''
+        Stop reading messages from the socket, they queue up in ZeroMQ up to the receive high-water mark.
+        This is done when the telemetry lane of the dispatcher is full, it also holds back control
+        messages such as heartbeats and RPC replies until reading resumes.
+        '''
+        self.paused = True
+        reactor.removeReader(self)
+        
+    def resume_reading(self):
+        '''
+        Start reading messages from the socket again.
+        '''
+        self.paused = False
+        reactor.addReader(self)
+        self.doRead()
+    
+    def send_rpc(self, routing_info, message, codec=None):       
         '''
         This function sends a RPC message to a specified plugin.
         @param routing_info: the routing information of the plugin
         @param message: the message to send
+        @param codec: the MessageCodec negotiated with the plugin, defaults to JSON
         
         @return a Twisted deferred.
         '''
-        d = defer.Deferred()
-        message_id = self.get_next_id()
-        self.requests[message_id] = d
-        message = [routing_info, b'', chr(4), message_id, json.dumps(message)]
-
         self.coordinator.log.debug("Coordinator::Sending RPC message:%r" % (message))
-        self.send(message)
-        
-        return d
+        return self.rpc.call(routing_info, (codec or self.codec).encode(message))
     
     def handle_rpc_reply(self, payload):
         '''
@@ -78,54 +162,156 @@ class Broker(ZmqConnection):
         message_id = payload[0]
         payload = payload[1]
         
-        d = self.requests.pop(message_id)
-        d.callback(json.loads(payload))
-    
-    def get_next_id(self):
-        '''
-        Get a unique message ID.
-        
-        @return: a unique message ID
-        '''
-        return 'msg_id_%d' % (self.message_id + 1,)
+        if not self.rpc.handle_reply(message_id, self.codec.decode(payload)):
+            self.coordinator.log.warning("Coordinator::Received RPC reply for unknown or expired request %s" % (message_id))
 
 class Coordinator(object):
     '''
     This class represents the network coordinator for HouseAgent.
     '''
     
-    def __init__(self, log, database):
+    def __init__(self, log, database, flush_size=500, flush_interval=0.005, max_queue=0, overload_policy='block'):
         '''
         Initialize the Coordinator
         @param log: a reference to the HouseAgent logger
         @param database: an instance of the HouseAgent database
+        @param flush_size: the number of queued value updates that triggers a database write
+        @param flush_interval: the maximum time in seconds a value update is queued before it's written
+        @param max_queue: the maximum number of queued value updates, 0 means unbounded
+        @param overload_policy: what to do with value updates when the queue is full: block, drop_oldest or latest
         
         @return: nothing
         '''
         self.factory = ZmqFactory()
         self.log = log
         self.db = database
-        self.plugins = []
+        self.plugins = PluginRegistry()
         self.crud_callbacks = []
+        self.status_callbacks = []
         self.eventengine = None
+        self.monitor = None
+        self.publisher = None
+        self.pub_port = None
+        self.pub_codec = MessageCodec('bin1')
+        self.bus = ValueBus()
+        self.scheduler = CommandScheduler(self.dispatch_command)
+        self.ingestor = ValueIngestor(log, database, self.values_committed, flush_size, flush_interval, 
+                                      max_queue, overload_policy)
         
         self.plugin_cmds = { '\x01': self.handle_plugin_ready,
                              '\x02': self.handle_plugin_heartbeat,
-                             '\x03': self.handle_plugin_value_update}
+                             '\x03': self.handle_plugin_value_update,
+                             '\x08': self.handle_plugin_value_batch}
         
         # Startup actions
         self.load_plugins()
         self.db.coordinator = self
     
-    def init_broker(self, host='*', port=13001):
+    def init_broker(self, host='*', port=13001, rpc_timeout=10.0, rpc_max_in_flight=32, 
+                    heartbeat_interval=30, missed_heartbeats=3, pub_port=0, capture_file=None,
+                    telemetry_quantum=256, socket_options=None, telemetry_queue=10000):
         '''
         Initialize a new broker instance
         @param host: the hostname to listen on
         @param port: the port to listen on
+        @param rpc_timeout: the number of seconds to wait for a RPC reply
+        @param rpc_max_in_flight: the maximum number of outstanding RPC requests per plugin
+        @param heartbeat_interval: the number of seconds between plugin heartbeats, sent to plugins in the ready handshake
+        @param missed_heartbeats: the number of missed heartbeats after which a plugin is considered offline
+        @param pub_port: the port to publish notifications on, 0 disables the notification channel
+        @param capture_file: when specified, all messages received by the broker are appended to this capture file
+        @param telemetry_quantum: the maximum number of value updates handled before control messages get another turn
+        @param socket_options: a SocketOptions instance with the high-water marks, linger and keepalive settings
+        @param telemetry_queue: the maximum number of value update messages queued in the broker, 0 means unbounded
         
         @return: nothing
         '''
-        self.broker = Broker(self.factory, self, ZmqEndpoint(ZmqEndpointType.bind, 'tcp://%s:%s' % (host, port)))
+        capture = None
+        if capture_file:
+            self.log.info("Coordinator::Capturing broker traffic to %s" % capture_file)
+            capture = CaptureWriter(capture_file)
+            reactor.addSystemEventTrigger('after', 'shutdown', capture.close)
+        
+        self.broker = Broker(self.factory, self, ZmqEndpoint(ZmqEndpointType.bind, 'tcp://%s:%s' % (host, port)),
+                             rpc_timeout=rpc_timeout, rpc_max_in_flight=rpc_max_in_flight, capture=capture,
+                             telemetry_quantum=telemetry_quantum, telemetry_queue=telemetry_queue,
+                             socket_options=socket_options)
+        
+        # With the block overload policy, the ingestion stage holds value updates in the broker when it
+        # can't keep up. Control traffic keeps flowing until the telemetry lane is full.
+        self.ingestor.pause_reading = self.broker.dispatcher.hold_telemetry
+        self.ingestor.resume_reading = self.broker.dispatcher.release_telemetry
+        
+        # Notifications are published on a separate socket, so they don't compete with 
+        # value updates and RPC traffic on the broker socket
+        if pub_port:
+            self.pub_port = pub_port
+            self.publisher = ZmqPubConnection(self.factory, ZmqEndpoint(ZmqEndpointType.bind, 'tcp://%s:%s' % (host, pub_port)))
+        
+        # Start liveness monitoring of the plugins
+        self.heartbeat_interval = heartbeat_interval
+        self.missed_heartbeats = missed_heartbeats
+        self.monitor = LoopingCall(self.check_liveness)
+        self.monitor.start(heartbeat_interval, False)
+    
+    def check_liveness(self):
+        '''
+        This function sweeps all plugins and sets plugins that missed too many heartbeats offline.
+        '''
+        if self.broker.paused:
+            # Heartbeats are waiting in the socket, they can't be told apart from missed ones
+            self.log.debug("Coordinator::Broker isn't reading, skipping the liveness check...")
+            return
+        
+        now = time.time()
+        
+        for plugin in self.plugins:
+            if plugin.online and plugin.time < now - plugin.heartbeat_interval * self.missed_heartbeats:
+                self.log.warning("Coordinator::Plugin %s missed %d heartbeats, setting status to offline..." % (plugin.guid, self.missed_heartbeats))
+                self.set_plugin_offline(plugin)
+    
+    def set_plugin_online(self, plugin):
+        '''
+        Mark a plugin online and notify status subscribers.
+        @param plugin: the Plugin instance
+        '''
+        plugin.time = time.time()
+        if not plugin.online:
+            plugin.online = True
+            self._notify_status(plugin)
+    
+    def set_plugin_offline(self, plugin):
+        '''
+        Mark a plugin offline, fail it's outstanding RPC requests and notify status subscribers.
+        @param plugin: the Plugin instance
+        '''
+        was_online = plugin.online
+        plugin.online = False
+        
+        if plugin.routing_info is not None:
+            self.broker.rpc.fail_pending(plugin.routing_info, PluginOffline(plugin.guid))
+        
+        if was_online:
+            self._notify_status(plugin)
+    
+    def _notify_status(self, plugin):
+        for callback in self.status_callbacks:
+            try:
+                callback(plugin.guid, plugin.online)
+            except Exception, e:
+                self.log.error("Coordinator::Plugin status callback failed: %s" % e)
+    
+    def get_stats(self):
+        '''
+        Returns runtime statistics of the coordinator.
+        
+        @return: a dictionary with statistics
+        '''
+        return {'plugins': len(self.plugins),
+                'rpc': self.broker.rpc.stats(),
+                'commands': self.scheduler.stats(),
+                'lanes': self.broker.dispatcher.stats(),
+                'ingestion': self.ingestor.stats()}
 
     def handle_plugin_ready(self, routing_info, payload):
         '''
@@ -138,20 +324,46 @@ class Coordinator(object):
         '''
         self.log.debug("Coordinator::Received plugin ready message from: %r" % (payload[0]) )
 
-        found = False
+        plugin = self.plugins.by_guid(payload[0])
 
-        for plugin in self.plugins:
-            if plugin.guid == payload[0]:
-                self.log.debug("Coordinator::Plugin found in database, setting status to online...")
-                found = True
-                plugin.online = True
-                plugin.type = payload[1]
-                plugin.routing_info = routing_info
+        if plugin:
+            self.log.debug("Coordinator::Plugin found in database, setting status to online...")
+            
+            if plugin.routing_info is not None and plugin.routing_info != routing_info:
+                # The plugin reconnected, requests sent to the old connection will never be answered
+                self.broker.rpc.fail_pending(plugin.routing_info, PluginOffline(plugin.guid))
+            
+            other = self.plugins.by_routing_info(routing_info)
+            if other is not None and other is not plugin:
+                # Another plugin registered on this connection, it's gone just like after missed heartbeats
+                self.log.warning("Coordinator::Plugin %s took over the connection of plugin %s, setting it offline..." % (plugin.guid, other.guid))
+                self.set_plugin_offline(other)
+            
+            self.plugins.set_type(plugin, payload[1])
+            self.plugins.set_routing_info(plugin, routing_info)
+            self.set_plugin_online(plugin)
+            
+            # Register callbacks
+            plugin.callbacks = json.loads(payload[2])
+            
+            # Select the message format, plugins that don't announce any formats keep using JSON.
+            # A new codec also starts with empty intern tables, just like the plugin after sending ready.
+            # Plugins that negotiate also subscribe to the notification channel when they handle CRUD updates.
+            if len(payload) > 3:
+                format = negotiate(json.loads(payload[3]))
+                plugin.codec = MessageCodec(format)
                 
-                # Register callbacks
-                plugin.callbacks = json.loads(payload[2])                    
-        
-        if not found:
+                options = {'codec': format, 'heartbeat_interval': self.heartbeat_interval}
+                plugin.heartbeat_interval = self.heartbeat_interval
+                if self.publisher:
+                    options['pub_port'] = self.pub_port
+                plugin.subscriber = bool(self.publisher)
+                self.broker.send([routing_info, b'', chr(7), json.dumps(options)])
+            else:
+                plugin.codec = MessageCodec()
+                plugin.subscriber = False
+                plugin.heartbeat_interval = LEGACY_HEARTBEAT_INTERVAL
+        else:
             self.log.warning("Coordinator::Plugin not found in database! Check your plugin GUID...")
                 
     def handle_plugin_heartbeat(self, routing_info, payload):
@@ -164,42 +376,96 @@ class Coordinator(object):
         @return: nothing
         '''
         self.log.debug("Coordinator::Received plugin heartbeat...")
-        found = False
-        
-        for plugin in self.plugins:
-            if plugin.routing_info == routing_info and plugin.online:
-                found = True
-                self.log.debug("Coordinator::Found plugin routing information and plugin is ready, heartbeat accepted...")
-                plugin.time = time.time()
+        plugin = self.plugins.by_routing_info(routing_info)
         
-        if not found:
+        if plugin and plugin.online:
+            self.log.debug("Coordinator::Found plugin routing information and plugin is ready, heartbeat accepted...")
+            plugin.time = time.time()
+        else:
             self.log.debug("Coordinator::Plugin is not ready, asking plugin about ready status...")
             message = [routing_info, b'', chr(1)]
             self.broker.send(message)
                 
-    @inlineCallbacks
     def handle_plugin_value_update(self, routing_info, payload):
         '''
         This function handles plugin value updates. 
+        The updates are queued on the ingestion stage, which writes them to the database in batches.
         
         @param routing_info: the routing information associated with the plugin
         @param payload: the payload, such as the device values and value labels
         '''
         self.log.debug("Coordinator::Received plugin value update...")
         
-        for plugin in self.plugins:
-            if plugin.routing_info == routing_info:
-                message = json.loads(payload[0])
-                self.log.debug("Coordinator::Decoded update, sending to database: %r " % (message))
-                
-                for key in message["values"]:
-                    value_id = yield self.db.update_or_add_value(key, message["values"][key], 
-                                                plugin.id, 
-                                                message["address"], message["time"])
-
-                    # Notify the eventengine
-                    if self.eventengine:
-                        self.eventengine.device_value_changed(value_id, message["values"][key])
+        plugin = self.plugins.by_routing_info(routing_info)
+        
+        if plugin:
+            message = self._decode_update(plugin, payload[0])
+            if message is None:
+                return
+            
+            self.log.debug("Coordinator::Decoded update, sending to database: %r " % (message))
+            
+            self.ingestor.put_many([(key, value, plugin.id, message["address"], message["time"]) 
+                                    for key, value in message["values"].iteritems()])
+            
+    def handle_plugin_value_batch(self, routing_info, payload):
+        '''
+        This function handles a batch of value updates for multiple devices.
+        The whole batch is queued on the ingestion stage at once, so it is written to the database in 
+        a single transaction and passed to the event engine as one unit.
+        
+        @param routing_info: the routing information associated with the plugin
+        @param payload: the payload, holding a list of updates with the device address and values
+        '''
+        self.log.debug("Coordinator::Received plugin value batch...")
+        
+        plugin = self.plugins.by_routing_info(routing_info)
+        
+        if plugin:
+            message = self._decode_update(plugin, payload[0])
+            if message is None:
+                return
+            
+            self.log.debug("Coordinator::Decoded batch of %d updates, sending to database" % len(message["updates"]))
+            
+            updates = []
+            for update in message["updates"]:
+                update_time = update.get("time", message["time"])
+                for key, value in update["values"].iteritems():
+                    updates.append((key, value, plugin.id, update["address"], update_time))
+                    
+            self.ingestor.put_many(updates)
+    
+    def _decode_update(self, plugin, data):
+        '''
+        Decode a value update message from a plugin.
+        @param plugin: the plugin that sent the message
+        @param data: the encoded message
+        
+        @return: the decoded message, or None when it couldn't be decoded
+        '''
+        if plugin.online:
+            plugin.time = time.time()
+            
+        try:
+            return plugin.codec.decode(data)
+        except (ValueError, KeyError, IndexError), e:
+            # Most likely the intern tables are out of sync, a new ready handshake resets them
+            self.log.warning("Coordinator::Unable to decode value update (%s), asking plugin about ready status..." % e)
+            self.broker.send([plugin.routing_info, b'', chr(1)])
+            return None
+    
+    def values_committed(self, values):
+        '''
+        This function is called by the ingestion stage after a batch of value updates has been committed.
+        @param values: a list of (value_id, value) tuples in arrival order
+        '''
+        # Push changed values to live subscribers, such as the web interface
+        self.bus.publish(values)
+        
+        # Notify the eventengine
+        if self.eventengine:
+            self.eventengine.device_values_changed(values)
                         
     def send_custom(self, plugin_guid, action, parameters):
         '''
@@ -284,15 +550,31 @@ class Coordinator(object):
 
     def send_command(self, plugin_guid, content):
         '''
-        Send command to specified plugin_guid
+        Send command to specified plugin_guid.
+        Commands for the same device value are coalesced by the command scheduler, only the newest
+        command waiting behind an in-flight command is sent.
+        
+        @param plugin_guid: the guid of the plugin
+        @param content: the content to send
+        
+        @return: a Twisted deferred which will callback with the result
+        '''
+        return self.scheduler.submit(plugin_guid, content)
+    
+    def dispatch_command(self, plugin_guid, content):
+        '''
+        Dispatch a command to the specified plugin_guid right away.
         
         @param plugin_guid: the guid of the plugin
         @param content: the content to send
         '''
         self.log.debug("Sending command {0}".format(content))
         p = self.plugin_by_guid(plugin_guid)
-        if p:
-            return self.broker.send_rpc(p.routing_info, content)
+        if p and not p.online:
+            # Fail right away instead of sending to a connection that will never answer
+            return defer.fail(PluginOffline(plugin_guid))
+        elif p:
+            return self.broker.send_rpc(p.routing_info, content, p.codec)
         else:
             d = defer.Deferred()
             d.callback(0)
@@ -302,6 +584,8 @@ class Coordinator(object):
         '''
         This function sends an update to the broker after a CRUD operation took place.
         Plugins can subcribe to these kind of messages to handle within their plugin.
+        The update is published once under the topic crud.<type>.<plugin guid>, plugins that
+        don't support the notification channel get the update sent on the broker socket.
         @param type: the update type, for example device update have the device update type
         @param action: the CRUD action, for example update, delete, creation
         @param parameters: the parameters specified with the CRUD action, for example a device ID
@@ -310,24 +594,34 @@ class Coordinator(object):
                    "action": action, 
                    "parameters": parameters}
         
+        if self.publisher:
+            self.publisher.publish(self.pub_codec.encode(content), crud_topic(type, parameters.get('plugin')))
+        
+        # Serialise once per message format
+        encoded = {}
+        
         for p in self.plugins:
-            if 'crud' in p.callbacks and p.online:
-                message = [p.routing_info, b'', chr(6), json.dumps(content)]
+            if 'crud' in p.callbacks and p.online and not p.subscriber:
+                if p.codec.format not in encoded:
+                    encoded[p.codec.format] = p.codec.encode(content)
+                message = [p.routing_info, b'', chr(6), encoded[p.codec.format]]
                 self.broker.send(message)
                            
     @inlineCallbacks
     def load_plugins(self):
         '''
         This function loads plugin information from the HouseAgent database.
+        It's also used to reload the plugin list after a plugin has been created, updated or deleted.
         '''
-        # Empty in case of a reload
-        self.plugins = []
-        
         plugins = yield self.db.query_plugins()
+        
+        loaded = []
         for plugin in plugins:
             p = Plugin(plugin[1], plugin[2], time.time(), plugin[4])
-            self.plugins.append(p)
+            loaded.append(p)
             self.log.debug("Loading plugin %s" % (plugin[0]))
+        
+        self.plugins.reload(loaded)
            
     def plugin_id_by_guid(self, guid):
         '''
@@ -336,9 +630,9 @@ class Coordinator(object):
         
         @return: returns a Plugin ID 
         '''
-        for p in self.plugins:
-            if p.guid == guid:
-                return p.id
+        p = self.plugins.by_guid(guid)
+        if p:
+            return p.id
     
     def plugin_guid_by_id(self, id):
         '''
@@ -347,9 +641,9 @@ class Coordinator(object):
         
         @return: returns a Plugin ID 
         '''
-        for p in self.plugins:
-            if p.id == id:
-                return p.guid
+        p = self.plugins.by_id(id)
+        if p:
+            return p.guid
             
     def plugin_by_id(self, id):
         '''
@@ -358,11 +652,7 @@ class Coordinator(object):
         
         @return: None if nothing is found, otherwise Plugin()
         '''
-        for p in self.plugins:
-            if p.id == id:
-                return p
-            
-        return None
+        return self.plugins.by_id(id)
     
     def plugin_by_guid(self, guid):
         '''
@@ -371,11 +661,7 @@ class Coordinator(object):
         
         @return: None if nothing is found, otherwise Plugin()
         '''
-        for p in self.plugins:
-            if p.guid == guid:
-                return p
-            
-        return None
+        return self.plugins.by_guid(guid)
     
     def get_plugins_by_type(self, type):
         '''
@@ -384,13 +670,158 @@ class Coordinator(object):
         
         @return: a list of plugins
         '''
-        output = []
-        for p in self.plugins:
+        return self.plugins.by_type(type)
 
-            if p.type == type:
-                output.append(p)
+class PluginRegistry(object):
+    '''
+    This class keeps track of the plugins known to the coordinator.
+    Next to the list of plugins it maintains hash indexes by guid, id, ZMQ routing information
+    and plugin type, so that looking up the plugin for an inbound broker message doesn't 
+    depend on the number of plugins.
+    
+    Plugin attributes that are indexed (routing_info and type) must be changed through
+    the registry in order to keep the indexes consistent.
+    '''
+    
+    def __init__(self):
+        '''
+        Initialize an empty PluginRegistry.
+        '''
+        self._plugins = []
+        self._by_guid = {}
+        self._by_id = {}
+        self._by_routing_info = {}
+        self._by_type = {}
+        
+    def __iter__(self):
+        return iter(list(self._plugins))
+    
+    def __len__(self):
+        return len(self._plugins)
         
-        return output
+    def add(self, plugin):
+        '''
+        Add a plugin to the registry.
+        @param plugin: the Plugin instance to add
+        '''
+        self._plugins.append(plugin)
+        self._by_guid[plugin.guid] = plugin
+        self._by_id[plugin.id] = plugin
+        
+        if plugin.routing_info is not None:
+            self._by_routing_info[plugin.routing_info] = plugin
+        
+        self._by_type.setdefault(plugin.type, []).append(plugin)
+    
+    def remove(self, plugin):
+        '''
+        Remove a plugin from the registry.
+        @param plugin: the Plugin instance to remove
+        '''
+        self._plugins.remove(plugin)
+        
+        if self._by_guid.get(plugin.guid) is plugin:
+            del self._by_guid[plugin.guid]
+        if self._by_id.get(plugin.id) is plugin:
+            del self._by_id[plugin.id]
+        if plugin.routing_info is not None and self._by_routing_info.get(plugin.routing_info) is plugin:
+            del self._by_routing_info[plugin.routing_info]
+        
+        self._by_type[plugin.type].remove(plugin)
+        if not self._by_type[plugin.type]:
+            del self._by_type[plugin.type]
+    
+    def reload(self, plugins):
+        '''
+        Replace the contents of the registry with a freshly loaded list of plugins.
+        Runtime state (online status, type, routing information and callbacks) of plugins 
+        that are still present is carried over, so connected plugins don't have to go
+        through the ready handshake again.
+        @param plugins: a list of Plugin instances
+        '''
+        old = self._by_guid
+        
+        self._plugins = []
+        self._by_guid = {}
+        self._by_id = {}
+        self._by_routing_info = {}
+        self._by_type = {}
+        
+        for plugin in plugins:
+            previous = old.get(plugin.guid)
+            if previous:
+                plugin.online = previous.online
+                plugin.type = previous.type
+                plugin.routing_info = previous.routing_info
+                plugin.callbacks = previous.callbacks
+                plugin.codec = previous.codec
+                plugin.subscriber = previous.subscriber
+                plugin.heartbeat_interval = previous.heartbeat_interval
+                plugin.time = previous.time
+                
+            self.add(plugin)
+    
+    def set_routing_info(self, plugin, routing_info):
+        '''
+        Update the ZMQ routing information of a plugin, for example when it reconnects.
+        @param plugin: the Plugin instance
+        @param routing_info: the new routing information
+        '''
+        if plugin.routing_info is not None and self._by_routing_info.get(plugin.routing_info) is plugin:
+            del self._by_routing_info[plugin.routing_info]
+        
+        # A routing identity belongs to exactly one connected plugin, the coordinator sets the
+        # previous owner offline before it's replaced
+        other = self._by_routing_info.get(routing_info)
+        if other is not None and other is not plugin:
+            other.routing_info = None
+            other.online = False
+        
+        plugin.routing_info = routing_info
+        if routing_info is not None:
+            self._by_routing_info[routing_info] = plugin
+    
+    def set_type(self, plugin, type):
+        '''
+        Update the type of a plugin.
+        @param plugin: the Plugin instance
+        @param type: the new plugin type
+        '''
+        if plugin.type == type:
+            return
+        
+        self._by_type[plugin.type].remove(plugin)
+        if not self._by_type[plugin.type]:
+            del self._by_type[plugin.type]
+            
+        plugin.type = type
+        self._by_type.setdefault(type, []).append(plugin)
+    
+    def by_guid(self, guid):
+        '''
+        @return: the Plugin with the specified guid, None if nothing is found
+        '''
+        return self._by_guid.get(guid)
+    
+    def by_id(self, id):
+        '''
+        @return: the Plugin with the specified id, None if nothing is found
+        '''
+        return self._by_id.get(id)
+    
+    def by_routing_info(self, routing_info):
+        '''
+        @return: the Plugin with the specified ZMQ routing information, None if nothing is found
+        '''
+        if routing_info is None:
+            return None
+        return self._by_routing_info.get(routing_info)
+    
+    def by_type(self, type):
+        '''
+        @return: a list of plugins of the specified type
+        '''
+        return list(self._by_type.get(type, []))
                 
 class Plugin(object):
     '''
@@ -413,6 +844,9 @@ class Plugin(object):
         self.type = None
         self.routing_info = None
         self.callbacks = []
+        self.codec = MessageCodec()
+        self.subscriber = False
+        self.heartbeat_interval = LEGACY_HEARTBEAT_INTERVAL
         self.location_id = location_id
         
     def __str__(self):
@@ -1,4 +1,3 @@
-from twisted.enterprise.adbapi import ConnectionPool
 from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks, returnValue
 import datetime
@@ -6,12 +5,24 @@ import time
 import os.path, sys
 import shutil
 import sqlite3 # Fix needed for PyInstaller.
-
-class Database():
+from houseagent.core.backup import snapshot
+from houseagent.core.dbwriter import SQLiteWriter
+from houseagent.core.idcache import IdCache
+from houseagent.core.storage import Storage
+from houseagent.core.valueview import ValueView
+from houseagent.core.valuetypes import parse_value
+from houseagent.utils.dbprofile import StorageProfile
+
+class Database(Storage):
     """
-    HouseAgent database interaction.
+    HouseAgent database interaction, the SQLite storage engine.
     """
-    def __init__(self, log, db_location):
+    def __init__(self, log, db_location, profile=None):
+        '''
+        @param log: logging object
+        @param db_location: the location of the database file
+        @param profile: the StorageProfile of the database, by default a single connection is used
+        '''
         self.log = log
 
         type = "sqlite"
@@ -19,14 +30,27 @@ class Database():
         self.coordinator = None
         self.histcollector = None
         self._db_location = db_location
+        self.profile = profile or StorageProfile()
 
-        # Note: cp_max=1 is required otherwise undefined behaviour could occur when using yield icw subsequent
-        # runQuery or runOperation statements
+        # Writes go through dbpool, a single connection on its own thread committing writes in groups.
+        # The query_ methods read through readpool, which is dbpool as well unless the storage profile
+        # provides reader connections.
         if type == "sqlite":
-            self.dbpool = ConnectionPool("sqlite3", db_location, check_same_thread=False, cp_max=1)
+            self.dbpool = SQLiteWriter(db_location, self.profile.open_connection, self.profile.write_group,
+                                       self.profile.write_delay / 1000.0)
+            self.readpool = self.profile.create_read_pool(db_location) or self.dbpool
        
-        # Check database schema version and upgrade when required
-        self.updatedb('0.3')
+        # Device and value ids used by value updates, and the values served by the web interface.
+        # Both are filled once the schema is up to date.
+        self.ids = IdCache()
+        self.view = ValueView(self.dbpool)
+
+        # Check database schema version and upgrade when required. started fires once the
+        # caches have been loaded.
+        self.started = self.updatedb('0.6')
+        self.started.addCallback(lambda _: self.dbpool.runWithoutTransaction(self._enable_incremental_vacuum))
+        self.started.addCallback(lambda _: self.ids.load(self.dbpool))
+        self.started.addCallback(lambda _: self.view.load())
              
     def updatedb(self, dbversion):
         '''
@@ -64,20 +88,29 @@ class Database():
         else:
             self.log.info("Database schema will be updated from %s to %s:" % (version, dbversion))
 
-            # Before we start manipulating the database schema, first make a backup copy of the database
+            # Before we start manipulating the database schema, first make a backup copy of the database.
+            # The copy is a snapshot taken through a connection of its own, this transaction hasn't written yet.
+            backup = self._db_location + datetime.datetime.strftime(datetime.datetime.now(), ".%y%m%d-%H%M%S")
             try:
-                shutil.copy(self._db_location, self._db_location + datetime.datetime.strftime(datetime.datetime.now(), ".%y%m%d-%H%M%S"))
+                snapshot(self._db_location, backup)
             except:
-                self.log.error("Cannot make a backup copy of the database (%s)", sys.exc_info()[1])
-                return
+                # Fall back to a plain copy of the file, the upgrade must not be skipped over the snapshot
+                self.log.warning("Cannot take a snapshot of the database (%s), copying the file instead" % sys.exc_info()[1])
+                try:
+                    shutil.copy(self._db_location, backup)
+                except:
+                    self.log.error("Cannot make a backup copy of the database (%s)" % sys.exc_info()[1])
+                    return
 
+            # Every step upgrades the schema by one version, so older databases are upgraded step by step.
+            # A failing step stops the upgrade.
             if version == '0.0':
                 try:
                     # Create common table
                     txn.execute("CREATE TABLE IF NOT EXISTS common (parm VARCHAR(16) PRIMARY KEY, parm_value VARCHAR(24) NOT NULL)")
             
                     # Add schema version to database
-                    txn.execute("INSERT INTO common (parm, parm_value) VALUES ('schema_version', ?)", [dbversion])
+                    txn.execute("INSERT INTO common (parm, parm_value) VALUES ('schema_version', '0.1')")
 
                     # Set primary key of the devices table on address + plugin_id to prevent adding duplicate devices
                     txn.execute("CREATE TEMPORARY TABLE devices_backup(id INTEGER PRIMARY KEY, name VARCHAR(45), address VARCHAR(45) NOT NULL, plugin_id INTEGER NOT NULL, location_id INTEGER)")
@@ -89,10 +122,12 @@ class Database():
                     txn.execute("DROP TABLE devices_backup")
 
                     self.log.info("Successfully upgraded database schema to schema version 0.1")
+                    version = '0.1'
                 except:
                     self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
+                    return
 
-            elif version == '0.1':
+            if version == '0.1':
                 # update DB schema version to '0.2'
                 try:
                     # update common table
@@ -172,10 +207,12 @@ class Database():
                     txn.execute("UPDATE control_types SET name='Thermostat (Setpoint)' WHERE id=2;")
 
                     self.log.info("Successfully upgraded database schema to schema version 0.2")
+                    version = '0.2'
                 except:
                     self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
+                    return
  
-            elif version == '0.2':
+            if version == '0.2':
                 # update DB schema version to '0.3'
                 try:
                     # update common table
@@ -190,11 +227,116 @@ class Database():
                     txn.execute("INSERT into control_types VALUES(3, 'CONTROL_TYPE_DIMMER');")
                     
                     self.log.info("Successfully upgraded database schema to schema version 0.3")
+                    version = '0.3'
                 except: 
                     self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
+                    return
+
+            if version == '0.3':
+                # update DB schema version to '0.4'
+                try:
+                    txn.execute("UPDATE common SET parm_value='0.4' WHERE parm='schema_version';")
+
+                    # Value updates look values up by device and name, this also serves lookups by device alone
+                    try:
+                        self._create_index(txn, "idx_current_values_device_name", "current_values", ("device_id", "name"), True)
+                    except sqlite3.IntegrityError:
+                        # Duplicate values from before the index existed, keep them rather than guessing which one is right
+                        self.log.warning("Duplicate values found, the index on current_values (device_id, name) is not unique")
+                        self._create_index(txn, "idx_current_values_device_name", "current_values", ("device_id", "name"))
+
+                    # History and archive queries filter on value and time
+                    self._create_index(txn, "idx_history_values_value_created", "history_values", ("value_id", "created_at"))
+                    txn.execute("DROP INDEX IF EXISTS 'history_values.idx_history_values_value_id1';")
+
+                    # Only few values are controllable
+                    self._create_index(txn, "idx_current_values_control_type", "current_values", ("control_type_id",))
+
+                    # Foreign keys used for lookups
+                    self._create_index(txn, "idx_devices_plugin", "devices", ("plugin_id",))
+                    self._create_index(txn, "idx_plugins_authcode", "plugins", ("authcode",))
+                    self._create_index(txn, "idx_triggers_events", "triggers", ("events_id",))
+                    self._create_index(txn, "idx_conditions_events", "conditions", ("events_id",))
+                    self._create_index(txn, "idx_actions_events", "actions", ("events_id",))
+                    self._create_index(txn, "idx_trigger_parameters_triggers", "trigger_parameters", ("triggers_id",))
+                    self._create_index(txn, "idx_condition_parameters_conditions", "condition_parameters", ("conditions_id",))
+                    self._create_index(txn, "idx_action_parameters_actions", "action_parameters", ("actions_id",))
+
+                    # Let the query planner know about the new indexes
+                    txn.execute("ANALYZE;")
+
+                    self.log.info("Successfully upgraded database schema to schema version 0.4")
+                    version = '0.4'
+                except:
+                    self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
+                    return
+
+            if version == '0.4':
+                # update DB schema version to '0.5'
+                try:
+                    txn.execute("UPDATE common SET parm_value='0.5' WHERE parm='schema_version';")
+
+                    # History retention in days of a value, of a history type, or the default when both are NULL
+                    txn.execute("CREATE TABLE history_retention (id INTEGER PRIMARY KEY, value_id INTEGER, history_type_id INTEGER, days INTEGER NOT NULL, " +
+                                "FOREIGN KEY (value_id) REFERENCES current_values(id), FOREIGN KEY (history_type_id) REFERENCES history_types(id));")
+                    txn.execute("INSERT INTO history_retention (value_id, history_type_id, days) VALUES (NULL, NULL, 7);")
+
+                    self.log.info("Successfully upgraded database schema to schema version 0.5")
+                    version = '0.5'
+                except:
+                    self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
+                    return
+
+            if version == '0.5':
+                # update DB schema version to '0.6'
+                try:
+                    txn.execute("UPDATE common SET parm_value='0.6' WHERE parm='schema_version';")
+
+                    # Values are parsed once when they are stored, the number is kept next to the text
+                    txn.execute("ALTER TABLE current_values ADD COLUMN value_numeric REAL;")
+                    txn.execute("ALTER TABLE current_values ADD COLUMN value_type INTEGER NOT NULL DEFAULT 0;")
+                    rows = [parse_value(value) + (id,) for id, value in txn.execute("SELECT id, value FROM current_values").fetchall()]
+                    txn.executemany("UPDATE current_values SET value_numeric=?, value_type=? WHERE id=?", rows)
+                    self._create_index(txn, "idx_current_values_numeric", "current_values", ("value_numeric",))
+
+                    # History values are numbers, text copied from values that aren't would be aggregated with them
+                    txn.execute("UPDATE history_values SET value=NULL WHERE typeof(value)='text';")
+
+                    self.log.info("Successfully upgraded database schema to schema version 0.6")
+                    version = '0.6'
+                except:
+                    self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
+                    return
+
+    def _enable_incremental_vacuum(self, txn):
+        '''
+        Switch the database to incremental vacuum, so the pages freed by the history retention can be
+        returned to the file system bit by bit. This has to be run outside of a transaction.
+        '''
+        if txn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            self.log.info("Enabling incremental vacuum, the database is rebuilt once, this may take a while")
+            txn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            txn.execute("VACUUM")
+
+    def _create_index(self, txn, name, table, columns, unique=False):
+        '''
+        Create an index, unless the table already has an index starting with the same columns.
+        Databases created by different versions of HouseAgent don't all have the same indexes.
+        @param name: the name of the index
+        @param table: the table to index
+        @param columns: a tuple of column names
+        @param unique: whether to create a unique index
+        '''
+        for index in txn.execute("PRAGMA index_list(%s)" % table).fetchall():
+            # index_list rows start with (seq, name, unique)
+            existing = tuple(row[2] for row in txn.execute("PRAGMA index_info('%s')" % index[1]).fetchall())
+            if existing[:len(columns)] == columns and (index[2] or not unique):
+                return
+
+        txn.execute("CREATE %sINDEX %s ON %s (%s)" % ("UNIQUE " if unique else "", name, table, ", ".join(columns)))
 
     def query_plugin_auth(self, authcode):
-        return self.dbpool.runQuery("SELECT authcode, id from plugins WHERE authcode = '%s'" % authcode)
+        return self.readpool.runQuery("SELECT authcode, id from plugins WHERE authcode = '%s'" % authcode)
 
     def check_plugin_auth(self, result):
         if len(result) >= 1:
@@ -207,123 +349,120 @@ class Database():
 
     def add_event(self, name, enabled, triggers):
         """
-        This function adds an event to the database.
+        This function adds an event with its triggers to the database.
+        @return: a Twisted deferred which fires with the id of the new event
         """
-        d = self.dbpool.runQuery("INSERT INTO events (name, enabled) VALUES (?, ?)", (name, enabled) )
-        def event_added(result):
-            print "added event"
-            return self.dbpool.runQuery("select id from events order by id desc limit 1")      
-        
-        d.addCallback(event_added)
-        def got_id(result):
-            event_id = result[0][0]
-            
-            print "got event_id", result[0][0]
-            print "triggers=",triggers
-            
-            # Add triggers
-            deferredlist = []
-            
-            for trigger in triggers:
-                trigger_type_id = trigger["trigger_type"]
-                print "trigger", trigger
-                
-                def got_triggerid(result):
-                    trigger_id = result[0][0]
-                    
-                    print "parameters", trigger["parameters"]
-                    for name, value in trigger["parameters"].iteritems():
-                        print name, value
-                        deferredlist.append(self.dbpool.runQuery("INSERT INTO trigger_parameters (name, value, " +
-                                                                 "triggers_id) VALUES (?, ?, ?)", (name, value, trigger_id)))
-                
-                def trigger_added(result):
-                    self.dbpool.runQuery("select id from triggers order by id desc limit 1").addCallback(got_triggerid)     
-                
-                # Triggers
-                deferredlist.append(self.dbpool.runQuery("INSERT INTO triggers (trigger_types_id, events_id)" +
-                                                         " VALUES (?, ?)", (trigger_type_id, event_id)).addCallback(trigger_added) )        
-                    
-            d = defer.gatherResults(deferredlist)
-            return d
-            
-        d.addCallback(got_id)
-        
-        def added_triggers(result):
-            print "triggers added"
-            
-        d.addCallback(added_triggers)
-        return d
+        return self.dbpool.runInteraction(self._add_event, {'name': name, 'enabled': enabled, 'conditions': [],
+                                                            'actions': [], 'triggers': triggers})
     
     def add_location(self, name, parent):
         if parent:
-            return self.dbpool.runQuery("INSERT INTO locations (name, parent) VALUES (?, ?)", [name, parent])
+            d = self.dbpool.runQuery("INSERT INTO locations (name, parent) VALUES (?, ?)", [name, parent])
         else:
-            return self.dbpool.runQuery("INSERT INTO locations (name) VALUES (?)", [name])
+            d = self.dbpool.runQuery("INSERT INTO locations (name) VALUES (?)", [name])
+            
+        return d.addCallback(self.view.refresh_table, 'locations')
     
-    @inlineCallbacks
     def add_event2(self, name, enabled, conditions, actions, trigger):
         '''
-        This adds an event to the database.
+        This adds an event, with its conditions, actions and trigger, to the database in one transaction.
+        @return: a Twisted deferred which fires with the id of the new event
         '''
-        # Add event, and get event id
-        yield self.dbpool.runQuery("INSERT INTO events (name, enabled) VALUES (?, ?)", [name, enabled])
-        eventid = yield self.dbpool.runQuery("select id from events order by id desc limit 1")
-        eventid = eventid[0][0]
-        
-        # Add conditions
-        for condition in conditions:
-            condition_type_id = condition["condition_type"]
-            
-            yield self.dbpool.runQuery("INSERT INTO conditions (condition_types_id, events_id)" +
-                                       " VALUES (?, ?)", [condition_type_id, eventid])
-            
-            condition_id = yield self.dbpool.runQuery("select id from conditions order by id desc limit 1")
-            condition_id = condition_id[0][0]
-            
-            for name, value in condition["parameters"].iteritems():
-                yield self.dbpool.runQuery("INSERT INTO condition_parameters (name, value, " +
-                                           "conditions_id) VALUES (?, ?, ?)", [name, value, condition_id])
-        
-        # Add actions
-        for action in actions:
-            action_type_id = action["action_type"]
-            
-            yield self.dbpool.runQuery("INSERT INTO actions (action_types_id, events_id)" +
-                                       " VALUES (?, ?)", [action_type_id, eventid])
-            
-            action_id = yield self.dbpool.runQuery("select id from actions order by id desc limit 1")
-            action_id = action_id[0][0]
-            
-            for name, value in action["parameters"].iteritems():
-                yield self.dbpool.runQuery("INSERT INTO action_parameters (name, value, " +
-                                           "actions_id) VALUES (?, ?, ?)", [name, value, action_id])
-                
-            
-        # Insert trigger
-        yield self.dbpool.runQuery("INSERT INTO triggers (trigger_types_id, events_id, conditions)" +
-                                   " VALUES (?,?,?)", [trigger["trigger_type"], eventid, trigger["conditions"]])
- 
-        trigger_id = yield self.dbpool.runQuery("select id from triggers order by id desc limit 1")
-        trigger_id = trigger_id[0][0]
-       
-        for name, value in trigger["parameters"].iteritems():
-            yield self.dbpool.runQuery("INSERT INTO trigger_parameters (name, value, " +
-                                       "triggers_id) VALUES (?, ?, ?)", [name, value, trigger_id])
-               
-    
+        return self.dbpool.runInteraction(self._add_event, {'name': name, 'enabled': enabled, 'conditions': conditions,
+                                                            'actions': actions, 'trigger': trigger})
+
+    def update_event(self, id, name, enabled, conditions, actions, trigger):
+        '''
+        This replaces an event, with its conditions, actions and trigger, in one transaction. The event keeps its id.
+        @return: a Twisted deferred which fires with the id of the event
+        '''
+        return self.dbpool.runInteraction(self._update_event, id, {'name': name, 'enabled': enabled, 'conditions': conditions,
+                                                                   'actions': actions, 'trigger': trigger})
+
+    def import_events(self, events):
+        '''
+        This adds a list of events to the database in one transaction, either all of them or none.
+        @param events: list of dictionaries with name, enabled, conditions, actions and trigger, like the event editor posts
+        @return: a Twisted deferred which fires with the ids of the new events
+        '''
+        return self.dbpool.runInteraction(self._import_events, events)
+
+    def _import_events(self, txn, events):
+        return [self._add_event(txn, event) for event in events]
+
+    def _add_event(self, txn, event):
+        '''
+        Insert an event, this method has to be run within a runInteraction call.
+        @param event: dictionary with name, enabled, conditions, actions and trigger (or a list of triggers)
+        @return: the id of the new event
+        '''
+        txn.execute("INSERT INTO events (name, enabled) VALUES (?, ?)", [event["name"], event["enabled"]])
+        event_id = txn.lastrowid
+
+        self._insert_event_parts(txn, event_id, event)
+        return event_id
+
+    def _update_event(self, txn, id, event):
+        txn.execute("UPDATE events SET name=?, enabled=? WHERE id=?", [event["name"], event["enabled"], id])
+        if not txn.rowcount:
+            raise KeyError("Event %s doesn't exist" % id)
+
+        self._delete_event_parts(txn, id)
+        self._insert_event_parts(txn, id, event)
+        return id
+
+    def _insert_event_parts(self, txn, event_id, event):
+        '''
+        Insert the conditions, actions and triggers of an event, the parameters of each kind with a single executemany.
+        '''
+        triggers = event.get("triggers") or [event["trigger"]]
+
+        parameters = []
+        for condition in event["conditions"]:
+            txn.execute("INSERT INTO conditions (condition_types_id, events_id) VALUES (?, ?)", [condition["condition_type"], event_id])
+            condition_id = txn.lastrowid
+            parameters.extend((name, value, condition_id) for name, value in condition["parameters"].iteritems())
+        txn.executemany("INSERT INTO condition_parameters (name, value, conditions_id) VALUES (?, ?, ?)", parameters)
+
+        parameters = []
+        for action in event["actions"]:
+            txn.execute("INSERT INTO actions (action_types_id, events_id) VALUES (?, ?)", [action["action_type"], event_id])
+            action_id = txn.lastrowid
+            parameters.extend((name, value, action_id) for name, value in action["parameters"].iteritems())
+        txn.executemany("INSERT INTO action_parameters (name, value, actions_id) VALUES (?, ?, ?)", parameters)
+
+        parameters = []
+        for trigger in triggers:
+            txn.execute("INSERT INTO triggers (trigger_types_id, events_id, conditions) VALUES (?, ?, ?)",
+                        [trigger["trigger_type"], event_id, trigger.get("conditions")])
+            trigger_id = txn.lastrowid
+            parameters.extend((name, value, trigger_id) for name, value in trigger["parameters"].iteritems())
+        txn.executemany("INSERT INTO trigger_parameters (name, value, triggers_id) VALUES (?, ?, ?)", parameters)
+
+    def _delete_event_parts(self, txn, event_id):
+        txn.execute("DELETE FROM trigger_parameters WHERE triggers_id IN (SELECT id FROM triggers WHERE events_id=?)", [event_id])
+        txn.execute("DELETE FROM condition_parameters WHERE conditions_id IN (SELECT id FROM conditions WHERE events_id=?)", [event_id])
+        txn.execute("DELETE FROM action_parameters WHERE actions_id IN (SELECT id FROM actions WHERE events_id=?)", [event_id])
+
+        txn.execute("DELETE FROM triggers WHERE events_id=?", [event_id])
+        txn.execute("DELETE FROM actions WHERE events_id=?", [event_id])
+        txn.execute("DELETE FROM conditions WHERE events_id=?", [event_id])
+
     def add_trigger(self, trigger_type_id, event_id, value_id, parameters):
-        print "INSERT INTO triggers (trigger_types_id, events_id, current_values_id) VALUES (%d, %d, %d)" % (int(trigger_type_id),
-                                                                                                                                  int(event_id),
-                                                                                                                                  int(value_id))
-        d = self.dbpool.runQuery("INSERT INTO triggers (trigger_types_id, events_id" + 
-                                 ", current_values_id) VALUES (%s, %s, %s)", (int(trigger_type_id),
-                                                                              int(event_id),
-                                                                              int(value_id)) ) 
-        for name, value in parameters.iteritems():
-            self.dbpool.runQuery("INSERT INTO trigger_parameters (name, value, triggers_id) VALUES (%s, %s, last_insert_id())", (name, value) )
-    
-        return d
+        '''
+        This adds a trigger on a value to an existing event.
+        @return: a Twisted deferred which fires with the id of the new trigger
+        '''
+        def add(txn):
+            txn.execute("INSERT INTO triggers (trigger_types_id, events_id) VALUES (?, ?)", [int(trigger_type_id), int(event_id)])
+            trigger_id = txn.lastrowid
+
+            rows = [(name, value, trigger_id) for name, value in parameters.iteritems()]
+            rows.append(("current_value_id", int(value_id), trigger_id))
+            txn.executemany("INSERT INTO trigger_parameters (name, value, triggers_id) VALUES (?, ?, ?)", rows)
+            return trigger_id
+
+        return self.dbpool.runInteraction(add)
     
     #def add_action(self, action_type_id, event_id):
     
@@ -331,46 +470,46 @@ class Database():
         '''
         This function queries the latest device id.
         '''
-        return self.dbpool.runQuery('select id from devices LIMIT 1')
+        return self.readpool.runQuery('select id from devices LIMIT 1')
          
     def query_triggers(self):
-        return self.dbpool.runQuery("SELECT triggers.id, trigger_types.name, triggers.events_id, triggers.conditions " + 
+        return self.readpool.runQuery("SELECT triggers.id, trigger_types.name, triggers.events_id, triggers.conditions " + 
                                     "FROM triggers INNER JOIN trigger_types ON (triggers.trigger_types_id = trigger_types.id)")
 
     def query_trigger(self, event_id):
-        return self.dbpool.runQuery("SELECT triggers.id, trigger_types.name, triggers.events_id, triggers.conditions " + 
+        return self.readpool.runQuery("SELECT triggers.id, trigger_types.name, triggers.events_id, triggers.conditions " + 
                                     "FROM triggers INNER JOIN trigger_types ON (triggers.trigger_types_id = trigger_types.id) " +
                                     "WHERE triggers.events_id = ? LIMIT 1", [event_id])
         
     def query_conditions(self):
-        return self.dbpool.runQuery("SELECT conditions.id, condition_types.name, conditions.events_id " + 
+        return self.readpool.runQuery("SELECT conditions.id, condition_types.name, conditions.events_id " + 
                                     "FROM conditions INNER JOIN condition_types ON (conditions.condition_types_id = condition_types.id)")
 
     def query_actions(self):
-        return self.dbpool.runQuery("SELECT actions.id, action_types.name, actions.events_id " + 
+        return self.readpool.runQuery("SELECT actions.id, action_types.name, actions.events_id " + 
                                     "FROM actions INNER JOIN action_types ON (actions.action_types_id = action_types.id)")
 
     def query_trigger_parameters(self, trigger_id):
-        return self.dbpool.runQuery("SELECT name, value from trigger_parameters WHERE triggers_id = ?", [trigger_id])
+        return self.readpool.runQuery("SELECT name, value from trigger_parameters WHERE triggers_id = ?", [trigger_id])
     
     def query_condition_parameters(self, condition_id):
-        return self.dbpool.runQuery("SELECT name, value from condition_parameters WHERE conditions_id = ?", [condition_id])        
+        return self.readpool.runQuery("SELECT name, value from condition_parameters WHERE conditions_id = ?", [condition_id])        
 
     def query_action_parameters(self, action_id):
-        return self.dbpool.runQuery("SELECT name, value from action_parameters WHERE actions_id = ?", [action_id])
+        return self.readpool.runQuery("SELECT name, value from action_parameters WHERE actions_id = ?", [action_id])
     
     def query_device_routing_by_id(self, device_id):
-        return self.dbpool.runQuery("SELECT devices.address, plugins.authcode FROM devices " +  
+        return self.readpool.runQuery("SELECT devices.address, plugins.authcode FROM devices " +  
                                     "INNER JOIN plugins ON (devices.plugin_id = plugins.id) "
                                     "WHERE devices.id = ?", [device_id])
 
     def query_value_properties(self, value_id):
-        return self.dbpool.runQuery("SELECT current_values.name, devices.address, devices.plugin_id, current_values.label from current_values " + 
+        return self.readpool.runQuery("SELECT current_values.name, devices.address, devices.plugin_id, current_values.label from current_values " + 
                                     "INNER JOIN devices ON (current_values.device_id = devices.id) " + 
                                     "WHERE current_values.id = ?", [value_id])
 
     def query_plugin_devices(self, plugin_id):
-        return self.dbpool.runQuery("SELECT devices.id, devices.name, devices.address, locations.name from devices " +
+        return self.readpool.runQuery("SELECT devices.id, devices.name, devices.address, locations.name from devices " +
                                     "LEFT OUTER JOIN locations ON (devices.location_id = locations.id) " +
                                     "WHERE plugin_id=? ", [plugin_id])
 
@@ -381,7 +520,8 @@ class Database():
         @param label: the predfined label of the value.
         @param device_id: the id of the device.
         '''
-        return self.dbpool.runQuery("INSERT into current_values (name, label, device_id) VALUES (?, ?, ?)", (value_id, label, device_id))
+        return self.dbpool.runQuery("INSERT into current_values (name, label, device_id) VALUES (?, ?, ?)", (value_id, label, device_id)) \
+                          .addCallback(self.view.refresh_value, name=value_id, device_id=device_id)
       
     def del_value_by_name_and_device_id(self, name, device_id):
         '''
@@ -389,14 +529,17 @@ class Database():
         @param name: the name of the value
         @param device_id: the device_id
         '''
-        return self.dbpool.runQuery("DELETE from current_values WHERE name=? and device_id=?", (name, device_id))  
+        self.ids.value_deleted(name=name, device_id=device_id)
+        return self.dbpool.runQuery("DELETE from current_values WHERE name=? and device_id=?", (name, device_id)) \
+                          .addCallback(self.view.value_deleted, name=name, device_id=device_id)
 
     def del_value(self, id):
         '''
         This function deletes a value by id.
         @param id: the value id
         '''
-        return self.dbpool.runQuery("DELETE from current_values WHERE id=?", [id])  
+        self.ids.value_deleted(id=id)
+        return self.dbpool.runQuery("DELETE from current_values WHERE id=?", [id]).addCallback(self.view.value_deleted, id)
 
     @inlineCallbacks
     def update_or_add_value(self, name, value, pluginid, address, time=None):
@@ -408,57 +551,114 @@ class Database():
         @param address: the address of the device being handled
         @param time: the time at which the update has been received, this defaults to now()
         '''
-        if not time:
-            updatetime = datetime.datetime.now().isoformat(' ').split('.')[0]
-        else:
-            updatetime = datetime.datetime.fromtimestamp(time).isoformat(' ').split('.')[0]
-        
-        # Query device first
-        device_id = yield self.dbpool.runQuery('select id from devices WHERE plugin_id = ? and address = ? LIMIT 1', (pluginid, address) )
+        value_ids = yield self.update_or_add_values([(name, value, pluginid, address, time)])
+        returnValue(value_ids[0])
 
-        try:
-            device_id = device_id[0][0]
-        except:
-            returnValue('') # device does not exist
+    def update_or_add_values(self, updates):
+        '''
+        This function updates or adds a batch of values to the HouseAgent database in a single transaction.
+        @param updates: a list of (name, value, pluginid, address, time) tuples, in arrival order
         
-        current_value = yield self.dbpool.runQuery("SELECT id, name, history_type_id, history_period_id FROM current_values WHERE name=? AND device_id=? LIMIT 1", (name, device_id))
-    
-        try:
-            value_id = current_value[0][0]
-        except:
-            value_id = None
+        @return: a Twisted deferred which fires with a list of value ids, one for each update. 
+                 The value id is an empty string when the device does not exist.
+        '''
+        # The ids are resolved in the reactor thread, only ids missing from the cache are
+        # looked up by the interaction
+        devices, values = self.ids.snapshot(updates)
+        d = self.dbpool.runInteraction(self._update_or_add_values, updates, devices, values)
+        d.addCallback(self.ids.merge, devices, values, self.ids.generation)
+        d.addCallback(self.view.values_written, updates)
+        return d
     
-        if value_id:
-            value_id = current_value[0][0]
+    def _update_or_add_values(self, txn, updates, devices=None, values=None):
+        '''
+        Write a batch of value updates, this method has to be run within a runInteraction call.
+        Device and value ids missing from the devices and values dictionaries are looked up and
+        added to them, new values are inserted and all updates of existing values are written
+        with a single executemany.
+        @param devices: dictionary mapping (plugin_id, address) to the device id
+        @param values: dictionary mapping (device_id, name) to (value_id, history_type_id, history_period_id)
+        '''
+        if devices is None:
+            devices = {}
+        if values is None:
+            values = {}
+            
+        value_ids = []
+        rows = []
+        
+        for name, value, pluginid, address, time in updates:
+            if not time:
+                updatetime = datetime.datetime.now().isoformat(' ').split('.')[0]
+            else:
+                updatetime = datetime.datetime.fromtimestamp(time).isoformat(' ').split('.')[0]
             
-            history_type = current_value[0][2]
-            history_period = current_value[0][3]
+            device_key = IdCache.device_key(pluginid, address)
+            if device_key not in devices:
+                device = txn.execute('SELECT id FROM devices WHERE plugin_id = ? AND address = ? LIMIT 1', (pluginid, address)).fetchall()
+                devices[device_key] = device[0][0] if device else None
             
-            yield self.dbpool.runQuery("UPDATE current_values SET value=?, lastupdate=? WHERE id=?", (value, updatetime, value_id))
-        else:
-            yield self.dbpool.runQuery("INSERT INTO current_values (name, value, device_id, lastupdate) VALUES (?, ?, (SELECT id FROM devices WHERE address=? AND plugin_id=?),  ?)", (name, value, address, pluginid, updatetime))
-            current_value = yield self.dbpool.runQuery("SELECT id FROM current_values WHERE name=? AND device_id=?", (name, device_id))
-            value_id = current_value[0][0]
-                        
-        returnValue(value_id)
+            device_id = devices[device_key]
+            if device_id is None:
+                value_ids.append('') # device does not exist
+                continue
+            
+            value_key = (device_id, name)
+            if value_key not in values:
+                current_value = txn.execute("SELECT id, history_type_id, history_period_id FROM current_values WHERE name=? AND device_id=? LIMIT 1", (name, device_id)).fetchall()
+                
+                if current_value:
+                    values[value_key] = tuple(current_value[0])
+                else:
+                    number, value_type = parse_value(value)
+                    txn.execute("INSERT INTO current_values (name, value, value_numeric, value_type, device_id, lastupdate) VALUES (?, ?, ?, ?, ?, ?)",
+                                (name, value, number, value_type, device_id, updatetime))
+                    value_id = txn.lastrowid
+                    # Cache the history settings the row got from the column defaults
+                    values[value_key] = (value_id,) + tuple(txn.execute("SELECT history_type_id, history_period_id FROM current_values WHERE id=?",
+                                                                        (value_id,)).fetchone())
+                    value_ids.append(value_id)
+                    continue
+            
+            value_id = values[value_key][0]
+            value_ids.append(value_id)
+            number, value_type = parse_value(value)
+            rows.append((value, number, value_type, updatetime, value_id))
+        
+        if rows:
+            txn.executemany("UPDATE current_values SET value=?, value_numeric=?, value_type=?, lastupdate=? WHERE id=?", rows)
+        
+        return value_ids
+
+    def cb_plugin_crud(self, result):
+        '''
+        Callback function that get's called when a plugin has been created, updated or deleted in, to or from the database.
+        The coordinator reloads it's plugin registry so plugin lookups stay consistent with the database.
+        @param result: the result of the action
+        '''
+        if self.coordinator:
+            self.coordinator.load_plugins()
+            
+        self.view.refresh_table(None, 'plugins')
+        return result
 
     def register_plugin(self, name, uuid, location):
-        return self.dbpool.runQuery("INSERT INTO plugins (name, authcode, location_id) VALUES (?, ?, ?)", [str(name), str(uuid), location])
+        return self.dbpool.runQuery("INSERT INTO plugins (name, authcode, location_id) VALUES (?, ?, ?)", [str(name), str(uuid), location]).addCallback(self.cb_plugin_crud)
 
     def query_plugins(self):
-        return self.dbpool.runQuery("SELECT plugins.name, plugins.authcode, plugins.id, locations.name, plugins.location_id from plugins " +
+        return self.readpool.runQuery("SELECT plugins.name, plugins.authcode, plugins.id, locations.name, plugins.location_id from plugins " +
                                     "LEFT OUTER JOIN locations ON (plugins.location_id = locations.id)")
     
     def query_plugin_by_type_name(self, type_name):
-        return self.dbpool.runQuery("SELECT plugins.id, plugins.authcode from plugins " +
+        return self.readpool.runQuery("SELECT plugins.id, plugins.authcode from plugins " +
                                     "INNER JOIN plugin_types ON (plugins.plugin_type_id = plugin_types.id)" +
                                     "WHERE plugin_types.name = ? LIMIT 1", [type_name])
 
     def query_device_classes(self):
-        return self.dbpool.runQuery("SELECT * from device_class order by name ASC")
+        return self.readpool.runQuery("SELECT * from device_class order by name ASC")
     
     def query_device_types(self):
-        return self.dbpool.runQuery("SELECT * from device_types order by name ASC")
+        return self.readpool.runQuery("SELECT * from device_types order by name ASC")
        
     @inlineCallbacks
     def cb_device_crud(self, result, action, id=None, plugin=None, address=None, name=None, location=None):
@@ -483,6 +683,8 @@ class Database():
             name = parms[0][2]
             location = parms[0][3]
             
+        self.view.refresh_table(None, 'devices')
+        
         parameters = {"plugin": plugin, 
                       "address": address,
                       "name": name,
@@ -501,6 +703,8 @@ class Database():
         @param id: the id of the device (in case this is an update)
         '''
         
+        self.ids.device_saved(plugin_id, address, id)
+        
         if not id:
             return self.dbpool.runQuery("INSERT INTO devices (name, address, plugin_id, location_id) VALUES (?, ?, ?, ?)", \
                                         (name, address, plugin_id, location_id)).addCallback(self.cb_device_crud, "create")
@@ -509,10 +713,12 @@ class Database():
                                         (name, address, plugin_id, location_id, id)).addCallback(self.cb_device_crud, "update", id)
 
     def save_value(self, label, history_type, history_period, control_type, id):
+        self.ids.history_changed(id, history_type, history_period)
         return self.dbpool.runQuery("UPDATE current_values SET label=?, history_type_id=?, history_period_id=?, control_type_id=? WHERE id=?", \
-                                    (label, history_type, history_period, control_type, id))     
+                                    (label, history_type, history_period, control_type, id)).addCallback(self.view.refresh_value, id)
 
     def del_device(self, id):
+        self.ids.device_deleted(id)
         
         def delete(result, id):
             self.dbpool.runQuery("DELETE FROM devices WHERE id=?", [id]).addCallback(self.cb_device_crud, "delete", id, result[0][0], result[0][1], result[0][2], result[0][3])
@@ -522,35 +728,28 @@ class Database():
                                     "WHERE devices.id=?", [id]).addCallback(delete, id)
 
     def del_location(self, id):
-        return self.dbpool.runQuery("DELETE FROM locations WHERE id=?", [id])
+        return self.dbpool.runQuery("DELETE FROM locations WHERE id=?", [id]).addCallback(self.view.refresh_table, 'locations')
 
-    @inlineCallbacks
     def del_event(self, id):
-        # Delete all parameters for this event id
-        yield self.dbpool.runQuery("DELETE FROM trigger_parameters where triggers_id=" +
-                                   " (select id from triggers where events_id=?)", [id])
-        
-        yield self.dbpool.runQuery("DELETE FROM condition_parameters where conditions_id=" +
-                                   " (select id from conditions where events_id=?)" , [id])
-    
-        yield self.dbpool.runQuery("DELETE FROM action_parameters where actions_id=" +
-                                   " (select id from actions where events_id=?)", [id])
-        
-        yield self.dbpool.runQuery("DELETE FROM triggers where events_id=?", [id])
-        yield self.dbpool.runQuery("DELETE FROM actions where events_id=?", [id])
-        yield self.dbpool.runQuery("DELETE FROM conditions where events_id=?", [id])
-        
-        yield self.dbpool.runQuery("DELETE FROM events where id=?", [id])
+        '''
+        This deletes an event, with its triggers, conditions, actions and their parameters, in one transaction.
+        '''
+        return self.dbpool.runInteraction(self._del_event, id)
+
+    def _del_event(self, txn, id):
+        self._delete_event_parts(txn, id)
+        txn.execute("DELETE FROM events WHERE id=?", [id])
 
     def del_plugin(self, id):
-        return self.dbpool.runQuery("DELETE FROM plugins WHERE id=?", [id])
+        self.ids.plugin_deleted(id)
+        return self.dbpool.runQuery("DELETE FROM plugins WHERE id=?", [id]).addCallback(self.cb_plugin_crud)
 
     def query_locations(self):
-        return self.dbpool.runQuery("select locations.id, locations.name, l2.name from locations " +  
+        return self.readpool.runQuery("select locations.id, locations.name, l2.name from locations " +  
                                     "left join locations as l2 on locations.parent=l2.id")
 
     def query_values(self):
-        return self.dbpool.runQuery("SELECT current_values.name, current_values.value, devices.name, " + 
+        return self.readpool.runQuery("SELECT current_values.name, current_values.value, devices.name, " + 
                                "current_values.lastupdate, plugins.name, devices.address, locations.name, current_values.id" + 
                                ", control_types.name, control_types.id, history_types.name, history_periods.name, plugins.id, current_values.label FROM current_values INNER " +
                                "JOIN devices ON (current_values.device_id = devices.id) INNER JOIN plugins ON (devices.plugin_id = plugins.id) " + 
@@ -560,101 +759,157 @@ class Database():
                                "LEFT OUTER JOIN history_periods ON (current_values.history_period_id = history_periods.id)")
 
     def query_values_light(self):
-        return self.dbpool.runQuery("SELECT id, IFNULL(label, name), history_period_id, history_type_id FROM current_values;")
+        return self.readpool.runQuery("SELECT id, IFNULL(label, name), history_period_id, history_type_id FROM current_values;")
 
     def query_devices(self):      
-        return self.dbpool.runQuery("SELECT devices.id, devices.name, devices.address, plugins.name, locations.name from devices " +
+        return self.readpool.runQuery("SELECT devices.id, devices.name, devices.address, plugins.name, locations.name from devices " +
                                     "INNER JOIN plugins ON (devices.plugin_id = plugins.id) " +
                                     "LEFT OUTER JOIN locations ON (devices.location_id = locations.id)")
 
     def query_location(self, id):
-        return self.dbpool.runQuery("SELECT id, name, parent FROM locations WHERE id=?", [id])
+        return self.readpool.runQuery("SELECT id, name, parent FROM locations WHERE id=?", [id])
     
     def query_plugin(self, id):
-        return self.dbpool.runQuery("SELECT id, name, location_id FROM plugins WHERE id=?", [id])
+        return self.readpool.runQuery("SELECT id, name, location_id FROM plugins WHERE id=?", [id])
     
     def query_device(self, id):
-        return self.dbpool.runQuery("SELECT id, name, address, plugin_id, location_id FROM devices WHERE id=?", [id])
+        return self.readpool.runQuery("SELECT id, name, address, plugin_id, location_id FROM devices WHERE id=?", [id])
 
     def query_triggertypes(self):
-        return self.dbpool.runQuery("SELECT id, name from trigger_types")
+        return self.readpool.runQuery("SELECT id, name from trigger_types")
 
     def query_actiontypes(self):
-        return self.dbpool.runQuery("SELECT id, name from action_types")
+        return self.readpool.runQuery("SELECT id, name from action_types")
     
     def query_conditiontypes(self):
-        return self.dbpool.runQuery("SELECT id, name from condition_types")
+        return self.readpool.runQuery("SELECT id, name from condition_types")
     
     def query_controltypes(self):
-        return self.dbpool.runQuery("SELECT id, name from control_types")
+        return self.readpool.runQuery("SELECT id, name from control_types")
     
     def query_controltypename(self, current_value_id):
-        return self.dbpool.runQuery("select control_types.name from current_values " +
+        return self.readpool.runQuery("select control_types.name from current_values " +
                                     "INNER JOIN controL_types ON (control_types.id = current_values.control_type_id) " +
                                     "where current_values.id=?", [current_value_id])
     
     def query_devices_simple(self):
-        return self.dbpool.runQuery("SELECT id, name from devices")
+        return self.readpool.runQuery("SELECT id, name from devices")
     
     def query_plugintypes(self):
-        return self.dbpool.runQuery("SELECT id, name from plugin_types")
+        return self.readpool.runQuery("SELECT id, name from plugin_types")
 
     # history collector stuff
     def query_history_types(self):
-        return self.dbpool.runQuery("SELECT id, name FROM history_types;")
+        return self.readpool.runQuery("SELECT id, name FROM history_types;")
 
     def query_history_schedules(self):
-        return self.dbpool.runQuery("SELECT id, name, history_period_id, history_type_id FROM current_values;")
+        return self.readpool.runQuery("SELECT id, name, history_period_id, history_type_id FROM current_values;")
 
     def query_history_periods(self):
-        return self.dbpool.runQuery("SELECT id, name, secs, sysflag FROM history_periods;")
+        return self.readpool.runQuery("SELECT id, name, secs, sysflag FROM history_periods;")
 
     def query_history_values(self, date_from, date_to):
-        return self.dbpool.runQuery("SELECT value, created_at FROM history_values WHERE created_at >= '%s' AND created_at < '%s';" % (date_from, date_to))
+        return self.readpool.runQuery("SELECT value, created_at FROM history_values WHERE created_at >= '%s' AND created_at < '%s';" % (date_from, date_to))
 
-    def cleanup_history_values(self):
-        """keep 7 days history of history_values table"""
-        return self.dbpool.runQuery("DELETE FROM history_values WHERE created_at < DATETIME(DATETIME(), 'localtime', '-7 day');")
+    def delete_history_values(self, before, limit, value_id=None):
+        '''
+        Delete a batch of history values.
+        @param before: history values created before this time are deleted
+        @param limit: the maximum number of history values deleted
+        @param value_id: the value of which the history is deleted, None deletes the history of the values the default
+                         retention applies to: values without a policy of their own or of their history type, and
+                         values that don't exist anymore
+
+        @return: a Twisted deferred which fires with the number of deleted history values
+        '''
+        if value_id is None:
+            sql = ("DELETE FROM history_values WHERE rowid IN (SELECT h.rowid FROM history_values h " +
+                   "LEFT JOIN current_values c ON c.id = h.value_id WHERE h.created_at < ? AND (c.id IS NULL OR " +
+                   "(c.id NOT IN (SELECT value_id FROM history_retention WHERE value_id IS NOT NULL) AND " +
+                   "(c.history_type_id IS NULL OR c.history_type_id NOT IN (SELECT history_type_id FROM history_retention " +
+                   "WHERE value_id IS NULL AND history_type_id IS NOT NULL)))) LIMIT ?)")
+            params = [before, limit]
+        else:
+            sql = "DELETE FROM history_values WHERE rowid IN (SELECT rowid FROM history_values WHERE value_id=? AND created_at < ? LIMIT ?)"
+            params = [value_id, before, limit]
+
+        return self.dbpool.runInteraction(lambda txn: txn.execute(sql, params).rowcount)
+
+    def incremental_vacuum(self, pages):
+        '''
+        Return free pages of the database file to the file system.
+        @param pages: the maximum number of pages returned, at least 1
+
+        @return: a Twisted deferred which fires with the number of pages returned
+        '''
+        def vacuum(txn):
+            free = txn.execute("PRAGMA freelist_count").fetchone()[0]
+            # incremental_vacuum(0) would return all free pages at once
+            txn.execute("PRAGMA incremental_vacuum(%d)" % max(1, pages)).fetchall()
+            return free - txn.execute("PRAGMA freelist_count").fetchone()[0]
+
+        return self.dbpool.runInteraction(vacuum)
+
+    def query_retention_policies(self):
+        return self.readpool.runQuery("SELECT id, value_id, history_type_id, days FROM history_retention")
+
+    def save_retention_policy(self, days, value_id=None, history_type_id=None):
+        '''
+        Set the history retention of a value, of a history type, or the default retention when neither is given.
+        @param days: the number of days history values are kept
+        '''
+        def save(txn):
+            txn.execute("DELETE FROM history_retention WHERE value_id IS ? AND history_type_id IS ?", [value_id, history_type_id])
+            txn.execute("INSERT INTO history_retention (value_id, history_type_id, days) VALUES (?, ?, ?)", [value_id, history_type_id, days])
+            return txn.lastrowid
+
+        return self.dbpool.runInteraction(save)
+
+    def del_retention_policy(self, id):
+        return self.dbpool.runQuery("DELETE FROM history_retention WHERE id=?", [id])
 
     def collect_history_values(self, value_id):
-        return self.dbpool.runQuery("INSERT INTO history_values SELECT id, value, DATETIME(DATETIME(), 'localtime') FROM current_values WHERE id=?;", [value_id])
+        return self.dbpool.runQuery("INSERT INTO history_values SELECT id, value_numeric, DATETIME(DATETIME(), 'localtime') FROM current_values WHERE id=?;", [value_id])
 
     # /history collector stuff
 
     def query_controllable_values(self):
-        return self.dbpool.runQuery("SELECT current_values.id, devices.name, current_values.label, current_values.value, control_types.name FROM current_values" +
+        return self.readpool.runQuery("SELECT current_values.id, devices.name, current_values.label, current_values.value, control_types.name FROM current_values" +
                                     " INNER JOIN devices ON (current_values.device_id = devices.id) INNER JOIN control_types ON (current_values.control_type_id = control_types.id)" +
-                                    " WHERE current_values.control_type_id != 0")
+                                    " WHERE current_values.control_type_id > 0")
     
     def query_action_types_by_device_id(self, device_id):
-        return self.dbpool.runQuery("SELECT current_values.id, current_values.name, control_types.name FROM current_values " +
+        return self.readpool.runQuery("SELECT current_values.id, current_values.name, control_types.name FROM current_values " +
                                     "INNER JOIN control_types ON (current_values.control_type_id = control_types.id) " +
                                     "WHERE current_values.device_id = ?", [device_id])
 
     def query_action_type_by_value_id(self, value_id):
-        return self.dbpool.runQuery("SELECT control_types.name FROM current_values " +
+        return self.readpool.runQuery("SELECT control_types.name FROM current_values " +
                                     "INNER JOIN control_types ON (current_values.control_type_id = control_types.id) " +
                                     "WHERE current_values.id = ? LIMIT 1", [value_id])
         
     def query_values_by_device_id(self, device_id):
-        return self.dbpool.runQuery("SELECT id, name from current_values WHERE device_id = '%s'" % device_id)
+        return self.readpool.runQuery("SELECT id, name from current_values WHERE device_id = '%s'" % device_id)
 
     def query_device_type_by_device_id(self, device_id):
-        return self.dbpool.runQuery("SELECT device_types.name FROM devices " +  
+        return self.readpool.runQuery("SELECT device_types.name FROM devices " +  
                                     "INNER JOIN device_types ON (device_types.id = devices.device_type_id) " + 
                                     "WHERE devices.id = ? LIMIT 1", [device_id])
 
     def query_value_by_valueid(self, value_id):
-        return self.dbpool.runQuery("SELECT value,name from current_values WHERE id = ? LIMIT 1", [value_id])
+        return self.readpool.runQuery("SELECT value, name, value_numeric from current_values WHERE id = ? LIMIT 1", [value_id])
     
     def query_extra_valueinfo(self, value_id):
-        return self.dbpool.runQuery("select devices.name, current_values.name from current_values " +
+        return self.readpool.runQuery("select devices.name, current_values.name from current_values " +
                                     "inner join devices on (current_values.device_id = devices.id) " + 
                                     "where current_values.id = ?", [value_id])
 
     def set_history(self, id, history_period, history_type):
+        self.ids.history_changed(id, history_type, history_period)
+        
         # histcollector needs a fresh data -> defer the UPDATE
         d = self.dbpool.runQuery("UPDATE current_values SET history_period_id=?, history_type_id=? WHERE id=?", [history_period, history_type, id])
+        d.addCallback(self.view.refresh_value, id)
 
         # helper fn
         def histcollector_refresh(result, id, history_period):
@@ -665,13 +920,13 @@ class Database():
         return d
     
     def set_controltype(self, id, control_type):
-        return self.dbpool.runQuery("UPDATE current_values SET control_type_id=? WHERE id=?", [control_type, id])
+        return self.dbpool.runQuery("UPDATE current_values SET control_type_id=? WHERE id=?", [control_type, id]).addCallback(self.view.refresh_value, id)
 
     def update_location(self, id, name, parent):
-        return self.dbpool.runQuery("UPDATE locations SET name=?, parent=? WHERE id=?", [name, parent, id])
+        return self.dbpool.runQuery("UPDATE locations SET name=?, parent=? WHERE id=?", [name, parent, id]).addCallback(self.view.refresh_table, 'locations')
     
     def update_plugin(self, id, name, location):
-        return self.dbpool.runQuery("UPDATE plugins SET name=?, location_id=? WHERE id=?", [name, location, id])
+        return self.dbpool.runQuery("UPDATE plugins SET name=?, location_id=? WHERE id=?", [name, location, id]).addCallback(self.cb_plugin_crud)
     
     def query_events(self):
-        return self.dbpool.runQuery("SELECT id, name, enabled from events")
+        return self.readpool.runQuery("SELECT id, name, enabled from events")
@@ -7,6 +7,8 @@ Created on Oct 5, 2011
 
 from database import Database
 #from database import Database, DataHistory
+from segmentlog import read_segment
+from valuetypes import parse_value
 from twisted.internet import reactor, defer
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
@@ -18,26 +20,110 @@ import sys
 class DatabaseFlash(Database):
     '''
     HouseAgent database optimized for flash drives.
-    This database subclass caches the value updates in a list by means of a CurrentValueTable
-    object. Then, "in-memory" values are saved back to the current_values table whenever a
-    query is launched from the web or periodically 
+    This database subclass caches the value updates in memory by means of a CurrentValueTable
+    object. Then, changed "in-memory" values are saved back to the current_values table whenever
+    a query is launched from the web, periodically and on shutdown.
+
+    With a SegmentLog, value updates and history samples are appended to the log instead, and
+    the database is left alone until the log is compacted: periodically and on shutdown its
+    segments are folded into the database, one transaction per segment. At startup the latest
+    values are rebuilt from the segments a crash left behind. Queries take the values from the
+    cache, as the database only gets them when the log is compacted.
     '''              
-    def __init__(self, log, db_location, interval):
+    def __init__(self, log, db_location, interval, profile=None, segments=None):
         '''
         Class constructor
         
         @param log: logging object
-        @param interval: elapsed seconds between periodic data saves (cache to database)
+        @param interval: elapsed seconds between periodic data saves (cache or segment log to database)
+        @param profile: the StorageProfile of the database
+        @param segments: the SegmentLog value updates are appended to, None caches them in memory only
         '''
-        Database.__init__(self, log, db_location)
-        # Create list of current values
-        self.curr_values = CurrentValueTable(self.dbpool)
+        Database.__init__(self, log, db_location, profile)
+        self.segments = segments
+        # Create the table of current values
+        self.curr_values = CurrentValueTable(self.dbpool, log)
+
+        if segments is None:
+            save = self.curr_values.save_values_in_db
+        else:
+            save = self.compact
+            self._compaction = defer.DeferredLock()
+            self._replay()
 
         # Periodic write of current values in database
         if interval > 0:
-            lp = LoopingCall(self.curr_values.save_values_in_db)
+            lp = LoopingCall(save)
             lp.start(interval, False)
 
+        # Write the cached values before the database is closed
+        reactor.addSystemEventTrigger('before', 'shutdown', save)
+
+    def _replay(self):
+        '''
+        Rebuild the latest values from the segments left by the previous run.
+        '''
+        values = {}
+        for path in self.segments.sealed:
+            for record in read_segment(path, self.log):
+                if record[0] == 'v':
+                    values[record[1]] = CurrentValue(record[1], record[2], record[3])
+                elif record[0] == 'd':
+                    values.pop(record[1], None)
+
+        # The values loaded from the database are older
+        for curr_val in values.itervalues():
+            self.curr_values.add_value(curr_val)
+
+        def replayed(result):
+            for curr_val in values.itervalues():
+                self.view.value_changed(curr_val.id, curr_val.value, curr_val.last_update)
+            return result
+
+        self.started.addCallback(replayed)
+
+    def compact(self):
+        '''
+        Seal the active segment and fold all sealed segments into the database.
+
+        @return: Deferred object which fires once the segments have been folded
+        '''
+        return self._compaction.run(self._compact)
+
+    @inlineCallbacks
+    def _compact(self):
+        sealed = yield self.segments.seal()
+        for path in sealed:
+            try:
+                yield self.dbpool.runInteraction(self._fold_segment, path)
+            except Exception:
+                # The segment is kept, so it is folded again by the next compaction
+                self.log.error("Unable to fold segment %s into the database (%s)" % (path, sys.exc_info()[1]))
+                return
+
+            self.segments.remove(path)
+
+    def _fold_segment(self, txn, path):
+        '''
+        Write the latest values and the history samples of a segment.
+        This method has to be run within a runInteraction call
+        '''
+        values = {}
+        history = []
+        for record in read_segment(path, self.log):
+            if record[0] == 'v':
+                number, value_type = parse_value(record[2])
+                values[record[1]] = (record[2], number, value_type, record[3], record[1])
+            elif record[0] == 'd':
+                values.pop(record[1], None)
+            elif record[0] == 'h':
+                history.append((record[1], parse_value(record[2])[0], record[3], record[1], record[3]))
+
+        txn.executemany("UPDATE current_values SET value=?, value_numeric=?, value_type=?, lastupdate=? WHERE id=?", values.values())
+        # A segment folded before a crash is folded again, so samples are only added once
+        txn.executemany("INSERT INTO history_values (value_id, value, created_at) SELECT ?, ?, ? " +
+                        "WHERE NOT EXISTS (SELECT 1 FROM history_values WHERE value_id=? AND created_at=?)", history)
+
 
     @inlineCallbacks
     def update_or_add_value(self, name, value, pluginid, address, time=None):
@@ -56,47 +142,68 @@ class DatabaseFlash(Database):
         else:
             updatetime = datetime.datetime.fromtimestamp(time).isoformat(' ').split('.')[0]
 
-        # Query device first
-        device = yield self.dbpool.runQuery('select id from devices WHERE plugin_id = ? and address = ? LIMIT 1', (pluginid, address) )
+        # Known values are only updated in memory
+        cached = self.ids.value(pluginid, address, name)
+        if cached and self.curr_values.update(cached[0], value, updatetime, self.segments is None):
+            if self.segments is not None:
+                self.segments.append('v', cached[0], value, updatetime)
+            self.view.value_changed(cached[0], value, updatetime)
+            returnValue(cached[0])
 
-        try:
-            device_id = device[0][0]
-        except:
+        # First update of this value, resolve the ids and write the value
+        value_ids = yield Database.update_or_add_values(self, [(name, value, pluginid, address, time)])
+        value_id = value_ids[0]
+        if value_id == '':
             returnValue('') # device does not exist
-        
-        current_value = yield self.curr_values.query_static_data(name=name, device_id=device_id)
-    
-        try:
-            value_id = current_value[0][0]
-        except:
-            value_id = None
-    
-        # If current value found in database
-        if value_id:
-            # Get current value from list
-            curr_val = self.curr_values.get_current_value(value_id)
-            if curr_val is not None:
-                # Update value
-                curr_val.value = value
-                curr_val.last_update = updatetime
-
-            # XXX: need to be rewriten
-            # Log value?
-            if current_value[0][2] not in (0, None):
-                DataHistory("data", value_id, value, "GAUGE", 60, int(time))                
-        else:
-            # Insert new row in current_values
-            yield self.curr_values.insert_value_in_db(name, value, address, pluginid, updatetime)
-            # Query last inserted row
-            current_value = yield self.curr_values.query_static_data(name=name, device_id=device_id)
-            value_id = current_value[0][0]
-            # Add new value to the list
-            curr_val = CurrentValue(value_id, value, updatetime)
-            self.curr_values.add_value(curr_val)
+
+        # The database holds this update, so the cached value is clean
+        self.curr_values.add_value(CurrentValue(value_id, value, updatetime))
                         
         returnValue(value_id)
                
 
+    @inlineCallbacks
+    def update_or_add_values(self, updates):
+        '''
+        Overriden method
+        Value updates are cached in memory, so a batch is simply applied update by update.
+        
+        @param updates: a list of (name, value, pluginid, address, time) tuples, in arrival order
+        '''
+        value_ids = []
+        for name, value, pluginid, address, time in updates:
+            value_id = yield self.update_or_add_value(name, value, pluginid, address, time)
+            value_ids.append(value_id)
+            
+        returnValue(value_ids)
+
+    def del_value(self, id):
+        '''
+        Overriden method
+        The value is removed from the cache as well.
+        '''
+        self.curr_values.remove_value(id)
+        if self.segments is not None:
+            self.segments.append('d', int(id))
+        return Database.del_value(self, id)
+
+    def collect_history_values(self, value_id):
+        '''
+        Overriden method
+        The history sample is taken from the cache, with a segment log it is appended to the log.
+        '''
+        curr_val = self.curr_values.get_current_value(value_id)
+        if curr_val is None:
+            return Database.collect_history_values(self, value_id)
+
+        created_at = datetime.datetime.now().isoformat(' ').split('.')[0]
+        if self.segments is not None:
+            self.segments.append('h', curr_val.id, curr_val.value, created_at)
+            return defer.succeed(None)
+
+        return self.dbpool.runOperation("INSERT INTO history_values (value_id, value, created_at) VALUES (?, ?, ?)",
+                                        [curr_val.id, curr_val.number, created_at])
+
     def query_values(self):
         """
         Query current values
@@ -104,47 +211,70 @@ class DatabaseFlash(Database):
         
         @return List of values
         """
-        # Update database from current values in memory
-        self.curr_values.save_values_in_db()
+        if self.segments is not None:
+            return Database.query_values(self).addCallback(self._cached_rows, 7, 1, 3)
+
+        # Update database from current values in memory, the read pool only sees them once committed
+        d = self.curr_values.save_values_in_db()
         # Query database
-        return Database.query_values(self)
+        return d.addCallback(lambda _: Database.query_values(self))
 
 
-    def query_controllable_devices(self):
+    def query_controllable_values(self):
         """
         Query controllable values
         Cached values are saved into database each time this method is called
         
         @return list of values
         """
+        if self.segments is not None:
+            return Database.query_controllable_values(self).addCallback(self._cached_rows, 0, 3)
+
         # Update database from current values in memory
-        self.curr_values.save_values_in_db()
+        d = self.curr_values.save_values_in_db()
         # Query database
-        return Database.query_controllable_devices(self)
+        return d.addCallback(lambda _: Database.query_controllable_values(self))
 
         
     def query_value_by_valueid(self, value_id):
         """
-        Query a given value
+        Query a given value, the value itself comes from the cache
         
         @param value_id: Value ID
         
         @return Deferred object
         """
-        d = defer.Deferred()
-    
-        @inlineCallbacks
-        def get_result():
-            # Query static data (format of the output: [id, name, history])
-            value = yield self.curr_values.query_static_data(id=value_id)
-            # Get actual current value
+        def cached(result):
             curr_val = self.curr_values.get_current_value(value_id)
+            if result and curr_val is not None:
+                return [(curr_val.value, result[0][1], curr_val.number)]
+            return result
+
+        return Database.query_value_by_valueid(self, value_id).addCallback(cached)
+
+    def _cached_rows(self, rows, id_column, value_column, lastupdate_column=None):
+        """
+        Replace the values of query result rows by the cached ones
+        
+        @param rows: the result rows
+        @param id_column: index of the value id in a row
+        @param value_column: index of the value in a row
+        @param lastupdate_column: index of the last update time in a row, if any
+        
+        @return the result rows
+        """
+        result = []
+        for row in rows:
+            curr_val = self.curr_values.get_current_value(row[id_column])
             if curr_val is not None:
-                result = [(curr_val.value, value[0][0])]
-                d.callback(result)
-       
-        reactor.callLater(0, get_result)               
-        return d
+                row = list(row)
+                row[value_column] = curr_val.value
+                if lastupdate_column is not None:
+                    row[lastupdate_column] = curr_val.last_update
+                row = tuple(row)
+            result.append(row)
+
+        return result
    
         
 class CurrentValue:
@@ -161,8 +291,19 @@ class CurrentValue:
         """
         ## id of the table row within SQLite
         self.id = val_id
+        self.set(value, last_update)
+
+    def set(self, value, last_update):
+        """
+        Set the value, which is parsed once here
+        
+        @param value: current value in string format
+        @param last_update: last update time
+        """
         ## Current value in string format
         self.value = value
+        ## Current value as a number, None when it isn't one, and its type
+        self.number, self.type = parse_value(value)
         ## Last update time
         self.last_update = last_update
         
@@ -170,18 +311,24 @@ class CurrentValue:
 class CurrentValueTable:
     """
     Class representing HouseAgent's current_value table with all the live data (value and time)
-    being stored in an in-memory list
+    being stored in an in-memory dictionary, keyed by value id.
+    The ids of the values changed since the last save are kept in a dirty set, so a save only
+    writes those.
     """
-    def __init__(self, conn_pool):
+    def __init__(self, conn_pool, log=None):
         """
         Class constructor
         
         @param conn_pool: Database connection pool
+        @param log: logging object
         """
         ## Connection pool to data base
         self.conn_pool = conn_pool
-        ## List of current values
-        self.lst_curr_values = None
+        self.log = log
+        ## Current values by id
+        self.curr_values = {}
+        ## Ids of the values changed in memory only
+        self.dirty = set()
         # Query current_values table
         self._query_current_values_table()
     
@@ -191,109 +338,109 @@ class CurrentValueTable:
         """
         query_str = "SELECT id, value, lastupdate from current_values"
                     
-        self.conn_pool.runQuery(query_str).addCallback(self._cb_query_result, "GETDBDATA")
+        self.conn_pool.runQuery(query_str).addCallback(self._cb_query_result)
 
     
-    def _cb_query_result(self, result, action):
+    def _cb_query_result(self, result):
         """
-        Result of the last query SQLite query received
+        Fill the "in-memory" table of "live" data, values cached in the meantime are newer
         
-        @param result: Result of the last query
-        @param action: Action to be deployed
+        @param result: Result of the query
         """
-        if action == "GETDBDATA":
-            # Fill the "in_memory" list of "live" data
-            self.lst_curr_values = []
-            for row in result:
-                curr_value = CurrentValue(row[0], row[1], row[2])
-                self.add_value(curr_value)
+        for row in result:
+            if row[0] not in self.curr_values:
+                self.curr_values[row[0]] = CurrentValue(row[0], row[1], row[2])
 
 
     def add_value(self, curr_value):
         """
-        Add new value to the list
+        Add a value as stored in the database, replacing the cached one
         
         @param curr_value: Current value to be added
         """
-        self.lst_curr_values.append(curr_value)
+        self.curr_values[curr_value.id] = curr_value
+        self.dirty.discard(curr_value.id)
         
 
-    def get_current_value(self, val_id):
+    def remove_value(self, val_id):
         """
-        Get current value from list
+        Remove a value from the cache
         
-        @param id: Value ID
-        
-        @return Current value entry or None if no value is found
+        @param val_id: Value ID
         """
-        for curr_val in self.lst_curr_values:
-            if curr_val.id == val_id:
-                return curr_val                
-        return None
-    
-    
-    def query_static_data(self, value_id=None, name=None, device_id=None):
+        val_id = _value_id(val_id)
+        self.curr_values.pop(val_id, None)
+        self.dirty.discard(val_id)
+
+
+    def get_current_value(self, val_id):
         """
-        Query static data about a given value in current_values
+        Get current value
         
-        @param value_id: Value ID
-        @param name: NAme fo the value
-        @param device_id: Device ID
+        @param val_id: Value ID
         
-        @return Deferred object to the result of this query. Format of the result:
-        [id, name, history]
+        @return Current value entry or None if no value is found
         """
-        if value_id is not None:
-            return self.conn_pool.runQuery("SELECT id, name, history from current_values WHERE id = ? LIMIT 1", [value_id])
-        else:
-            return self.conn_pool.runQuery("select id, name, history from current_values where name=? AND device_id=? LIMIT 1", (name, device_id))
-
+        return self.curr_values.get(_value_id(val_id))
     
-    def insert_value_in_db(self, name, value, address, plugin_id, update_time):
+
+    def update(self, val_id, value, last_update, dirty=True):
         """
-        Insert new value row in the table. Get the id of the new inserted row
+        Update a cached value, it is saved by the next save_values_in_db
         
-        @param name: Name of the value
-        @param value: Current value
-        @param address: Address of the device
-        @param plugin_id: ID of the plugin
-        @param update_time: Last update time for the current value
+        @param val_id: Value ID
+        @param value: the new value
+        @param last_update: the update time
+        @param dirty: False when the update is stored elsewhere and shouldn't be saved
         
-        @return deferred object to the result of the query
+        @return True when the value is cached, False otherwise
         """
-        # Insert new value into current_values
-        return self.conn_pool.runQuery("INSERT INTO current_values (name, value, device_id, lastupdate) VALUES (?, ?, (select id from devices where address=? AND plugin_id=?),  ?)", (name, value, address, plugin_id, update_time))
+        curr_val = self.curr_values.get(val_id)
+        if curr_val is None:
+            return False
+
+        curr_val.set(value, last_update)
+        if dirty:
+            self.dirty.add(val_id)
+        return True
 
 
-    def _save_table(self, txn):
+    def _save_table(self, txn, rows):
         """
-        Save values in current_values table. Only modified values/timestamps are been written
+        Save changed values in current_values table
         This method has to be run within a runInteraction call
         """
-        # Query database first
-        querystr = "SELECT id, value, lastupdate from current_values"
-        values = txn.execute(querystr).fetchall()
-        
-        # Prepare query for updating values and timestamps
-        querystr = "UPDATE current_values SET value=?, lastupdate=? WHERE id=?"
-        for i, curr_val in enumerate(self.lst_curr_values):
-            # Value changed?
-            val_id = values[i][0]
-            oldval = values[i][1]
-            oldtime = values[i][2]
-            
-            # Run update only forthose values that have been updated
-            if (curr_val.id == val_id) and ((curr_val.value != oldval) or (curr_val.last_update != oldtime)):
-                txn.execute(querystr, [curr_val.value, curr_val.last_update, curr_val.id])
+        txn.executemany("UPDATE current_values SET value=?, value_numeric=?, value_type=?, lastupdate=? WHERE id=?", rows)
                 
             
     def save_values_in_db(self):
         """
-        Save values in database
+        Save the values changed since the last save in the database, in one transaction
+        
+        @return Deferred object which fires once the values have been committed
         """
-        try:
-            # Run database operations in a separate thread
-            return self.conn_pool.runInteraction(self._save_table)
-        except:
-            self.log.error("Unable to write current values in database (%s)" % sys.exc_info()[1])
-    
+        if not self.dirty:
+            return defer.succeed(None)
+
+        # Values changing while the save is in progress are marked dirty again
+        dirty, self.dirty = self.dirty, set()
+        rows = [(curr_val.value, curr_val.number, curr_val.type, curr_val.last_update, curr_val.id)
+                for curr_val in (self.curr_values[val_id] for val_id in dirty)]
+
+        def failed(failure):
+            # Saved by the next attempt
+            self.dirty.update(val_id for val_id in dirty if val_id in self.curr_values)
+            if self.log:
+                self.log.error("Unable to write current values in database (%s)" % failure.getErrorMessage())
+
+        return self.conn_pool.runInteraction(self._save_table, rows).addErrback(failed)
+
+
+def _value_id(val_id):
+    """
+    @return: the value id as an integer, ids from the web interface and event parameters are strings
+    """
+    try:
+        return int(val_id)
+    except (TypeError, ValueError):
+        return val_id
@@ -0,0 +1,610 @@
+from twisted.internet import defer
+import os.path
+import sqlite3
+from houseagent.core.idcache import IdCache
+from houseagent.core.storage import Storage
+from houseagent.core.valueview import lastupdate
+from houseagent.core.valuetypes import parse_value
+
+# Columns of the tables kept in memory, the first column is the id
+_COLUMNS = {'locations': ('id', 'name', 'parent'),
+            'plugins': ('id', 'name', 'authcode', 'location_id'),
+            'devices': ('id', 'name', 'address', 'plugin_id', 'location_id'),
+            'current_values': ('id', 'name', 'value', 'device_id', 'lastupdate', 'history_period_id',
+                               'history_type_id', 'control_type_id', 'label', 'value_numeric', 'value_type'),
+            'control_types': ('id', 'name'),
+            'history_types': ('id', 'name'),
+            'history_periods': ('id', 'name', 'secs', 'sysflag'),
+            'trigger_types': ('id', 'name'),
+            'condition_types': ('id', 'name'),
+            'action_types': ('id', 'name'),
+            'events': ('id', 'name', 'enabled'),
+            'triggers': ('id', 'trigger_types_id', 'events_id', 'conditions'),
+            'conditions': ('id', 'condition_types_id', 'events_id'),
+            'actions': ('id', 'action_types_id', 'events_id'),
+            'history_retention': ('id', 'value_id', 'history_type_id', 'days')}
+
+# Parameter tables, by the table their rows belong to
+_PARAMETERS = {'triggers': ('trigger_parameters', 'triggers_id'),
+               'conditions': ('condition_parameters', 'conditions_id'),
+               'actions': ('action_parameters', 'actions_id')}
+
+# Contents of the lookup tables of a new database
+_LOOKUP_TABLES = {'control_types': [(0, 'Not controllable'), (1, 'CONTROL_TYPE_ON_OFF'), (2, 'CONTROL_TYPE_THERMOSTAT'),
+                                    (3, 'CONTROL_TYPE_DIMMER')],
+                  'history_types': [(1, 'GAUGE'), (2, 'COUNTER')],
+                  'history_periods': [(1, 'Disabled', 0, '1'), (2, '5 min', 300, '1'), (3, '15 min', 900, '1'),
+                                      (4, '30 min', 1800, '1'), (5, '1 hour', 3600, '1'), (6, '2 hours', 7200, '1'),
+                                      (7, '8 hours', 28800, '1'), (8, '12 hours', 43200, '1'), (9, '1 day', 86400, '1')],
+                  'trigger_types': [(2, 'Device value change'), (3, 'Absolute time')],
+                  'condition_types': [(1, 'Device value')],
+                  'action_types': [(1, 'Device action')],
+                  'history_retention': [(1, None, None, 7)]}
+
+# Column defaults of a new value
+_VALUE_DEFAULTS = {'history_period_id': 1, 'history_type_id': 1, 'control_type_id': 0, 'value_type': 0}
+
+class MemoryDatabase(Storage):
+    '''
+    HouseAgent storage engine keeping everything in memory, for tests and benchmarks.
+
+    Rows are dictionaries kept by id per table, parameters are lists of (name, value) tuples by
+    the id of the trigger, condition or action they belong to and the history is a list of
+    (value id, value, created_at) tuples. Queries return the same rows as Database, also for
+    rows referring to rows that don't exist, and store values with the same types as the SQLite
+    columns would. Nothing is written to disk.
+
+    Every operation completes before it returns, so the deferreds have fired already.
+    '''
+
+    def __init__(self, log, db_location=None):
+        '''
+        @param log: logging object
+        @param db_location: an SQLite database to copy the contents of, by default the engine
+                            starts with the lookup tables of a new database
+        '''
+        self.log = log
+
+        self.coordinator = None
+        self.histcollector = None
+        self.view = None
+
+        self.tables = dict((name, {}) for name in _COLUMNS)
+        self.parameters = dict((name, {}) for name in _PARAMETERS)
+        self.history = []
+
+        # Lookups of value updates, (plugin id, address) to device id and (device id, name) to value id
+        self._devices = {}
+        self._values = {}
+        self._next_id = dict((name, 1) for name in _COLUMNS)
+
+        if db_location:
+            self.load(db_location)
+        else:
+            for name, rows in _LOOKUP_TABLES.iteritems():
+                for row in rows:
+                    self._insert(name, dict(zip(_COLUMNS[name], row)))
+
+    def load(self, db_location):
+        '''
+        Replace the contents of the engine with the contents of an SQLite database.
+        @param db_location: the location of the database file
+        '''
+        if not os.path.exists(db_location):
+            raise IOError("Database %s doesn't exist" % db_location)
+
+        connection = sqlite3.connect(db_location)
+        try:
+            existing = set(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+            for name, columns in _COLUMNS.iteritems():
+                self.tables[name] = {}
+                self._next_id[name] = 1
+                if name in existing:
+                    # Columns added by a later schema version are left out
+                    stored = set(row[1] for row in connection.execute("PRAGMA table_info(%s)" % name))
+                    columns = [column for column in columns if column in stored]
+                    rows = connection.execute("SELECT %s FROM %s ORDER BY id" % (', '.join(columns), name))
+                else:
+                    # A table added by a later schema version
+                    rows = _LOOKUP_TABLES.get(name, [])
+                for row in rows:
+                    self._insert(name, dict(zip(columns, row)))
+
+            for name, (table, column) in _PARAMETERS.iteritems():
+                self.parameters[name] = {}
+                for parent, parameter, value in connection.execute("SELECT %s, name, value FROM %s ORDER BY id" % (column, table)):
+                    self.parameters[name].setdefault(parent, []).append((parameter, value))
+
+            self.history = connection.execute("SELECT value_id, value, created_at FROM history_values ORDER BY created_at").fetchall()
+
+            # AUTOINCREMENT tables don't reuse the ids of deleted rows
+            for name, sequence in connection.execute("SELECT name, seq FROM sqlite_sequence"):
+                if name in self._next_id:
+                    self._next_id[name] = max(self._next_id[name], sequence + 1)
+        finally:
+            connection.close()
+
+        self._devices = {}
+        for device in self.tables['devices'].itervalues():
+            self._devices.setdefault(IdCache.device_key(device['plugin_id'], device['address']), device['id'])
+
+        self._values = {}
+        for value in self.tables['current_values'].itervalues():
+            self._values.setdefault((value['device_id'], value['name']), value['id'])
+            if value['value_type'] is None:
+                self._set_value(value, value['value'])
+
+    # Plugins
+    def register_plugin(self, name, uuid, location):
+        self._insert('plugins', {'name': _text(name), 'authcode': _text(str(uuid)), 'location_id': _integer(location)})
+        return self._plugin_crud()
+
+    def update_plugin(self, id, name, location):
+        self._update('plugins', id, name=_text(name), location_id=_integer(location))
+        return self._plugin_crud()
+
+    def del_plugin(self, id):
+        self.tables['plugins'].pop(_integer(id), None)
+        return self._plugin_crud()
+
+    def query_plugins(self):
+        locations = self.tables['locations']
+        return self._result((plugin['name'], plugin['authcode'], plugin['id'], self._name(locations, plugin['location_id']),
+                             plugin['location_id']) for plugin in self._rows('plugins'))
+
+    # Locations
+    def add_location(self, name, parent):
+        self._insert('locations', {'name': _text(name), 'parent': _integer(parent) if parent else 0})
+        return defer.succeed([])
+
+    def update_location(self, id, name, parent):
+        self._update('locations', id, name=_text(name), parent=_integer(parent))
+        return defer.succeed([])
+
+    def del_location(self, id):
+        self.tables['locations'].pop(_integer(id), None)
+        return defer.succeed([])
+
+    def query_locations(self):
+        locations = self.tables['locations']
+        return self._result((location['id'], location['name'], self._name(locations, location['parent']))
+                            for location in self._rows('locations'))
+
+    # Devices
+    def save_device(self, name, address, plugin_id, location_id, id=None):
+        plugin_id = _integer(plugin_id)
+        key = IdCache.device_key(plugin_id, address)
+
+        if not id:
+            if key in self._devices:
+                return defer.fail(sqlite3.IntegrityError("columns address, plugin_id are not unique"))
+            device = self._insert('devices', {'name': _text(name), 'address': _text(address), 'plugin_id': plugin_id,
+                                              'location_id': _integer(location_id)})
+            action = "create"
+        else:
+            device = self.tables['devices'].get(_integer(id))
+            if not device:
+                return defer.succeed([])
+            self._devices.pop(IdCache.device_key(device['plugin_id'], device['address']), None)
+            device.update(name=_text(name), address=_text(address), plugin_id=plugin_id, location_id=_integer(location_id))
+            action = "update"
+
+        self._devices[key] = device['id']
+        return self._device_crud(action, device)
+
+    def del_device(self, id):
+        device = self.tables['devices'].pop(_integer(id), None)
+        if not device:
+            return defer.succeed([])
+
+        self._devices.pop(IdCache.device_key(device['plugin_id'], device['address']), None)
+        return self._device_crud("delete", device)
+
+    def query_devices(self):
+        plugins = self.tables['plugins']
+        locations = self.tables['locations']
+        return self._result((device['id'], device['name'], device['address'], plugins[device['plugin_id']]['name'],
+                             self._name(locations, device['location_id']))
+                            for device in self._rows('devices') if device['plugin_id'] in plugins)
+
+    def query_devices_simple(self):
+        return self._result((device['id'], device['name']) for device in self._rows('devices'))
+
+    def query_device(self, id):
+        return self._result(self._row('devices', id, ('id', 'name', 'address', 'plugin_id', 'location_id')))
+
+    def query_device_routing_by_id(self, device_id):
+        device = self.tables['devices'].get(_integer(device_id))
+        if not device or device['plugin_id'] not in self.tables['plugins']:
+            return defer.succeed([])
+
+        return defer.succeed([(device['address'], self.tables['plugins'][device['plugin_id']]['authcode'])])
+
+    # Values
+    def update_or_add_value(self, name, value, pluginid, address, time=None):
+        return self.update_or_add_values([(name, value, pluginid, address, time)]).addCallback(lambda value_ids: value_ids[0])
+
+    def update_or_add_values(self, updates):
+        devices = self._devices
+        values = self._values
+        rows = self.tables['current_values']
+        value_ids = []
+
+        for name, value, pluginid, address, time in updates:
+            device_id = devices.get(IdCache.device_key(pluginid, address))
+            if device_id is None:
+                value_ids.append('') # device does not exist
+                continue
+
+            value_id = values.get((device_id, name))
+            if value_id is None:
+                row = dict(_VALUE_DEFAULTS, name=_text(name), device_id=device_id, label=None)
+                value_id = self._insert('current_values', row)['id']
+                values[(device_id, name)] = value_id
+            else:
+                row = rows[value_id]
+
+            self._set_value(row, value)
+            row['lastupdate'] = _text(lastupdate(time))
+            value_ids.append(value_id)
+
+        return defer.succeed(value_ids)
+
+    def save_value(self, label, history_type, history_period, control_type, id):
+        self._update('current_values', id, label=_text(label), history_type_id=_integer(history_type),
+                     history_period_id=_integer(history_period), control_type_id=_integer(control_type))
+        return defer.succeed([])
+
+    def del_value(self, id):
+        value = self.tables['current_values'].pop(_integer(id), None)
+        if value and self._values.get((value['device_id'], value['name'])) == value['id']:
+            del self._values[(value['device_id'], value['name'])]
+        return defer.succeed([])
+
+    def query_values(self):
+        tables = self.tables
+        devices, plugins, locations = tables['devices'], tables['plugins'], tables['locations']
+        control_types, history_types, history_periods = tables['control_types'], tables['history_types'], tables['history_periods']
+
+        rows = []
+        for value in self._rows('current_values'):
+            device = devices.get(value['device_id'])
+            if not device or device['plugin_id'] not in plugins:
+                continue
+
+            plugin = plugins[device['plugin_id']]
+            control_type = control_types.get(value['control_type_id'])
+            rows.append((value['name'], value['value'], device['name'], value['lastupdate'], plugin['name'], device['address'],
+                         self._name(locations, device['location_id']), value['id'], self._name(control_types, value['control_type_id']),
+                         control_type['id'] if control_type else None, self._name(history_types, value['history_type_id']),
+                         self._name(history_periods, value['history_period_id']), plugin['id'], value['label']))
+
+        return defer.succeed(rows)
+
+    def query_values_light(self):
+        return self._result((value['id'], value['name'] if value['label'] is None else value['label'],
+                             value['history_period_id'], value['history_type_id']) for value in self._rows('current_values'))
+
+    def query_value_by_valueid(self, value_id):
+        return self._result(self._row('current_values', value_id, ('value', 'name', 'value_numeric')))
+
+    def query_values_by_device_id(self, device_id):
+        device_id = _integer(device_id)
+        return self._result((value['id'], value['name']) for value in self._rows('current_values') if value['device_id'] == device_id)
+
+    def query_value_properties(self, value_id):
+        value, device = self._value_device(value_id)
+        if not device:
+            return defer.succeed([])
+
+        return defer.succeed([(value['name'], device['address'], device['plugin_id'], value['label'])])
+
+    def query_extra_valueinfo(self, value_id):
+        value, device = self._value_device(value_id)
+        if not device:
+            return defer.succeed([])
+
+        return defer.succeed([(device['name'], value['name'])])
+
+    def query_controllable_values(self):
+        devices = self.tables['devices']
+        control_types = self.tables['control_types']
+        return self._result((value['id'], devices[value['device_id']]['name'], value['label'], value['value'],
+                             control_types[value['control_type_id']]['name'])
+                            for value in self._rows('current_values')
+                            if value['control_type_id'] > 0 and value['device_id'] in devices and value['control_type_id'] in control_types)
+
+    def query_action_types_by_device_id(self, device_id):
+        device_id = _integer(device_id)
+        control_types = self.tables['control_types']
+        return self._result((value['id'], value['name'], control_types[value['control_type_id']]['name'])
+                            for value in self._rows('current_values')
+                            if value['device_id'] == device_id and value['control_type_id'] in control_types)
+
+    def query_action_type_by_value_id(self, value_id):
+        return self.query_controltypename(value_id)
+
+    def query_controltypename(self, current_value_id):
+        value = self.tables['current_values'].get(_integer(current_value_id))
+        if not value or value['control_type_id'] not in self.tables['control_types']:
+            return defer.succeed([])
+
+        return defer.succeed([(self.tables['control_types'][value['control_type_id']]['name'],)])
+
+    # Lookup tables
+    def query_controltypes(self):
+        return self._result(self._columns('control_types', ('id', 'name')))
+
+    def query_history_types(self):
+        return self._result(self._columns('history_types', ('id', 'name')))
+
+    def query_triggertypes(self):
+        return self._result(self._columns('trigger_types', ('id', 'name')))
+
+    def query_actiontypes(self):
+        return self._result(self._columns('action_types', ('id', 'name')))
+
+    def query_conditiontypes(self):
+        return self._result(self._columns('condition_types', ('id', 'name')))
+
+    def query_history_periods(self):
+        return self._result(self._columns('history_periods', ('id', 'name', 'secs', 'sysflag')))
+
+    # Events
+    def add_event2(self, name, enabled, conditions, actions, trigger):
+        return self.import_events([{'name': name, 'enabled': enabled, 'conditions': conditions,
+                                    'actions': actions, 'trigger': trigger}]).addCallback(lambda ids: ids[0])
+
+    def update_event(self, id, name, enabled, conditions, actions, trigger):
+        event = self.tables['events'].get(_integer(id))
+        if not event:
+            return defer.fail(KeyError("Event %s doesn't exist" % id))
+
+        try:
+            parts = self._event_parts({'conditions': conditions, 'actions': actions, 'trigger': trigger})
+        except (KeyError, TypeError, AttributeError), err:
+            return defer.fail(err)
+
+        event.update(name=_text(name), enabled=_integer(enabled))
+        self._delete_event_parts(event['id'])
+        self._add_event_parts(event['id'], parts)
+        return defer.succeed(event['id'])
+
+    def import_events(self, events):
+        # All events are checked before the first one is added, so either all of them are added or none
+        try:
+            events = [({'name': _text(event["name"]), 'enabled': _integer(event["enabled"])}, self._event_parts(event))
+                      for event in events]
+        except (KeyError, TypeError, AttributeError), err:
+            return defer.fail(err)
+
+        ids = []
+        for event, parts in events:
+            event_id = self._insert('events', event)['id']
+            self._add_event_parts(event_id, parts)
+            ids.append(event_id)
+
+        return defer.succeed(ids)
+
+    def del_event(self, id):
+        id = _integer(id)
+        self._delete_event_parts(id)
+        self.tables['events'].pop(id, None)
+        return defer.succeed([])
+
+    def query_events(self):
+        return self._result(self._columns('events', ('id', 'name', 'enabled')))
+
+    def query_triggers(self):
+        types = self.tables['trigger_types']
+        return self._result((trigger['id'], types[trigger['trigger_types_id']]['name'], trigger['events_id'], trigger['conditions'])
+                            for trigger in self._rows('triggers') if trigger['trigger_types_id'] in types)
+
+    def query_conditions(self):
+        types = self.tables['condition_types']
+        return self._result((condition['id'], types[condition['condition_types_id']]['name'], condition['events_id'])
+                            for condition in self._rows('conditions') if condition['condition_types_id'] in types)
+
+    def query_actions(self):
+        types = self.tables['action_types']
+        return self._result((action['id'], types[action['action_types_id']]['name'], action['events_id'])
+                            for action in self._rows('actions') if action['action_types_id'] in types)
+
+    def query_trigger_parameters(self, trigger_id):
+        return defer.succeed(list(self.parameters['triggers'].get(_integer(trigger_id), [])))
+
+    def query_condition_parameters(self, condition_id):
+        return defer.succeed(list(self.parameters['conditions'].get(_integer(condition_id), [])))
+
+    def query_action_parameters(self, action_id):
+        return defer.succeed(list(self.parameters['actions'].get(_integer(action_id), [])))
+
+    # History
+    def query_history_schedules(self):
+        return self._result(self._columns('current_values', ('id', 'name', 'history_period_id', 'history_type_id')))
+
+    def collect_history_values(self, value_id):
+        value = self.tables['current_values'].get(_integer(value_id))
+        if value:
+            self.history.append((value['id'], value['value_numeric'], _text(lastupdate())))
+        return defer.succeed([])
+
+    def delete_history_values(self, before, limit, value_id=None):
+        if value_id is None:
+            policies = self.tables['history_retention'].values()
+            own = set(policy['value_id'] for policy in policies if policy['value_id'] is not None)
+            types = set(policy['history_type_id'] for policy in policies
+                        if policy['value_id'] is None and policy['history_type_id'] is not None)
+            values = self.tables['current_values']
+
+            def expired(row):
+                value = values.get(row[0])
+                return row[2] < before and (value is None or (value['id'] not in own and value['history_type_id'] not in types))
+        else:
+            value_id = _integer(value_id)
+            expired = lambda row: row[0] == value_id and row[2] < before
+
+        history = []
+        deleted = 0
+        for row in self.history:
+            if deleted < limit and expired(row):
+                deleted += 1
+            else:
+                history.append(row)
+
+        self.history = history
+        return defer.succeed(deleted)
+
+    def incremental_vacuum(self, pages):
+        return defer.succeed(0)
+
+    def query_retention_policies(self):
+        return self._result(self._columns('history_retention', ('id', 'value_id', 'history_type_id', 'days')))
+
+    def save_retention_policy(self, days, value_id=None, history_type_id=None):
+        value_id, history_type_id = _integer(value_id), _integer(history_type_id)
+        for policy in self._rows('history_retention'):
+            if policy['value_id'] == value_id and policy['history_type_id'] == history_type_id:
+                self.tables['history_retention'].pop(policy['id'])
+
+        policy = self._insert('history_retention', {'value_id': value_id, 'history_type_id': history_type_id, 'days': _integer(days)})
+        return defer.succeed(policy['id'])
+
+    def del_retention_policy(self, id):
+        self.tables['history_retention'].pop(_integer(id), None)
+        return defer.succeed([])
+
+    # Internal functions
+    def _insert(self, name, row):
+        '''
+        Add a row, it gets the next id unless it has one.
+        @return: the row
+        '''
+        if row.get('id') is None:
+            row['id'] = self._next_id[name]
+        self._next_id[name] = max(self._next_id[name], row['id'] + 1)
+
+        for column in _COLUMNS[name]:
+            row.setdefault(column, None)
+
+        self.tables[name][row['id']] = row
+        return row
+
+    def _set_value(self, row, value):
+        '''
+        Store a value of a current_values row with its number and type.
+        '''
+        number, value_type = parse_value(value)
+        row['value'] = _text(value)
+        row['value_numeric'] = _real(number)
+        row['value_type'] = value_type
+
+    def _update(self, table, id, **columns):
+        row = self.tables[table].get(_integer(id))
+        if row:
+            row.update(columns)
+
+    def _rows(self, name):
+        '''
+        @return: the rows of a table in id order, like an SQLite table scan
+        '''
+        table = self.tables[name]
+        return [table[id] for id in sorted(table)]
+
+    def _columns(self, name, columns):
+        return (tuple(row[column] for column in columns) for row in self._rows(name))
+
+    def _row(self, name, id, columns):
+        row = self.tables[name].get(_integer(id))
+        return [tuple(row[column] for column in columns)] if row else []
+
+    def _name(self, table, id):
+        row = table.get(id)
+        return row['name'] if row else None
+
+    def _result(self, rows):
+        return defer.succeed(list(rows))
+
+    def _value_device(self, value_id):
+        value = self.tables['current_values'].get(_integer(value_id))
+        if not value:
+            return None, None
+        return value, self.tables['devices'].get(value['device_id'])
+
+    def _event_parts(self, event):
+        '''
+        Convert the conditions, actions and triggers of an event, as posted by the event editor, to rows.
+        @return: a list of (table name, row, parameters) tuples
+        '''
+        parts = []
+        for name, type, items in (('conditions', 'condition_type', event["conditions"]),
+                                  ('actions', 'action_type', event["actions"]),
+                                  ('triggers', 'trigger_type', event.get("triggers") or [event["trigger"]])):
+            for item in items:
+                row = {_COLUMNS[name][1]: _integer(item[type])}
+                if name == 'triggers':
+                    row['conditions'] = _integer(item.get("conditions"))
+                parameters = [(_text(parameter), _text(value)) for parameter, value in item["parameters"].iteritems()]
+                parts.append((name, row, parameters))
+
+        return parts
+
+    def _add_event_parts(self, event_id, parts):
+        for name, row, parameters in parts:
+            id = self._insert(name, dict(row, events_id=event_id))['id']
+            self.parameters[name][id] = parameters
+
+    def _delete_event_parts(self, event_id):
+        for name in _PARAMETERS:
+            table = self.tables[name]
+            for id in [id for id, row in table.iteritems() if row['events_id'] == event_id]:
+                del table[id]
+                self.parameters[name].pop(id, None)
+
+    def _plugin_crud(self):
+        if self.coordinator:
+            self.coordinator.load_plugins()
+        return defer.succeed([])
+
+    def _device_crud(self, action, device):
+        plugin = self.tables['plugins'].get(device['plugin_id'])
+        parameters = {"plugin": plugin['authcode'] if plugin else None,
+                      "address": device['address'],
+                      "name": device['name'],
+                      "location": self._name(self.tables['locations'], device['location_id'])}
+
+        if self.coordinator:
+            self.coordinator.send_crud_update("device", action, parameters)
+        return defer.succeed([])
+
+def _integer(value):
+    '''
+    @return: the value as stored in an INTEGER column, strings holding a number are converted
+    '''
+    if isinstance(value, basestring):
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+def _real(value):
+    '''
+    @return: the value as stored in a REAL column
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+def _text(value):
+    '''
+    @return: the value as stored in a VARCHAR column, numbers are converted to text
+    '''
+    if value is None or isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
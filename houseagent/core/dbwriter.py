@@ -0,0 +1,280 @@
+import sqlite3
+import threading
+import time
+from collections import deque
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+class _Operation(object):
+    '''
+    Skeleton class for a queued write operation.
+    '''
+    def __init__(self, func, args, kwargs, transaction=True):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.transaction = transaction
+        self.deferred = defer.Deferred()
+        self.result = None
+
+class SQLiteWriter(object):
+    '''
+    This class owns a single SQLite connection on a dedicated thread and runs write operations
+    in groups, with one commit per group instead of one per operation.
+
+    Operations are taken from a queue in arrival order. A group is committed once it holds
+    max_group operations, or max_delay seconds after its first operation was taken. Every
+    operation runs in its own savepoint, so a failing operation is rolled back without
+    affecting the rest of the group. The deferred of an operation fires once its group has
+    been committed.
+
+    A group that finds the database locked, for instance by a backup reading it in a single
+    read transaction with the rollback journal, is rolled back and run again once the lock
+    has been released, for up to busy_retry seconds. Its operations are delayed, not lost.
+
+    The methods runQuery, runOperation and runInteraction behave like the ones of a Twisted
+    adbapi ConnectionPool.
+    '''
+
+    def __init__(self, db_location, open_connection=None, max_group=256, max_delay=0.001, busy_retry=600):
+        '''
+        Initialize a new SQLiteWriter and start its thread.
+        @param db_location: the location of the database file
+        @param open_connection: function called with the new connection, to configure it
+        @param max_group: the maximum number of operations committed together
+        @param max_delay: the maximum time in seconds an operation waits for others to join its group
+        @param busy_retry: the maximum time in seconds a group is retried while the database is locked
+        '''
+        self.db_location = db_location
+        self.open_connection = open_connection
+        self.max_group = max(1, max_group)
+        self.max_delay = max_delay
+        self.busy_retry = busy_retry
+
+        self.operations = 0
+        self.commits = 0
+        self.largest_group = 0
+        self.retries = 0
+
+        # deque appends and pops are atomic, the event only wakes up the writer thread
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._running = True
+
+        self._thread = threading.Thread(target=self._run, name='SQLiteWriter')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+        self._shutdown = reactor.addSystemEventTrigger('during', 'shutdown', self._final_close)
+
+    def runInteraction(self, interaction, *args, **kw):
+        '''
+        Run a function in the writer thread, as part of the current group.
+        @param interaction: function called with a cursor as first argument, followed by args and kw
+
+        @return: a Twisted deferred which fires with the result of the function once it has been committed
+        '''
+        return self._submit(interaction, args, kw)
+
+    def runWithoutTransaction(self, interaction, *args, **kw):
+        '''
+        Run a function in the writer thread outside of any transaction, for statements like VACUUM
+        which can't be run within one. The function runs on its own, after the operations queued
+        before it have been committed.
+        @param interaction: function called with a cursor as first argument, followed by args and kw
+
+        @return: a Twisted deferred which fires with the result of the function
+        '''
+        return self._submit(interaction, args, kw, False)
+
+    def runQuery(self, *args, **kw):
+        '''
+        Execute a statement and fetch its result rows.
+
+        @return: a Twisted deferred which fires with the result rows once they have been committed
+        '''
+        return self._submit(self._query, args, kw)
+
+    def runOperation(self, *args, **kw):
+        '''
+        Execute a statement without fetching a result.
+
+        @return: a Twisted deferred which fires with None once the statement has been committed
+        '''
+        return self._submit(self._operation, args, kw)
+
+    def stats(self):
+        '''
+        @return: a dictionary with writer counters
+        '''
+        return {'operations': self.operations,
+                'commits': self.commits,
+                'largest_group': self.largest_group,
+                'retries': self.retries,
+                'queued': len(self._queue)}
+
+    def close(self):
+        '''
+        Commit the queued operations and stop the writer thread.
+        '''
+        if not self._running:
+            return
+
+        self._running = False
+        self._wakeup.set()
+        self._thread.join()
+
+        if self._shutdown is not None:
+            reactor.removeSystemEventTrigger(self._shutdown)
+            self._shutdown = None
+
+    def _final_close(self):
+        self._shutdown = None
+        self.close()
+
+    def _query(self, cursor, *args, **kw):
+        cursor.execute(*args, **kw)
+        return cursor.fetchall()
+
+    def _operation(self, cursor, *args, **kw):
+        cursor.execute(*args, **kw)
+
+    def _submit(self, func, args, kw, transaction=True):
+        operation = _Operation(func, args, kw, transaction)
+        if not self._running:
+            operation.deferred.errback(sqlite3.ProgrammingError("The database writer has been closed"))
+            return operation.deferred
+
+        self._queue.append(operation)
+        self._wakeup.set()
+        return operation.deferred
+
+    def _next_group(self):
+        '''
+        Wait for operations and take the next group from the queue.
+        '''
+        queue = self._queue
+        wakeup = self._wakeup
+
+        # Clear the event before checking the queue, so a wakeup in between isn't lost
+        while not queue:
+            if not self._running:
+                return []
+            wakeup.clear()
+            if not queue and self._running:
+                wakeup.wait()
+
+        group = [queue.popleft()]
+        if not group[0].transaction:
+            return group
+
+        deadline = time.time() + self.max_delay
+
+        while len(group) < self.max_group:
+            if queue:
+                # An operation without transaction starts a group of its own
+                if not queue[0].transaction:
+                    break
+                group.append(queue.popleft())
+                continue
+
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self._running:
+                break
+
+            wakeup.clear()
+            if not queue:
+                wakeup.wait(remaining)
+
+        return group
+
+    def _run(self):
+        connection = sqlite3.connect(self.db_location)
+        # Transactions are managed here rather than by the sqlite3 module
+        connection.isolation_level = None
+        if self.open_connection:
+            self.open_connection(connection)
+
+        cursor = connection.cursor()
+
+        while True:
+            group = self._next_group()
+            if not group:
+                break
+
+            self._commit(cursor, group)
+
+        connection.close()
+
+    def _commit(self, cursor, group):
+        '''
+        Run a group of operations in one transaction.
+        '''
+        if not group[0].transaction:
+            try:
+                group[0].result = group[0].func(cursor, *group[0].args, **group[0].kwargs)
+            except:
+                group[0].result = Failure()
+
+            self.operations += 1
+            reactor.callFromThread(self._fire, group)
+            return
+
+        deadline = time.time() + self.busy_retry
+        while True:
+            try:
+                self._run_group(cursor, group)
+                break
+            except:
+                failure = Failure()
+                try:
+                    cursor.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+
+                if _locked(failure.value) and time.time() < deadline:
+                    self.retries += 1
+                    time.sleep(0.05)
+                    continue
+
+                for operation in group:
+                    operation.result = failure
+                break
+
+        self.operations += len(group)
+        self.commits += 1
+        self.largest_group = max(self.largest_group, len(group))
+
+        reactor.callFromThread(self._fire, group)
+
+    def _run_group(self, cursor, group):
+        '''
+        Run the operations of a group and commit them. An operation that fails because the database
+        is locked fails the whole group, so it can be run again.
+        '''
+        cursor.execute("BEGIN")
+        for operation in group:
+            cursor.execute("SAVEPOINT operation")
+            try:
+                operation.result = operation.func(cursor, *operation.args, **operation.kwargs)
+                cursor.execute("RELEASE operation")
+            except Exception, e:
+                if _locked(e):
+                    raise
+                operation.result = Failure()
+                cursor.execute("ROLLBACK TO operation")
+                cursor.execute("RELEASE operation")
+        cursor.execute("COMMIT")
+
+    def _fire(self, group):
+        for operation in group:
+            if isinstance(operation.result, Failure):
+                operation.deferred.errback(operation.result)
+            else:
+                operation.deferred.callback(operation.result)
+
+def _locked(error):
+    '''
+    @return: True when the error means another connection holds a conflicting lock
+    '''
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
@@ -0,0 +1,167 @@
+import time
+from collections import deque
+from twisted.internet import reactor
+from twisted.python import log
+
+# Traffic classes, in order of priority
+CONTROL = 'control'
+TELEMETRY = 'telemetry'
+
+# Message types carrying telemetry, everything else (ready, heartbeats, RPC replies) is control traffic
+TELEMETRY_TYPES = ('\x03', '\x08')
+
+# Ready resets the intern tables of a plugin, it must not overtake telemetry encoded with the old ones
+READY = '\x01'
+
+class _Lane(object):
+    '''
+    Queue for one traffic class, with queueing delay statistics.
+    '''
+    def __init__(self, samples=1000):
+        self.queue = deque()
+        self.delays = deque(maxlen=samples)
+        self.handled = 0
+        self.max_depth = 0
+        self.overflows = 0
+
+    def stats(self):
+        delays = sorted(self.delays)
+        pick = lambda p: delays[min(len(delays) - 1, int(len(delays) * p))] * 1000.0 if delays else 0.0
+        return {'handled': self.handled,
+                'depth': len(self.queue),
+                'max_depth': self.max_depth,
+                'overflows': self.overflows,
+                'delay_p50_ms': pick(0.50),
+                'delay_p99_ms': pick(0.99),
+                'delay_max_ms': delays[-1] * 1000.0 if delays else 0.0}
+
+class PriorityDispatcher(object):
+    '''
+    This class puts received broker messages in a queue per traffic class and dispatches them
+    in order of priority. Control traffic is always handled first, telemetry is handled in
+    rounds of at most telemetry_quantum messages. Between rounds the reactor gets control back,
+    so newly received control messages overtake a telemetry burst.
+    
+    A ready message from a plugin that still has telemetry queued is queued behind that
+    telemetry, so it's decoded before the ready handshake resets the intern tables.
+    The telemetry lane holds at most max_telemetry messages. When it's full, pause_reading is
+    called to stop reading from the broker, which leaves further messages to the ZeroMQ receive
+    high-water mark. resume_reading is called once the lane has been drained to half its size.
+    
+    Handling of telemetry can be held with hold_telemetry, for instance while the database
+    catches up. Control traffic keeps being handled, until the telemetry lane is full and
+    reading stops altogether.
+    '''
+
+    def __init__(self, dispatch, telemetry_quantum=256, max_telemetry=10000):
+        '''
+        Initialize a new PriorityDispatcher.
+        @param dispatch: function that handles a single message
+        @param telemetry_quantum: the maximum number of telemetry messages handled per round
+        @param max_telemetry: the maximum number of queued telemetry messages, 0 means unbounded
+        '''
+        self.dispatch = dispatch
+        self.telemetry_quantum = telemetry_quantum
+        self.max_telemetry = max_telemetry
+
+        # Called to stop and restart reading from the broker when the telemetry lane is full
+        self.pause_reading = None
+        self.resume_reading = None
+        self.full = False
+        self.held = False
+
+        self.lanes = {CONTROL: _Lane(), TELEMETRY: _Lane()}
+        self._round = None
+
+        # Number of queued telemetry messages by routing id
+        self._queued = {}
+
+    def put(self, msg):
+        '''
+        Queue a received message.
+        @param msg: the raw message, a list of frames
+        '''
+        routing_info = msg[0]
+        if msg[2] in TELEMETRY_TYPES or (msg[2] == READY and routing_info in self._queued):
+            lane = self.lanes[TELEMETRY]
+            self._queued[routing_info] = self._queued.get(routing_info, 0) + 1
+        else:
+            lane = self.lanes[CONTROL]
+        lane.queue.append((time.time(), msg))
+
+        if len(lane.queue) > lane.max_depth:
+            lane.max_depth = len(lane.queue)
+
+        if lane is self.lanes[TELEMETRY] and self.max_telemetry and len(lane.queue) >= self.max_telemetry and not self.full:
+            self.full = True
+            lane.overflows += 1
+            if self.pause_reading:
+                self.pause_reading()
+
+        if not self._round:
+            self._round = reactor.callLater(0, self._run)
+
+    def hold_telemetry(self):
+        '''
+        Stop handling telemetry, it stays queued in the telemetry lane.
+        '''
+        self.held = True
+
+    def release_telemetry(self):
+        '''
+        Handle queued telemetry again.
+        '''
+        self.held = False
+        if not self._round:
+            self._round = reactor.callLater(0, self._run)
+
+    def stats(self):
+        '''
+        @return: a dictionary with the queue depth and queueing delay per traffic class
+        '''
+        return dict((name, lane.stats()) for name, lane in self.lanes.iteritems())
+
+    def _run(self):
+        self._round = None
+
+        control = self.lanes[CONTROL]
+        telemetry = self.lanes[TELEMETRY]
+
+        self._drain(control, len(control.queue))
+        self._drain(telemetry, self.telemetry_quantum)
+
+        if self.full and len(telemetry.queue) <= self.max_telemetry / 2:
+            self.full = False
+            if self.resume_reading:
+                self.resume_reading()
+
+        if control.queue or (telemetry.queue and not self.held):
+            self._round = reactor.callLater(0, self._run)
+
+    def _drain(self, lane, count):
+        '''
+        Dispatch up to count messages from a lane.
+        '''
+        queue = lane.queue
+        telemetry = lane is self.lanes[TELEMETRY]
+
+        while queue and count > 0 and not (telemetry and self.held):
+            received, msg = queue.popleft()
+            if telemetry:
+                self._dequeued(msg[0])
+            lane.delays.append(time.time() - received)
+            lane.handled += 1
+            count -= 1
+
+            try:
+                self.dispatch(msg)
+            except Exception:
+                # Don't let one bad message stall the queue
+                log.err()
+
+    def _dequeued(self, routing_info):
+        count = self._queued[routing_info] - 1
+        if count:
+            self._queued[routing_info] = count
+        else:
+            del self._queued[routing_info]
@@ -1,4 +1,5 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
+from houseagent.core.valuetypes import parse_value
 
 # Fix to support both twisted.scheduling and txscheduling (new version)
 try:
@@ -58,6 +59,7 @@ class EventHandler(object):
                     t.condition = param[1]
                 elif param[0] == "condition_value":
                     t.condition_value = param[1]
+                    t.condition_number = parse_value(param[1])[0]
             
             # Handle absolute time directly, and schedule. No need to keep track of this.
             if trigger[1] == "Absolute time":         
@@ -125,6 +127,7 @@ class EventHandler(object):
                     c.condition = param[1]
                 elif param[0] == "condition_value":
                     c.condition_value = param[1]
+                    c.condition_number = parse_value(param[1])[0]
                 elif param[0] == "current_values_id":
                     c.current_values_id = param[1]
 
@@ -143,48 +146,65 @@ class EventHandler(object):
         self._load_triggers()
         self._load_actions()
         
-    @inlineCallbacks
     def device_value_changed(self, value_id, value):
         '''
         Callback from the coordinator when a device value has been changed.
         '''
-        if not value_id:
-            return
+        self.device_values_changed([(value_id, value)])
         
+    def device_values_changed(self, values):
+        '''
+        Callback from the coordinator when a batch of device values has been changed.
+        The triggers are looked up once for the whole batch.
+        @param values: a list of (value_id, value) tuples in arrival order
+        '''
+        triggers = {}
         for t in self._triggers:
-
-            if t.type == "Device value change" and int(t.current_value_id) == int(value_id):
+            if t.type == "Device value change":
+                triggers.setdefault(int(t.current_value_id), []).append(t)
+        
+        if not triggers:
+            return
+        
+        for value_id, value in values:
+            if not value_id:
+                continue
+            
+            value_triggers = triggers.get(int(value_id))
+            if not value_triggers:
+                continue
+            
+            # parse the value once for all its triggers
+            number = parse_value(value)[0]
+            for t in value_triggers:
                 self.log.debug("Found trigger for this value {0}".format(t))
+                self._value_triggered(t, value, number)
+                
+    @inlineCallbacks
+    def _value_triggered(self, t, value, number):
+        '''
+        This function checks a device value change trigger against the new value.
+        When it matches, the conditions are checked and the actions associated with the event are executed.
+        @param t: the trigger
+        @param value: the new value
+        @param number: the new value as a number, None when it isn't one
+        '''
+        matching = _matches(t, value, number)
                 
-                matching = True
+        if matching:
+            # check conditions
+            if t.conditions:           
+                condition_check = yield self._check_conditions(t.event_id)
                 
-                if t.condition == "eq":
-                    if value != t.condition_value:
-                        matching = False
-                elif t.condition == "ne":
-                    if value == t.condition_value:
-                        matching = False
-                elif t.condition == "gt":
-                    if float(value) < float(t.condition_value):
-                        matching = False
-                elif t.condition == "lt":
-                    if float(value) > float(t.condition_value):
-                        matching = False       
-                        
-                if matching:
-                    # check conditions
-                    if t.conditions:           
-                        condition_check = yield self._check_conditions(t.event_id)
-                        
-                        if condition_check:
-                            self._run_actions(t.event_id)
-                        else:
-                            self.log.debug("Conditions do not match")
-                    else:
-                        # no conditions, just run the actions
-                        self._run_actions(t.event_id)
+                if condition_check:
+                    self._run_actions(t.event_id)
                 else:
-                    self.log.debug("Trigger does not match")      
+                    self.log.debug("Conditions do not match")
+            else:
+                # no conditions, just run the actions
+                self._run_actions(t.event_id)
+        else:
+            self.log.debug("Trigger does not match")      
 
     @inlineCallbacks
     def _absolute_time_triggered(self, eventid, conditions):
@@ -213,14 +233,24 @@ class EventHandler(object):
         for a in self._actions:
             if a.event_id == eventid:
                 self.log.debug("Executing action {0}".format(a))
+                d = None
                 if a.type == "Device action" and a.control_type == "CONTROL_TYPE_ON_OFF" and int(a.command) == 1:
-                    self._coordinator.send_poweron(a.plugin_id, a.address, a.control_value_id)
+                    d = self._coordinator.send_poweron(a.plugin_id, a.address, a.control_value_id)
                 elif a.type == "Device action" and a.control_type == "CONTROL_TYPE_ON_OFF" and int(a.command) == 0:
-                    self._coordinator.send_poweroff(a.plugin_id, a.address, a.control_value_id)
+                    d = self._coordinator.send_poweroff(a.plugin_id, a.address, a.control_value_id)
                 elif a.type == "Device action" and a.control_type == "CONTROL_TYPE_THERMOSTAT":
-                    self._coordinator.send_thermostat_setpoint(a.plugin_id, a.address, a.command, a.control_value_id)
+                    d = self._coordinator.send_thermostat_setpoint(a.plugin_id, a.address, a.command, a.control_value_id)
                 elif a.type == "Device action" and a.control_type == "CONTROL_TYPE_DIMMER":
-                    self._coordinator.send_dim(a.plugin_id, a.address, a.command, a.control_value_id)
+                    d = self._coordinator.send_dim(a.plugin_id, a.address, a.command, a.control_value_id)
+                    
+                if d:
+                    d.addErrback(self._action_failed, a)
+                    
+    def _action_failed(self, failure, action):
+        '''
+        Errback for actions that could not be delivered to a plugin.
+        '''
+        self.log.warning("Action {0} failed: {1}".format(action, failure.value))
 
     @inlineCallbacks            
     def _check_conditions(self, eventid):
@@ -239,25 +269,40 @@ class EventHandler(object):
                     # query current value
                     actual_value = yield self.db.query_value_by_valueid(c.current_values_id)
                     
-                    # check conditions, note that these are actually checked reversed...
-                    if c.condition == "eq":
-                        if actual_value[0][0] != c.condition_value:
-                            matching = False
-                    elif c.condition == "ne":
-                        if actual_value[0][0] == c.condition_value:
-                            matching = False
-                    elif c.condition == "gt":
-                        if float(actual_value[0][0]) < float(c.condition_value):
-                            matching = False
-                    elif c.condition == "lt":
-                        if float(actual_value[0][0]) > float(c.condition_value):
-                            matching = False              
+                    # the value is stored with its number, no need to parse it here
+                    if not _matches(c, actual_value[0][0], actual_value[0][2]):
+                        matching = False
                             
             if matching == False:
                 break
         
         returnValue(matching)
 
+def _matches(c, value, number):
+    '''
+    Check a value against the condition of a trigger or condition.
+    eq and ne compare the text of the value, gt and lt its number. A value or condition value
+    that isn't a number never matches gt or lt.
+    @param c: the trigger or condition
+    @param value: the value
+    @param number: the value as a number, None when it isn't one
+    
+    @return: True when the value matches
+    '''
+    if c.condition == "eq":
+        return value == c.condition_value
+    elif c.condition == "ne":
+        return value != c.condition_value
+    elif c.condition in ("gt", "lt"):
+        if number is None or c.condition_number is None:
+            return False
+        # note that these are checked reversed, equal values match both
+        if c.condition == "gt":
+            return not number < c.condition_number
+        return not number > c.condition_number
+    
+    return True
+
 class Condition(object):
     '''
     This class is a skeleton class for a condition.
@@ -267,6 +312,7 @@ class Condition(object):
         self.event_id = event_id
         self.condition = None
         self.condition_value = None
+        self.condition_number = None
         self.current_values_id = None
         
         # Only used for web page output
@@ -285,6 +331,7 @@ class Trigger(object):
         self.current_value_id = None
         self.condition = None
         self.condition_value = None
+        self.condition_number = None
         
         # Only used for web page output
         self.device = None
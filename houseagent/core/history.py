@@ -1,4 +1,4 @@
-from twisted.internet import task
+from twisted.internet import reactor, task
 from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.enterprise.adbapi import ConnectionPool
@@ -17,6 +17,7 @@ import datetime
 import os
 import sys
 import sqlite3
+import time
 
 # TODO:
 # * better logging
@@ -117,25 +118,120 @@ class HistoryCollector():
         self.db.collect_history_values(value_id)
 
 
-    def cleanup(self):
-        self.log.debug("Cleaning old values from history_values table.")
-        self.db.cleanup_history_values()
-
-
     def do(self, result):
         for val_id in self._schedules:
             schedule = self._resolve_schedule(val_id)
             period = self._resolve_period(schedule)
             self._start_schedule(val_id, schedule, period)
 
-        # Try to cleanup history_values every 12 hours
-        t = task.LoopingCall(self.cleanup)
-        t.start(43200, False)
-
         self.log.debug("Sheduled tasks: %s" % self._scheduled_tasks)
 
 
 
+class HistoryRetention():
+    '''
+    Deletes expired history values, following the retention policies stored in the database.
+
+    The retention of a value is the policy of the value, else the policy of its history type,
+    else the default policy. History of values that don't exist anymore follows the default
+    policy, without a default policy it's kept. The history covered by the default policy is
+    deleted in one pass over all values.
+    Expired history values are deleted in batches of at most batch_size rows with a pause after
+    every full batch, so the database writer is never held up for long. Afterwards the freed
+    pages are returned to the file system, vacuum_pages at a time.
+    '''
+    def __init__(self, database, interval=43200, batch_size=1000, batch_pause=0.05, vacuum_pages=256):
+        '''
+        @param database: the storage engine
+        @param interval: seconds between runs, 0 disables them
+        @param batch_size: the maximum number of history values deleted at once
+        @param batch_pause: seconds between batches
+        @param vacuum_pages: the maximum number of pages returned at once, 0 disables vacuuming
+        '''
+        self.db = database
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.vacuum_pages = vacuum_pages
+
+        self.log = pluginapi.Logging("Retention")
+
+        # Statistics of the last run
+        self.last_run = None
+
+        if interval > 0:
+            t = task.LoopingCall(self.run)
+            t.start(interval, False)
+
+    @inlineCallbacks
+    def run(self):
+        '''
+        Delete the expired history values and vacuum.
+
+        @return: a Twisted deferred which fires with the statistics of the run
+        '''
+        started = time.time()
+
+        policies = yield self.db.query_retention_policies()
+        by_value = {}
+        by_type = {}
+        default = None
+        for id, value_id, history_type_id, days in policies:
+            if value_id is not None:
+                by_value[value_id] = days
+            elif history_type_id is not None:
+                by_type[history_type_id] = days
+            else:
+                default = days
+
+        deleted = 0
+        pages = 0
+        try:
+            schedules = yield self.db.query_history_schedules()
+            for value_id, name, period_id, type_id in schedules:
+                days = by_value.get(value_id, by_type.get(type_id))
+                if days is not None:
+                    deleted += yield self._delete(days, value_id)
+
+            if default is not None:
+                deleted += yield self._delete(default)
+
+            if self.vacuum_pages > 0:
+                pages = yield self._vacuum()
+        except Exception:
+            self.log.error("History retention failed (%s)" % sys.exc_info()[1])
+
+        self.last_run = {"deleted": deleted, "pages": pages, "seconds": time.time() - started}
+        self.log.info("History retention deleted %d history values and returned %d pages in %.1f s" %
+                      (deleted, pages, self.last_run["seconds"]))
+        returnValue(self.last_run)
+
+    @inlineCallbacks
+    def _delete(self, days, value_id=None):
+        before = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat(' ').split('.')[0]
+
+        deleted = 0
+        while True:
+            count = yield self.db.delete_history_values(before, self.batch_size, value_id)
+            deleted += count
+            if count < self.batch_size:
+                break
+            yield task.deferLater(reactor, self.batch_pause, lambda: None)
+
+        returnValue(deleted)
+
+    @inlineCallbacks
+    def _vacuum(self):
+        returned = 0
+        while True:
+            count = yield self.db.incremental_vacuum(self.vacuum_pages)
+            returned += count
+            if count < self.vacuum_pages:
+                break
+            yield task.deferLater(reactor, self.batch_pause, lambda: None)
+
+        returnValue(returned)
+
+
 class HistoryAggregator():
 
     def __init__(self, database):
@@ -315,6 +411,8 @@ class DatabaseArchive():
         """
         if os.path.exists(self.db_path):
             self.dbpool = ConnectionPool(self.type, self.db_path, check_same_thread=False, cp_max=1)
+            # archives created by older versions lack the indexes
+            self.dbpool.runInteraction(self._create_archive_indexes)
         else:
             self.create_archive_db()
             try:
@@ -347,9 +445,17 @@ class DatabaseArchive():
             txn.execute("CREATE TABLE day (id INTEGER, value REAL DEFAULT 0.00, min REAL DEFAULT 0.00, avg REAL DEFAULT 0.00, max REAL DEFAULT 0.00, type VARCHAR(50), date_from DATETIME, date_to DATETIME);")
             txn.execute("CREATE TABLE month (id INTEGER, value REAL DEFAULT 0.00, min REAL DEFAULT 0.00, avg REAL DEFAULT 0.00, max REAL DEFAULT 0.00, type VARCHAR(50), date_from DATETIME, date_to DATETIME);")
             txn.execute("CREATE TABLE year (id INTEGER, value REAL DEFAULT 0.00, min REAL DEFAULT 0.00, avg REAL DEFAULT 0.00, max REAL DEFAULT 0.00, type VARCHAR(50), date_from DATETIME, date_to DATETIME);")
+            self._create_archive_indexes(txn)
         except:
             self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
 
+    def _create_archive_indexes(self, txn):
+        '''
+        The aggregations and daily data queries select the rows of one value id, by date.
+        '''
+        for table in ('day', 'month', 'year'):
+            txn.execute("CREATE INDEX IF NOT EXISTS idx_%s_id_date_from ON %s (id, date_from);" % (table, table))
+
 
     def attach_main_db(self, main_db):
         """
@@ -379,7 +485,7 @@ class DatabaseArchive():
                                ROUND(MAX(value),2) AS max, \
                                '%s', '%s', '%s'\
                         FROM houseagent.history_values \
-                        WHERE value_id='%s' AND created_at >= '%s' AND created_at < '%s';" \
+                        WHERE value_id='%s' AND created_at >= '%s' AND created_at < '%s' AND value IS NOT NULL;" \
                         % (val_type, date_from, date_to, val_id, date_from, date_to))
 
 
@@ -417,7 +523,7 @@ class DatabaseArchive():
 
     def query_history_values(self, val_id):
         """return all 'current' historic values for given value id"""
-        return self.dbpool.runQuery("SELECT value, STRFTIME('%s', created_at) AS ts FROM history_values WHERE value_id=?;", [val_id])
+        return self.dbpool.runQuery("SELECT value, STRFTIME('%s', created_at) AS ts FROM history_values WHERE value_id=? AND value IS NOT NULL;", [val_id])
 
     def query_archive_daily_data(self, val_id):
         return self.dbpool.runQuery("SELECT value, min, avg, max, STRFTIME('%s', date_from) AS ts FROM day WHERE id=?;", [val_id])
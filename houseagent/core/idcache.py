@@ -0,0 +1,196 @@
+class IdCache(object):
+    '''
+    Write-through cache of the ids needed to write a value update, so an update of a known value
+    doesn't have to read from the database.
+
+    Maps (plugin_id, address) to the device id and (device_id, name) to a (value_id, history_type_id,
+    history_period_id) tuple. A device id of None means the device doesn't exist.
+
+    The cache is only used from the reactor thread. Database interactions get a snapshot of the
+    entries they need, fill in what is missing while running in the pool thread, and the snapshot
+    is merged back when the interaction completes. Every invalidation bumps the generation, a
+    snapshot taken before an invalidation is not merged back.
+    '''
+
+    def __init__(self):
+        self.devices = {}
+        self.values = {}
+        self.generation = 0
+
+        # Reverse lookups used for invalidation by id
+        self._device_keys = {}
+        self._value_keys = {}
+
+    @staticmethod
+    def device_key(plugin_id, address):
+        '''
+        @return: the key of a device, plugin ids arrive both as integer and string
+        '''
+        try:
+            plugin_id = int(plugin_id)
+        except (TypeError, ValueError):
+            pass
+
+        if not isinstance(address, basestring):
+            address = unicode(address)
+
+        return (plugin_id, address)
+
+    def load(self, dbpool):
+        '''
+        Fill the cache with all devices and values in a single query.
+        @param dbpool: the database connection pool
+
+        @return: a Twisted deferred which fires when the cache has been filled
+        '''
+        devices = {}
+        values = {}
+
+        def loaded(result):
+            for device_id, plugin_id, address, value_id, name, history_type, history_period in result:
+                devices[self.device_key(plugin_id, address)] = device_id
+                if value_id is not None:
+                    values[(device_id, name)] = (value_id, history_type, history_period)
+
+        d = dbpool.runQuery("SELECT devices.id, devices.plugin_id, devices.address, current_values.id, " +
+                            "current_values.name, current_values.history_type_id, current_values.history_period_id " +
+                            "FROM devices LEFT OUTER JOIN current_values ON (current_values.device_id = devices.id)")
+        d.addCallback(loaded)
+        d.addCallback(self.merge, devices, values, self.generation)
+        return d
+
+    def value(self, plugin_id, address, name):
+        '''
+        @return: the cached (value_id, history_type_id, history_period_id) tuple of a value, or None
+        '''
+        device_id = self.devices.get(self.device_key(plugin_id, address))
+        if device_id is None:
+            return None
+
+        return self.values.get((device_id, name))
+
+    def snapshot(self, updates):
+        '''
+        Copy the entries needed to write a batch of value updates.
+        @param updates: a list of (name, value, pluginid, address, time) tuples
+
+        @return: a (devices, values) tuple of dictionaries, to be passed to the database interaction
+        '''
+        devices = {}
+        values = {}
+
+        for name, value, plugin_id, address, time in updates:
+            device_key = self.device_key(plugin_id, address)
+            if device_key not in self.devices:
+                continue
+
+            device_id = devices[device_key] = self.devices[device_key]
+            if device_id is not None and (device_id, name) in self.values:
+                values[(device_id, name)] = self.values[(device_id, name)]
+
+        return devices, values
+
+    def merge(self, result, devices, values, generation):
+        '''
+        Merge the entries resolved by a database interaction into the cache, meant to be used
+        as a callback.
+        @param result: the result of the interaction, which is passed on
+        @param devices: the device entries of the snapshot
+        @param values: the value entries of the snapshot
+        @param generation: the generation the snapshot was taken at
+        '''
+        if generation != self.generation:
+            # The database changed in the meantime, the entries can be stale
+            return result
+
+        for key, device_id in devices.iteritems():
+            self.devices[key] = device_id
+            if device_id is not None:
+                self._device_keys[device_id] = key
+
+        for key, value in values.iteritems():
+            self.values[key] = value
+            self._value_keys[value[0]] = key
+
+        return result
+
+    def device_saved(self, plugin_id, address, id=None):
+        '''
+        Invalidate the entries of a device that has been added or updated.
+        @param plugin_id: the new plugin id of the device
+        @param address: the new address of the device
+        @param id: the id of the device, None for a new device
+        '''
+        self.generation += 1
+
+        if id is not None:
+            old_key = self._device_keys.pop(int(id), None)
+            if old_key is not None:
+                self.devices.pop(old_key, None)
+
+        # Drops a cached "device doesn't exist" entry as well
+        self.devices.pop(self.device_key(plugin_id, address), None)
+
+    def device_deleted(self, id):
+        '''
+        Invalidate the entries of a device and its values.
+        @param id: the id of the device
+        '''
+        self.generation += 1
+        id = int(id)
+
+        key = self._device_keys.pop(id, None)
+        if key is not None:
+            self.devices.pop(key, None)
+
+        for key in [key for key in self.values if key[0] == id]:
+            self._value_keys.pop(self.values.pop(key)[0], None)
+
+    def plugin_deleted(self, plugin_id):
+        '''
+        Invalidate the entries of all devices of a plugin.
+        @param plugin_id: the id of the plugin
+        '''
+        for key, device_id in self.devices.items():
+            if key[0] == int(plugin_id):
+                if device_id is None:
+                    self.generation += 1
+                    del self.devices[key]
+                else:
+                    self.device_deleted(device_id)
+
+    def value_deleted(self, id=None, name=None, device_id=None):
+        '''
+        Invalidate the entry of a value, by id or by name and device id.
+        '''
+        self.generation += 1
+
+        if id is not None:
+            key = self._value_keys.pop(int(id), None)
+            if key is not None:
+                self.values.pop(key, None)
+        else:
+            value = self.values.pop((int(device_id), name), None)
+            if value is not None:
+                self._value_keys.pop(value[0], None)
+
+    def history_changed(self, id, history_type, history_period):
+        '''
+        Write the new history settings of a value through to the cache.
+        @param id: the id of the value
+        @param history_type: the new history type id
+        @param history_period: the new history period id
+        '''
+        self.generation += 1
+
+        key = self._value_keys.get(int(id))
+        if key is not None:
+            self.values[key] = (int(id), _optional_id(history_type), _optional_id(history_period))
+
+def _optional_id(id):
+    '''
+    @return: a foreign key as stored in the database, ids from web forms arrive as strings
+    '''
+    if id in (None, ''):
+        return None
+    return int(id)
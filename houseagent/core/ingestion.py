@@ -0,0 +1,228 @@
+from collections import deque
+import sys
+import traceback
+from twisted.internet import reactor, defer
+
+# Overload policies, applied when the queue is full
+BLOCK = 'block'               # hold value updates in the broker until the queue has been written
+DROP_OLDEST = 'drop_oldest'   # drop the oldest queued update of the same device
+LATEST = 'latest'             # replace the queued update of the same device value
+POLICIES = (BLOCK, DROP_OLDEST, LATEST)
+
+class ValueIngestor(object):
+    '''
+    This class implements the ingestion stage between the broker and the database.
+    Decoded value updates are queued and written to the database in batches, either
+    when the flush interval expires or when the queue reaches the flush size.
+    Each batch is written as a single database transaction.
+    
+    The queue holds at most max_queue updates, when it's full the overload policy decides
+    what happens with new updates. Updates that are dropped or replaced leave a hole in the 
+    queue, which is skipped when the batch is written.
+    '''
+    
+    def __init__(self, log, database, committed, flush_size=500, flush_interval=0.005, max_queue=0, policy=BLOCK):
+        '''
+        Initialize a new ValueIngestor.
+        @param log: a reference to the HouseAgent logger
+        @param database: an instance of the HouseAgent database
+        @param committed: function called after a batch has been committed, with a list of 
+                          (value_id, value) tuples in arrival order
+        @param flush_size: the number of queued updates that triggers an immediate flush
+        @param flush_interval: the maximum time in seconds an update stays queued
+        @param max_queue: the maximum number of queued updates, 0 means unbounded
+        @param policy: the overload policy, one of POLICIES
+        '''
+        if policy not in POLICIES:
+            raise ValueError("Unknown overload policy %r, use one of %s" % (policy, ', '.join(POLICIES)))
+        
+        self.log = log
+        self.db = database
+        self.committed = committed
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.policy = policy
+        
+        # Called to hold and release value updates in the broker with the block policy
+        self.pause_reading = None
+        self.resume_reading = None
+        
+        self._reset_queue()
+        self._flush_call = None
+        self._flushing = False
+        self._flush_waiters = []
+        self._paused = False
+        
+        self.dropped = 0
+        self.coalesced = 0
+        self.paused = 0
+        
+        # Write out whatever is still queued before the reactor stops
+        reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+        
+    def put(self, name, value, plugin_id, address, time=None):
+        '''
+        Queue a value update.
+        @param name: the name of the value
+        @param value: the actual value of the value
+        @param plugin_id: the id of the plugin which holds the device information
+        @param address: the address of the device
+        @param time: the time at which the update has been received
+        '''
+        self.put_many([(name, value, plugin_id, address, time)])
+        
+    def put_many(self, updates):
+        '''
+        Queue a batch of value updates. 
+        The updates are never split, they end up in the same database transaction.
+        @param updates: a list of (name, value, plugin_id, address, time) tuples
+        '''
+        for update in updates:
+            if self.max_queue and self._live >= self.max_queue and self.policy != BLOCK:
+                self._shed(update)
+            else:
+                self._append(update)
+        
+        if self.max_queue and self._live >= self.max_queue and self.policy == BLOCK and not self._paused:
+            self.log.warning("Ingestion::Queue full (%d updates), holding value updates in the broker..." % self._live)
+            self._paused = True
+            self.paused += 1
+            if self.pause_reading:
+                self.pause_reading()
+        
+        if self._live >= self.flush_size:
+            self.flush()
+        elif not self._flush_call:
+            self._flush_call = reactor.callLater(self.flush_interval, self.flush)
+    
+    def stats(self):
+        '''
+        @return: a dictionary with ingestion counters
+        '''
+        return {'queued': self._live,
+                'policy': self.policy,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'paused': self.paused}
+    
+    def _reset_queue(self):
+        self._queue = []
+        self._live = 0
+        self._head = 0
+        self._by_device = {}
+        self._by_value = {}
+    
+    def _append(self, update):
+        index = len(self._queue)
+        self._queue.append(update)
+        self._live += 1
+        
+        name, value, plugin_id, address = update[:4]
+        if self.policy == DROP_OLDEST:
+            self._by_device.setdefault((plugin_id, address), deque()).append(index)
+        elif self.policy == LATEST:
+            self._by_value[(plugin_id, address, name)] = index
+    
+    def _remove(self, index):
+        update = self._queue[index]
+        self._queue[index] = None
+        self._live -= 1
+        
+        if self.policy == LATEST:
+            key = (update[2], update[3], update[0])
+            if self._by_value.get(key) == index:
+                del self._by_value[key]
+    
+    def _shed(self, update):
+        '''
+        Apply the overload policy to a new update while the queue is full.
+        '''
+        name, value, plugin_id, address = update[:4]
+        
+        if self.policy == LATEST:
+            index = self._by_value.get((plugin_id, address, name))
+            if index is not None:
+                self._queue[index] = update
+                self.coalesced += 1
+                return
+        else:
+            indices = self._by_device.get((plugin_id, address))
+            while indices:
+                index = indices.popleft()
+                if self._queue[index] is not None:
+                    self._remove(index)
+                    self.dropped += 1
+                    self._append(update)
+                    return
+        
+        # Nothing queued for this device (value), make room by dropping the oldest update
+        while self._queue[self._head] is None:
+            self._head += 1
+        self._remove(self._head)
+        self.dropped += 1
+        self._append(update)
+            
+    def flush(self):
+        '''
+        Write all queued updates to the database in one transaction.
+        If a flush is already running, the queued updates are written as soon as it completes.
+        
+        @return: a Twisted deferred which fires when the batch has been committed, or when a running
+                 flush and the flush of everything queued meanwhile have completed
+        '''
+        if self._flush_call and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        
+        if self._flushing:
+            waiter = defer.Deferred()
+            self._flush_waiters.append(waiter)
+            return waiter
+        
+        if not self._live:
+            return defer.succeed(None)
+        
+        if self._live == len(self._queue):
+            batch = self._queue
+        else:
+            batch = [update for update in self._queue if update is not None]
+        self._reset_queue()
+        self._flushing = True
+        
+        d = self.db.update_or_add_values(batch)
+        d.addCallbacks(self._cb_flushed, self._eb_flushed, callbackArgs=(batch,), errbackArgs=(batch,))
+        d.addBoth(self._flush_done)
+        return d
+    
+    def _cb_flushed(self, value_ids, batch):
+        self.log.debug("Ingestion::Committed batch of %d value updates" % len(batch))
+        
+        # The batch is committed, a failing consumer must not turn that into a lost failure
+        try:
+            self.committed([(value_id, update[1]) for value_id, update in zip(value_ids, batch)])
+        except Exception:
+            self.log.error("Ingestion::Failed to process committed batch of %d value updates (%s)" % (len(batch), sys.exc_info()[1]))
+            self.log.debug(traceback.format_exc())
+        
+    def _eb_flushed(self, failure, batch):
+        self.log.error("Ingestion::Failed to write batch of %d value updates (%s)" % (len(batch), failure.getErrorMessage()))
+        
+    def _flush_done(self, result):
+        self._flushing = False
+        
+        if self._paused and self._live < self.max_queue:
+            self.log.info("Ingestion::Queue below limit, releasing value updates in the broker...")
+            self._paused = False
+            if self.resume_reading:
+                self.resume_reading()
+        
+        # Updates that arrived during the flush, callers waiting for them get their result when
+        # they have been written as well
+        waiters, self._flush_waiters = self._flush_waiters, []
+        if waiters or self._live >= self.flush_size:
+            d = self.flush()
+            for waiter in waiters:
+                d.addBoth(lambda result, waiter=waiter: waiter.callback(None))
+        elif self._live and not self._flush_call:
+            self._flush_call = reactor.callLater(self.flush_interval, self.flush)
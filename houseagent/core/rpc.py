@@ -0,0 +1,175 @@
+import heapq
+import itertools
+import time
+from uuid import uuid4
+from twisted.internet import reactor, defer
+from houseagent.utils.error import RPCTimeout, RPCLimitExceeded
+
+class PendingRequest(object):
+    '''
+    Skeleton class for an outstanding RPC request.
+    '''
+    def __init__(self, message_id, routing_info, deferred, deadline):
+        self.message_id = message_id
+        self.routing_info = routing_info
+        self.deferred = deferred
+        self.deadline = deadline
+
+class RPCManager(object):
+    '''
+    This class keeps track of RPC requests sent to plugins.
+    Every request gets a unique message id and a deadline. Deadlines are kept in a heap
+    which is reaped by a single timer, requests that are not answered in time are failed
+    with an RPCTimeout error.
+    '''
+
+    def __init__(self, send, timeout=10.0, max_in_flight=32):
+        '''
+        Initialize a new RPCManager.
+        @param send: function used to send a list of message frames
+        @param timeout: the number of seconds to wait for a reply
+        @param max_in_flight: the maximum number of outstanding requests per plugin
+        '''
+        self.send = send
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+
+        # Message ids are unique within this coordinator session, the session prefix
+        # makes sure late replies to a previous session are never mistaken for a new request
+        self._session = uuid4().hex[:8]
+        self._counter = itertools.count(1)
+
+        self._requests = {}
+        self._by_plugin = {}
+        self._deadlines = []
+        self._reaper = None
+
+        self.completed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def next_id(self):
+        '''
+        Get a unique message ID.
+
+        @return: a unique message ID
+        '''
+        return 'msg_%s_%d' % (self._session, self._counter.next())
+
+    def call(self, routing_info, message):
+        '''
+        Send an RPC request to a plugin.
+        @param routing_info: the routing information of the plugin
+        @param message: the encoded message to send
+
+        @return: a Twisted deferred which fires with the reply, or fails with RPCTimeout
+                 or RPCLimitExceeded
+        '''
+        outstanding = self._by_plugin.setdefault(routing_info, set())
+        if len(outstanding) >= self.max_in_flight:
+            self.rejected += 1
+            return defer.fail(RPCLimitExceeded(routing_info))
+
+        message_id = self.next_id()
+        request = PendingRequest(message_id, routing_info, defer.Deferred(), time.time() + self.timeout)
+
+        self._requests[message_id] = request
+        outstanding.add(message_id)
+        heapq.heappush(self._deadlines, (request.deadline, message_id))
+        self._schedule_reaper()
+
+        self.send([routing_info, b'', chr(4), message_id, message])
+        return request.deferred
+
+    def handle_reply(self, message_id, result):
+        '''
+        Handle a reply to an RPC request.
+        @param message_id: the message id of the request
+        @param result: the decoded reply
+
+        @return: True when the reply belonged to an outstanding request, otherwise False
+        '''
+        request = self._pop(message_id)
+        if not request:
+            return False
+
+        self.completed += 1
+        request.deferred.callback(result)
+        return True
+
+    def fail_pending(self, routing_info, error):
+        '''
+        Fail all outstanding requests for a plugin.
+        @param routing_info: the routing information of the plugin
+        @param error: the exception to fail the requests with
+        '''
+        for message_id in list(self._by_plugin.get(routing_info, ())):
+            request = self._pop(message_id)
+            self.failed += 1
+            request.deferred.errback(error)
+
+    def pending(self, routing_info=None):
+        '''
+        @return: the number of outstanding requests, for a single plugin when routing_info is specified
+        '''
+        if routing_info is None:
+            return len(self._requests)
+        return len(self._by_plugin.get(routing_info, ()))
+
+    def stats(self):
+        '''
+        @return: a dictionary with RPC counters
+        '''
+        return {'in_flight': len(self._requests),
+                'completed': self.completed,
+                'timed_out': self.timed_out,
+                'rejected': self.rejected,
+                'failed': self.failed}
+
+    def _pop(self, message_id):
+        request = self._requests.pop(message_id, None)
+        if request:
+            outstanding = self._by_plugin[request.routing_info]
+            outstanding.discard(message_id)
+            if not outstanding:
+                del self._by_plugin[request.routing_info]
+        return request
+
+    def _schedule_reaper(self):
+        '''
+        Make sure the reaper runs at the earliest deadline in the heap.
+        '''
+        # Drop deadlines of requests that already completed
+        while self._deadlines and self._deadlines[0][1] not in self._requests:
+            heapq.heappop(self._deadlines)
+
+        if not self._deadlines:
+            if self._reaper and self._reaper.active():
+                self._reaper.cancel()
+            self._reaper = None
+            return
+
+        deadline = self._deadlines[0][0]
+        if self._reaper and self._reaper.active():
+            if self._reaper.getTime() <= deadline:
+                return
+            self._reaper.cancel()
+
+        self._reaper = reactor.callLater(max(0, deadline - time.time()), self._reap)
+
+    def _reap(self):
+        '''
+        Fail all requests of which the deadline has passed.
+        '''
+        self._reaper = None
+        now = time.time()
+
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, message_id = heapq.heappop(self._deadlines)
+            request = self._pop(message_id)
+            if request:
+                self.timed_out += 1
+                request.deferred.errback(RPCTimeout(message_id))
+
+        self._schedule_reaper()
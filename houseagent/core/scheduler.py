@@ -0,0 +1,102 @@
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+class _Command(object):
+    '''
+    Skeleton class for a command, together with the deferreds of all callers waiting for its result.
+    '''
+    def __init__(self, plugin_guid, content, deferred):
+        self.plugin_guid = plugin_guid
+        self.content = content
+        self.waiters = [deferred]
+
+class CommandScheduler(object):
+    '''
+    This class sits in front of the command dispatch to plugins and coalesces commands per device value.
+    At most one command per (plugin, address, value_id) is in flight. Commands issued in the meantime
+    are queued, a newer command replaces the queued one (last writer wins). Callers of a replaced
+    command get the result of the command that replaced it.
+    '''
+
+    def __init__(self, dispatch):
+        '''
+        Initialize a new CommandScheduler.
+        @param dispatch: function that sends a command to a plugin, called with the plugin guid and
+                         the command content, returning a Twisted deferred
+        '''
+        self.dispatch = dispatch
+
+        self._in_flight = {}
+        self._queued = {}
+
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0
+
+    def submit(self, plugin_guid, content):
+        '''
+        Submit a command for a plugin.
+        @param plugin_guid: the guid of the plugin
+        @param content: the command content, commands without an address are sent right away
+
+        @return: a Twisted deferred which fires with the result of the command, or of the command
+                 that superseded it
+        '''
+        self.submitted += 1
+
+        if content.get('address') is None:
+            self.sent += 1
+            return self.dispatch(plugin_guid, content)
+
+        key = (plugin_guid, content['address'], content.get('value_id'))
+        d = defer.Deferred()
+
+        if key not in self._in_flight:
+            self._send(key, _Command(plugin_guid, content, d))
+            return d
+
+        queued = self._queued.get(key)
+        command = _Command(plugin_guid, content, d)
+        if queued:
+            # Last writer wins, the callers of the queued command wait for the new one
+            self.coalesced += 1
+            command.waiters = queued.waiters + command.waiters
+
+        self._queued[key] = command
+        return d
+
+    def pending(self):
+        '''
+        @return: the number of commands queued behind an in-flight command
+        '''
+        return len(self._queued)
+
+    def stats(self):
+        '''
+        @return: a dictionary with command scheduler counters
+        '''
+        return {'submitted': self.submitted,
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._in_flight),
+                'queued': len(self._queued)}
+
+    def _send(self, key, command):
+        self._in_flight[key] = command
+        self.sent += 1
+        self.dispatch(command.plugin_guid, command.content).addBoth(self._completed, key, command)
+
+    def _completed(self, result, key, command):
+        del self._in_flight[key]
+
+        # Send the newest queued command before the callers get control, so a command they issue
+        # from their callback is queued behind it
+        queued = self._queued.pop(key, None)
+        if queued:
+            self._send(key, queued)
+
+        for d in command.waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
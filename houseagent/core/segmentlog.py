@@ -0,0 +1,158 @@
+import json
+import os
+import struct
+import zlib
+from twisted.internet import defer, threads
+from twisted.internet.task import LoopingCall
+
+# Record header: payload length and CRC-32 of the payload
+_HEADER = struct.Struct('<II')
+
+# Extension of segment files, segments are named after their sequence number
+_EXTENSION = '.seg'
+
+# Buffered bytes that trigger a write before the sync interval has elapsed
+_MAX_BUFFER = 65536
+
+class SegmentLog(object):
+    '''
+    Append-only log of records stored in sequential segment files, to spare flash storage.
+
+    Records are buffered in memory and written with a single sequential write and fsync every
+    sync_interval seconds. Every record carries its length and a CRC-32 checksum, so a record
+    torn by a power loss is detected when the log is read back. A segment is sealed once it has
+    grown to segment_size bytes or when it is sealed explicitly, the next write starts a new
+    segment. Sealed segments are removed by their reader once they have been processed.
+
+    A record is a list of JSON values. Segments found at startup are sealed, read them back with
+    read_segment before removing them.
+    '''
+
+    def __init__(self, directory, segment_size=262144, sync_interval=10, log=None):
+        '''
+        @param directory: the directory holding the segment files, it is created when missing
+        @param segment_size: the size in bytes from which a segment is sealed
+        @param sync_interval: seconds between writes of the buffered records, 0 writes them on seal and close only
+        @param log: logging object
+        '''
+        self.directory = directory
+        self.segment_size = segment_size
+        self.log = log
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        ## Paths of the sealed segments, oldest first
+        self.sealed = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                       if name.endswith(_EXTENSION)]
+        self._sequence = int(os.path.basename(self.sealed[-1])[:-len(_EXTENSION)]) if self.sealed else 0
+
+        self._buffer = []
+        self._buffered = 0
+        self._file = None
+
+        # Writes and seals run in a thread, one at a time and in order
+        self._lock = defer.DeferredLock()
+
+        if sync_interval > 0:
+            self._sync = LoopingCall(self.sync)
+            self._sync.start(sync_interval, False)
+
+    def append(self, *record):
+        '''
+        Add a record to the log, it is written by the next sync.
+        '''
+        payload = json.dumps(record, separators=(',', ':'))
+        self._buffer.append(_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+        self._buffered += _HEADER.size + len(payload)
+
+        if self._buffered >= _MAX_BUFFER:
+            self.sync()
+
+    def sync(self):
+        '''
+        Write the buffered records to the active segment.
+
+        @return: a Twisted deferred which fires once the records are on disk
+        '''
+        if not self._buffer:
+            return self._lock.run(defer.succeed, None)
+
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        d = self._lock.run(threads.deferToThread, self._write, data)
+        d.addErrback(self._failed, 'write')
+        return d
+
+    def seal(self):
+        '''
+        Write the buffered records and seal the active segment.
+
+        @return: a Twisted deferred which fires with the paths of the sealed segments
+        '''
+        self.sync()
+        d = self._lock.run(threads.deferToThread, self._seal)
+        d.addErrback(self._failed, 'seal')
+        return d.addCallback(lambda _: list(self.sealed))
+
+    def remove(self, path):
+        '''
+        Remove a sealed segment once its records have been processed.
+        '''
+        self.sealed.remove(path)
+        os.remove(path)
+
+    def _write(self, data):
+        if self._file is None:
+            self._sequence += 1
+            self._file = open(os.path.join(self.directory, '%010d%s' % (self._sequence, _EXTENSION)), 'ab')
+
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        if self._file.tell() >= self.segment_size:
+            self._seal()
+
+    def _seal(self):
+        if self._file is not None:
+            self._file.close()
+            self.sealed.append(self._file.name)
+            self._file = None
+
+    def _failed(self, failure, action):
+        if self.log:
+            self.log.error("Unable to %s the segment log in %s (%s)" % (action, self.directory, failure.getErrorMessage()))
+
+def read_segment(path, log=None):
+    '''
+    Read the records of a segment. Reading stops at the first incomplete or corrupt record, which
+    is what a write interrupted by a power loss leaves behind.
+    @param path: the path of the segment file
+    @param log: logging object, corrupt records are reported to it
+
+    @return: a list of records
+    '''
+    with open(path, 'rb') as segment:
+        data = segment.read()
+
+    records = []
+    offset = 0
+    while offset < len(data):
+        if offset + _HEADER.size > len(data):
+            break
+
+        length, checksum = _HEADER.unpack_from(data, offset)
+        payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != checksum:
+            break
+
+        records.append(json.loads(payload))
+        offset += _HEADER.size + length
+
+    if offset < len(data) and log:
+        log.warning("Segment %s: ignoring %d bytes after the last valid record" % (path, len(data) - offset))
+
+    return records
@@ -0,0 +1,312 @@
+class Storage():
+    '''
+    The storage interface of HouseAgent: the operations the coordinator, the event engine, the
+    history collector and the web interface use. Database implements it on SQLite and
+    MemoryDatabase in memory, other engines can be plugged in by implementing it as well.
+
+    Every operation returns a Twisted deferred. Queries fire with a list of rows, each row is
+    a tuple with the columns documented for the query, in that order. Ids are integers, a
+    name column is None when the row it refers to doesn't exist (an outer join).
+
+    The coordinator and histcollector attributes are set by those components. The storage
+    engine notifies the coordinator of CRUD actions: it reloads its plugins when a plugin
+    changes (load_plugins) and forwards device changes to the plugins (send_crud_update).
+    view is the ValueView serving the /values API, or None when the web interface serves
+    query_values directly.
+    '''
+    coordinator = None
+    histcollector = None
+    view = None
+
+    # Plugins
+    def register_plugin(self, name, uuid, location):
+        '''
+        Add a plugin.
+        @param uuid: the authentication code of the plugin
+        @param location: the location id, or None
+        '''
+        raise NotImplementedError
+
+    def update_plugin(self, id, name, location):
+        raise NotImplementedError
+
+    def del_plugin(self, id):
+        raise NotImplementedError
+
+    def query_plugins(self):
+        '''
+        @return: rows of (name, authcode, id, location name, location id)
+        '''
+        raise NotImplementedError
+
+    # Locations
+    def add_location(self, name, parent):
+        '''
+        Add a location.
+        @param parent: the id of the parent location, or None
+        '''
+        raise NotImplementedError
+
+    def update_location(self, id, name, parent):
+        raise NotImplementedError
+
+    def del_location(self, id):
+        raise NotImplementedError
+
+    def query_locations(self):
+        '''
+        @return: rows of (id, name, parent name)
+        '''
+        raise NotImplementedError
+
+    # Devices
+    def save_device(self, name, address, plugin_id, location_id, id=None):
+        '''
+        Add a device, or update it when id is given.
+        '''
+        raise NotImplementedError
+
+    def del_device(self, id):
+        raise NotImplementedError
+
+    def query_devices(self):
+        '''
+        @return: rows of (id, name, address, plugin name, location name), of the devices of existing plugins
+        '''
+        raise NotImplementedError
+
+    def query_devices_simple(self):
+        '''
+        @return: rows of (id, name)
+        '''
+        raise NotImplementedError
+
+    def query_device(self, id):
+        '''
+        @return: rows of (id, name, address, plugin id, location id)
+        '''
+        raise NotImplementedError
+
+    def query_device_routing_by_id(self, device_id):
+        '''
+        @return: rows of (address, plugin authcode)
+        '''
+        raise NotImplementedError
+
+    # Values
+    def update_or_add_value(self, name, value, pluginid, address, time=None):
+        '''
+        Store a value update, adding the value when it doesn't exist yet.
+        @return: a deferred which fires with the value id, or an empty string when the device doesn't exist
+        '''
+        raise NotImplementedError
+
+    def update_or_add_values(self, updates):
+        '''
+        Store a batch of value updates in arrival order.
+        @param updates: a list of (name, value, pluginid, address, time) tuples, time is a timestamp or None for now
+        @return: a deferred which fires with a list of value ids, like update_or_add_value
+        '''
+        raise NotImplementedError
+
+    def save_value(self, label, history_type, history_period, control_type, id):
+        raise NotImplementedError
+
+    def del_value(self, id):
+        raise NotImplementedError
+
+    def query_values(self):
+        '''
+        @return: rows of (name, value, device name, lastupdate, plugin name, device address, location name,
+                 id, control type name, control type id, history type name, history period name,
+                 plugin id, label), of the values of existing devices and plugins
+        '''
+        raise NotImplementedError
+
+    def query_values_light(self):
+        '''
+        @return: rows of (id, label or else name, history period id, history type id)
+        '''
+        raise NotImplementedError
+
+    def query_value_by_valueid(self, value_id):
+        '''
+        @return: rows of (value, name, numeric value), the numeric value is None when the value isn't a number
+        '''
+        raise NotImplementedError
+
+    def query_values_by_device_id(self, device_id):
+        '''
+        @return: rows of (id, name)
+        '''
+        raise NotImplementedError
+
+    def query_value_properties(self, value_id):
+        '''
+        @return: rows of (name, device address, plugin id, label)
+        '''
+        raise NotImplementedError
+
+    def query_extra_valueinfo(self, value_id):
+        '''
+        @return: rows of (device name, name)
+        '''
+        raise NotImplementedError
+
+    def query_controllable_values(self):
+        '''
+        @return: rows of (id, device name, label, value, control type name), of the values with a control type
+        '''
+        raise NotImplementedError
+
+    def query_action_types_by_device_id(self, device_id):
+        '''
+        @return: rows of (id, name, control type name)
+        '''
+        raise NotImplementedError
+
+    def query_action_type_by_value_id(self, value_id):
+        '''
+        @return: rows of (control type name)
+        '''
+        raise NotImplementedError
+
+    def query_controltypename(self, current_value_id):
+        '''
+        @return: rows of (control type name)
+        '''
+        raise NotImplementedError
+
+    # Lookup tables, rows of (id, name)
+    def query_controltypes(self):
+        raise NotImplementedError
+
+    def query_history_types(self):
+        raise NotImplementedError
+
+    def query_triggertypes(self):
+        raise NotImplementedError
+
+    def query_actiontypes(self):
+        raise NotImplementedError
+
+    def query_conditiontypes(self):
+        raise NotImplementedError
+
+    def query_history_periods(self):
+        '''
+        @return: rows of (id, name, secs, sysflag)
+        '''
+        raise NotImplementedError
+
+    # Events
+    def add_event2(self, name, enabled, conditions, actions, trigger):
+        '''
+        Add an event with its conditions, actions and trigger, as posted by the event editor.
+        @return: a deferred which fires with the id of the new event
+        '''
+        raise NotImplementedError
+
+    def update_event(self, id, name, enabled, conditions, actions, trigger):
+        raise NotImplementedError
+
+    def import_events(self, events):
+        '''
+        Add a list of events, all of them or none.
+        @param events: list of dictionaries with name, enabled, conditions, actions and trigger
+        @return: a deferred which fires with the ids of the new events
+        '''
+        raise NotImplementedError
+
+    def del_event(self, id):
+        raise NotImplementedError
+
+    def query_events(self):
+        '''
+        @return: rows of (id, name, enabled)
+        '''
+        raise NotImplementedError
+
+    def query_triggers(self):
+        '''
+        @return: rows of (id, trigger type name, event id, conditions)
+        '''
+        raise NotImplementedError
+
+    def query_conditions(self):
+        '''
+        @return: rows of (id, condition type name, event id)
+        '''
+        raise NotImplementedError
+
+    def query_actions(self):
+        '''
+        @return: rows of (id, action type name, event id)
+        '''
+        raise NotImplementedError
+
+    def query_trigger_parameters(self, trigger_id):
+        '''
+        @return: rows of (name, value)
+        '''
+        raise NotImplementedError
+
+    def query_condition_parameters(self, condition_id):
+        '''
+        @return: rows of (name, value)
+        '''
+        raise NotImplementedError
+
+    def query_action_parameters(self, action_id):
+        '''
+        @return: rows of (name, value)
+        '''
+        raise NotImplementedError
+
+    # History
+    def query_history_schedules(self):
+        '''
+        @return: rows of (value id, name, history period id, history type id)
+        '''
+        raise NotImplementedError
+
+    def collect_history_values(self, value_id):
+        '''
+        Add the current value of a value to its history.
+        '''
+        raise NotImplementedError
+
+    def delete_history_values(self, before, limit, value_id=None):
+        '''
+        Delete a batch of history values created before a time.
+        @param before: the time, in the format of created_at
+        @param limit: the maximum number of history values deleted
+        @param value_id: the value of which the history is deleted, None deletes the history of the values the default
+                         retention applies to: values without a policy of their own or of their history type, and
+                         values that don't exist anymore
+        @return: a deferred which fires with the number of deleted history values
+        '''
+        raise NotImplementedError
+
+    def incremental_vacuum(self, pages):
+        '''
+        Return up to pages free pages to the file system.
+        @return: a deferred which fires with the number of pages returned
+        '''
+        raise NotImplementedError
+
+    def query_retention_policies(self):
+        '''
+        @return: rows of (id, value id, history type id, days), a policy without value and history type is the default
+        '''
+        raise NotImplementedError
+
+    def save_retention_policy(self, days, value_id=None, history_type_id=None):
+        '''
+        Set the history retention of a value, of a history type, or the default retention when neither is given.
+        @return: a deferred which fires with the id of the policy
+        '''
+        raise NotImplementedError
+
+    def del_retention_policy(self, id):
+        raise NotImplementedError
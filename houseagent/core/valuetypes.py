@@ -0,0 +1,40 @@
+# Type tags of current_values.value_type
+TEXT = 0
+INTEGER = 1
+REAL = 2
+
+# Range of SQLite integers
+_MIN_INTEGER = -2 ** 63
+_MAX_INTEGER = 2 ** 63 - 1
+
+def parse_value(value):
+    '''
+    Parse a value as sent by a plugin, values are stored as text next to their number.
+    Integers and finite decimal numbers are numeric, anything else is text.
+    @param value: the value, usually a string
+
+    @return: a (number, type) tuple, the number is None for text values
+    '''
+    if isinstance(value, float):
+        number = value
+    elif isinstance(value, (int, long)):
+        number = int(value)
+    else:
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                return None, TEXT
+
+    if isinstance(number, (int, long)):
+        if _MIN_INTEGER <= number <= _MAX_INTEGER:
+            return number, INTEGER
+        number = float(number)
+
+    # NaN and infinity don't compare like numbers
+    if number != number or number in (float('inf'), float('-inf')):
+        return None, TEXT
+
+    return number, REAL
@@ -0,0 +1,206 @@
+import datetime
+import json
+
+# Value columns kept by the view, in query order
+_VALUE_COLUMNS = "id, name, value, device_id, lastupdate, control_type_id, history_type_id, history_period_id, label"
+
+# Lookup tables the value rows refer to
+_TABLES = {'devices': "SELECT id, name, address, plugin_id, location_id FROM devices",
+           'plugins': "SELECT id, name FROM plugins",
+           'locations': "SELECT id, name FROM locations",
+           'control_types': "SELECT id, name FROM control_types",
+           'history_types': "SELECT id, name FROM history_types",
+           'history_periods': "SELECT id, name FROM history_periods"}
+
+class ValueView(object):
+    '''
+    In-memory materialized view of Database.query_values, which is what the /values API serves.
+
+    The view keeps the current_values rows and the tables they refer to. It is loaded once and
+    patched afterwards: value updates are applied without any SQL, CRUD actions reload the
+    changed rows or the (small) table they changed. The rendered JSON of every value is kept
+    until the value changes, so serving the whole list is a string join.
+
+    Like query_values, values of which the device or plugin doesn't exist are left out.
+    '''
+
+    def __init__(self, dbpool):
+        '''
+        @param dbpool: the pool the view queries through, it has to see committed writes in order
+        '''
+        self.dbpool = dbpool
+        self.loaded = False
+
+        self.values = {}
+        self.tables = dict((name, {}) for name in _TABLES)
+
+        self._fragments = {}
+        self._output = None
+
+    def load(self):
+        '''
+        Load the whole view.
+
+        @return: a Twisted deferred which fires when the view has been loaded
+        '''
+        # One interaction, so no value update is committed halfway through loading
+        return self.dbpool.runInteraction(self._load).addCallback(self._loaded)
+
+    def json(self):
+        '''
+        @return: the JSON document with all values, as returned by the /values API
+        '''
+        if self._output is None:
+            fragments = self._fragments
+            output = []
+            for value_id in sorted(self.values):
+                fragment = fragments.get(value_id)
+                if fragment is None:
+                    row = self.row(value_id)
+                    fragment = fragments[value_id] = json.dumps(row) if row else ''
+                if fragment:
+                    output.append(fragment)
+
+            self._output = '[' + ', '.join(output) + ']'
+
+        return self._output
+
+    def row(self, value_id):
+        '''
+        @return: a dictionary with the properties of a value, or None when the value doesn't exist
+        '''
+        value = self.values.get(value_id)
+        if not value:
+            return None
+
+        id, name, current, device_id, lastupdate, control_type_id, history_type_id, history_period_id, label = value
+        device = self.tables['devices'].get(device_id)
+        if not device or device[2] not in self.tables['plugins']:
+            return None
+
+        device_name, address, plugin_id, location_id = device
+        return {'id': id, 'name': name, 'value': current, 'device': device_name, 'device_address': address,
+                'location': self.tables['locations'].get(location_id), 'plugin': self.tables['plugins'][plugin_id],
+                'lastupdate': lastupdate, 'history_type': self.tables['history_types'].get(history_type_id),
+                'control_type': self.tables['control_types'].get(control_type_id),
+                'history_period': self.tables['history_periods'].get(history_period_id),
+                'plugin_id': plugin_id, 'label': label}
+
+    def value_changed(self, value_id, value, lastupdate):
+        '''
+        Apply a value update, a value the view doesn't hold yet is loaded from the database.
+        @param value_id: the id of the value
+        @param value: the new value
+        @param lastupdate: the update time, as stored in the database
+        '''
+        if not self.loaded:
+            return
+
+        row = self.values.get(value_id)
+        if not row:
+            # A new value, it gets the column defaults of the database
+            self.refresh_value(None, value_id)
+            return
+
+        row[2] = value
+        row[4] = lastupdate
+        self._fragments.pop(value_id, None)
+        self._output = None
+
+    def values_written(self, value_ids, updates):
+        '''
+        Apply a batch of value updates written by Database.update_or_add_values, meant to be used
+        as a callback.
+        @param value_ids: the value ids, as returned by the database interaction
+        @param updates: the list of (name, value, pluginid, address, time) tuples
+        '''
+        for value_id, update in zip(value_ids, updates):
+            if value_id != '':
+                self.value_changed(value_id, update[1], lastupdate(update[4]))
+
+        return value_ids
+
+    def refresh_table(self, result, name):
+        '''
+        Reload one of the tables the values refer to, after a CRUD action.
+        @param result: passed on, so this method can be used as a callback
+        @param name: devices, plugins, locations, control_types, history_types or history_periods
+
+        @return: a Twisted deferred which fires with result once the table has been reloaded
+        '''
+        def loaded(rows):
+            self.tables[name] = _table(rows)
+            self._invalidate()
+            return result
+
+        return self.dbpool.runQuery(_TABLES[name]).addCallback(loaded)
+
+    def refresh_value(self, result=None, id=None, name=None, device_id=None):
+        '''
+        Reload a value by id, or by name and device id, after a CRUD action.
+        @param result: passed on, so this method can be used as a callback
+
+        @return: a Twisted deferred which fires with result once the value has been reloaded
+        '''
+        if id is not None:
+            d = self.dbpool.runQuery("SELECT %s FROM current_values WHERE id=?" % _VALUE_COLUMNS, [id])
+        else:
+            d = self.dbpool.runQuery("SELECT %s FROM current_values WHERE name=? AND device_id=?" % _VALUE_COLUMNS,
+                                     [name, device_id])
+
+        def loaded(rows):
+            if rows:
+                self.values[rows[0][0]] = list(rows[0])
+                self._fragments.pop(rows[0][0], None)
+                self._output = None
+            elif id is not None:
+                self.value_deleted(None, id)
+            return result
+
+        return d.addCallback(loaded)
+
+    def value_deleted(self, result=None, id=None, name=None, device_id=None):
+        '''
+        Remove a value from the view, by id or by name and device id.
+        @param result: passed on, so this method can be used as a callback
+        '''
+        if id is None:
+            ids = [row[0] for row in self.values.itervalues() if row[1] == name and row[3] == int(device_id)]
+        else:
+            ids = [int(id)]
+
+        for id in ids:
+            self.values.pop(id, None)
+            self._fragments.pop(id, None)
+        self._output = None
+
+        return result
+
+    def _load(self, txn):
+        tables = dict((name, _table(txn.execute(query).fetchall())) for name, query in _TABLES.iteritems())
+        values = txn.execute("SELECT %s FROM current_values" % _VALUE_COLUMNS).fetchall()
+        return tables, values
+
+    def _loaded(self, result):
+        self.tables, values = result
+        self.values = dict((row[0], list(row)) for row in values)
+        self.loaded = True
+        self._invalidate()
+
+    def _invalidate(self):
+        self._fragments = {}
+        self._output = None
+
+def _table(rows):
+    '''
+    @return: dictionary mapping the id of each row to its name, or to a tuple of its other columns
+    '''
+    return dict((row[0], tuple(row[1:]) if len(row) > 2 else row[1]) for row in rows)
+
+def lastupdate(time=None):
+    '''
+    @return: the update time of a value as stored in the database, which is now when time is not given
+    '''
+    if not time:
+        return datetime.datetime.now().isoformat(' ').split('.')[0]
+    return datetime.datetime.fromtimestamp(time).isoformat(' ').split('.')[0]
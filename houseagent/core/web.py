@@ -5,6 +5,7 @@ import json
 import os.path
 import imp
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.web.server import Site
 from twisted.web.static import File
 from pyrrd.rrd import RRD
@@ -14,6 +15,7 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.error import CannotListenError
 from twisted.web.resource import Resource, NoResource
 from twisted.web.server import NOT_DONE_YET
+from twisted.protocols.basic import FileSender
 from uuid import uuid4
 from twisted.web import http, resource
 from houseagent.core.history import HistoryViewer
@@ -24,13 +26,14 @@ class Web(object):
     All management functions to control HouseAgent take place from here.
     '''
     
-    def __init__(self, log, host, port, backlog, coordinator, eventengine, database):
+    def __init__(self, log, host, port, backlog, coordinator, eventengine, database, backups=None):
         '''
         Initialize the web interface.
         @param port: the port on which the web server should listen
         @param coordinator: an instance of the network coordinator in order to interact with it
         @param eventengine: an instance of the event engine in order to interact with it
         @param database: an instance of the database layer in order to interact with it
+        @param backups: the BackupManager of the database, None disables database downloads
         '''
         self.host = host # web server interface
         self.port = port # web server listening port
@@ -61,12 +64,20 @@ class Web(object):
         
         # Device control
         root.putChild("control", Control(self.db))
+        
+        # Runtime statistics
+        root.putChild("stats", Stats(self.coordinator))
+
+        # Database backup download
+        if backups:
+            root.putChild("backup", Backup(backups))
 
         # Value management
         root.putChild('values', Values(self.db, self.coordinator))
         root.putChild('values_view', Values_view())
         root.putChild('history_types', HistoryTypes(self.db)) 
         root.putChild('history_periods', HistoryPeriods(self.db))
+        root.putChild('retention_policies', RetentionPolicies(self.db))
         root.putChild('control_types', ControlTypes(self.db))
 
         # Events
@@ -78,6 +89,7 @@ class Web(object):
         root.putChild("event_control_types_by_id", Event_control_types_by_id(self.db))
         root.putChild("events", Events(self.db))
         root.putChild("event_del", Event_del(self.eventengine, self.db))
+        root.putChild("event_import", Event_import(self.eventengine, self.db))
 
         # Graphing
         root.putChild("create_graph", CreateGraph(self.db))
@@ -138,8 +150,8 @@ class HouseAgentREST(Resource):
     def __init__(self, db):
         Resource.__init__(self)
         self.db = db
-        self._load()
         self._objects = []
+        self._load()
     
     # functions that must be implemented
     def _load(self, **kwargs):
@@ -283,22 +295,19 @@ class Plugin(Resource):
 class Plugins(HouseAgentREST):
 
     def __init__(self, db, coordinator):
-        HouseAgentREST.__init__(self, db)
         self.coordinator = coordinator
+        HouseAgentREST.__init__(self, db)
         
-    def render_GET(self, request):
-        ''' 
-        This gets overriden in order to support online/offline status
+        # Keep online/offline status up to date
+        coordinator.status_callbacks.append(self.plugin_status_changed)
+        
+    def plugin_status_changed(self, guid, online):
+        '''
+        Callback from the coordinator when a plugin went online or offline.
         '''
-        output = []
         for obj in self._objects:
-            for p in self.coordinator.plugins:
-                if p.guid == obj.authcode:
-                    obj.status = p.online            
-            
-            output.append(obj.json())
-
-        return json.dumps(output)
+            if obj.authcode == guid:
+                obj.status = online
 
     @inlineCallbacks            
     def _load(self):
@@ -310,6 +319,11 @@ class Plugins(HouseAgentREST):
         
         for plugin in plugin_query:
             plug = Plugin(plugin[2], plugin[0], plugin[1], plugin[3], self)
+            
+            p = self.coordinator.plugin_by_guid(plug.authcode)
+            if p:
+                plug.status = p.online
+                
             self._objects.append(plug)
     
     @inlineCallbacks
@@ -461,17 +475,24 @@ class ValueActionResult(Resource):
         def control_result(result):
             request.write(str(result))
             request.finish()
+            
+        def control_failed(failure):
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            request.write(str(failure.value))
+            request.finish()
         
         plugin_guid = self.coordinator.plugin_guid_by_id(self.plugin_id)
         
         if self.action == 'poweron':
-            self.coordinator.send_poweron(plugin_guid, self.device_address, self.value_id).addCallback(control_result)
+            d = self.coordinator.send_poweron(plugin_guid, self.device_address, self.value_id)
         elif self.action == 'poweroff':
-            self.coordinator.send_poweroff(plugin_guid, self.device_address, self.value_id).addCallback(control_result)
+            d = self.coordinator.send_poweroff(plugin_guid, self.device_address, self.value_id)
         elif self.action == 'dim':
-            self.coordinator.send_dim(plugin_guid, self.device_address, self.params["level"], self.value_id).addCallback(control_result)
+            d = self.coordinator.send_dim(plugin_guid, self.device_address, self.params["level"], self.value_id)
         elif self.action == 'thermostat_setpoint':
-            self.coordinator.send_thermostat_setpoint(plugin_guid, self.device_address, self.params["temp"], self.value_id).addCallback(control_result)
+            d = self.coordinator.send_thermostat_setpoint(plugin_guid, self.device_address, self.params["temp"], self.value_id)
+            
+        d.addCallbacks(control_result, control_failed)
         return NOT_DONE_YET
     
 class Values(HouseAgentREST):
@@ -479,13 +500,18 @@ class Values(HouseAgentREST):
     def __init__(self, db, coordinator):
         HouseAgentREST.__init__(self, db)
         self.coordinator = coordinator
+        self.putChild('stream', ValueStream(coordinator.bus))
 
     def render_GET(self, request):
+        # Served from the in-memory view of the values, once it has been loaded
+        if self.db.view and self.db.view.loaded:
+            return self.db.view.json()
+        
+        self.request = request
+
         self._objects = []
         self._load().addCallback(self.done)
 
-        self.request = request
-
         return NOT_DONE_YET
     
     def done(self, result):
@@ -520,9 +546,33 @@ class Values(HouseAgentREST):
     @inlineCallbacks
     def delete(self, obj):
         yield self.db.del_value(int(obj.id))
-        self._objects.remove(obj)
+        if obj in self._objects:
+            self._objects.remove(obj)
         obj.request.finish()
     
+    def _find(self, name):
+        '''
+        Find a value by id.
+        @param name: the id of the value, as found in the URL
+        
+        @return: a Value object, or None when the value doesn't exist
+        '''
+        if not (self.db.view and self.db.view.loaded):
+            for obj in self._objects:
+                if name == str(obj.id):
+                    return obj
+            return None
+        
+        try:
+            row = self.db.view.row(int(name))
+        except ValueError:
+            row = None
+            
+        if row:
+            return Value(row['id'], row['name'], row['value'], row['device'], row['device_address'], row['location'], row['plugin'],
+                         row['lastupdate'], row['history_type'], row['history_period'], row['control_type'], row['plugin_id'],
+                         row['label'], self)
+    
     def getChild(self, name, request):
                
         try:
@@ -530,29 +580,101 @@ class Values(HouseAgentREST):
         except KeyError:
             action = None
         
+        obj = self._find(name)
+        
         if not action:
             
-            for obj in self._objects:
-                if name == str(obj.id):
-                    return obj
+            if obj:
+                return obj
                 
             return NoResource(message="The resource %s was not found" % request.URLPath())
         
         else:
 
-            for obj in self._objects: 
-                if name == str(obj.id): 
-                    device_address = obj.device_address 
-                    plugin_id = obj.plugin_id
-                    
-                    if action == 'poweron' or action == 'poweroff':   
-                        return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, {})
-                    elif action == 'dim':
-                        params = {'level': request.args['level'][0]}
-                        return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, params)
-                    elif action == 'thermostat_setpoint':
-                        params = {'temp': request.args['temp'][0]}
-                        return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, params)
+            if obj:
+                device_address = obj.device_address 
+                plugin_id = obj.plugin_id
+                
+                if action == 'poweron' or action == 'poweroff':   
+                    return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, {})
+                elif action == 'dim':
+                    params = {'level': request.args['level'][0]}
+                    return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, params)
+                elif action == 'thermostat_setpoint':
+                    params = {'temp': request.args['temp'][0]}
+                    return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, params)
+        
+class ValueStream(Resource):
+    '''
+    Pushes value changes to web clients using Server-Sent Events.
+    Each event carries the sequence number of the change, a client that reconnects with a
+    Last-Event-ID header (or a since=<id> argument) receives the changes it missed. When these 
+    are no longer available a reset event is sent, the client should then reload /values.
+    '''
+    isLeaf = True
+    
+    def __init__(self, bus, keepalive=15):
+        Resource.__init__(self)
+        self.bus = bus
+        self._clients = []
+        self._keepalive = LoopingCall(self._send_keepalive)
+        self._keepalive_interval = keepalive
+        
+        bus.subscribe(self._values_changed)
+        
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.write('retry: 2000\n\n')
+        
+        last_id = request.getHeader('Last-Event-ID') or request.args.get('since', [None])[0]
+        if last_id:
+            self._resume(request, last_id)
+        
+        self._clients.append(request)
+        request.notifyFinish().addBoth(self._client_gone, request)
+        
+        if not self._keepalive.running:
+            self._keepalive.start(self._keepalive_interval, False)
+            
+        return NOT_DONE_YET
+    
+    def _resume(self, request, last_id):
+        events = None
+        
+        try:
+            session, seq = last_id.split('.')
+            if session == self.bus.session:
+                events = self.bus.since(int(seq))
+        except ValueError:
+            pass
+        
+        if events is None:
+            request.write(self._format('reset', '%s.%d' % (self.bus.session, self.bus.seq), {}))
+        elif events:
+            request.write(self._format_events(events))
+            
+    def _client_gone(self, result, request):
+        self._clients.remove(request)
+        
+        if not self._clients and self._keepalive.running:
+            self._keepalive.stop()
+    
+    def _values_changed(self, events):
+        if self._clients:
+            data = self._format_events(events)
+            for request in self._clients:
+                request.write(data)
+                
+    def _send_keepalive(self):
+        for request in self._clients:
+            request.write(': keepalive\n\n')
+    
+    def _format_events(self, events):
+        return ''.join(self._format('value', '%s.%d' % (self.bus.session, e.seq), e.json()) for e in events)
+    
+    def _format(self, event, id, data):
+        return 'id: %s\nevent: %s\ndata: %s\n\n' % (id, event, json.dumps(data))
         
 class Values_view(Resource):
     
@@ -622,6 +744,60 @@ class HistoryPeriods(HouseAgentREST):
             hist = HistoryPeriod(period[0], period[1], period[2], period[3])
             self._objects.append(hist)
 
+class RetentionPolicy(Resource):
+    '''
+    This object represents a history RetentionPolicy.
+    '''
+    def __init__(self, id, value_id, history_type_id, days, parent):
+        Resource.__init__(self)
+        self.id = id
+        self.value_id = value_id
+        self.history_type_id = history_type_id
+        self.days = days
+        self.parent = parent
+
+    def json(self):
+        return {"id": self.id, "value_id": self.value_id,
+                "history_type_id": self.history_type_id, "days": self.days}
+
+    def render_GET(self, request):
+        return json.dumps(self.json())
+
+    def render_DELETE(self, request):
+        self.request = request
+        self.parent.delete(self)
+        return NOT_DONE_YET
+
+class RetentionPolicies(HouseAgentREST):
+
+    @inlineCallbacks
+    def _load(self):
+        '''
+        Load history retention policies from the database.
+        '''
+        self._objects = []
+        policy_query = yield self.db.query_retention_policies()
+
+        for policy in policy_query:
+            pol = RetentionPolicy(policy[0], policy[1], policy[2], policy[3], self)
+            self._objects.append(pol)
+
+    @inlineCallbacks
+    def _add(self, parameters):
+        # A policy without value and history type is the default policy
+        value_id = parameters.get('value_id', [''])[0] or None
+        history_type_id = parameters.get('history_type_id', [''])[0] or None
+
+        yield self.db.save_retention_policy(int(parameters['days'][0]), value_id, history_type_id)
+        self._reload()
+        self._done()
+
+    @inlineCallbacks
+    def delete(self, obj):
+        yield self.db.del_retention_policy(int(obj.id))
+        self._objects.remove(obj)
+        obj.request.finish()
+
 class ControlType(Resource):
     '''
     This object represents a ControlType.
@@ -822,8 +998,41 @@ class Event_save(Resource):
             
         print "event_info", event_info
 
-        self.db.add_event2(event_info["name"], enabled, event_info["conditions"], event_info["actions"], event_info["trigger"]).addCallback(self.finished)
-        
+        if event_info.get("id"):
+            d = self.db.update_event(int(event_info["id"]), event_info["name"], enabled, event_info["conditions"],
+                                     event_info["actions"], event_info["trigger"])
+        else:
+            d = self.db.add_event2(event_info["name"], enabled, event_info["conditions"], event_info["actions"], event_info["trigger"])
+
+        d.addCallback(self.finished)
+        return NOT_DONE_YET
+
+class Event_import(Resource):
+    """
+    Imports a list of events, in the format posted to event_save, in one transaction.
+    """
+    def __init__(self, eventengine, database):
+        Resource.__init__(self)
+        self.eventengine = eventengine
+        self.db = database
+
+    def imported(self, result, request):
+        self.eventengine.reload()
+        request.write(json.dumps(result))
+        request.finish()
+
+    def failed(self, failure, request):
+        request.setResponseCode(400)
+        request.write(json.dumps({'error': failure.getErrorMessage()}))
+        request.finish()
+
+    def render_POST(self, request):
+        events = json.loads(request.content.read())
+
+        for event in events:
+            event["enabled"] = event.get("enabled") in (True, "yes")
+
+        self.db.import_events(events).addCallbacks(self.imported, self.failed, callbackArgs=[request], errbackArgs=[request])
         return NOT_DONE_YET
 
 
@@ -1000,6 +1209,52 @@ class CreateGraph(Resource):
         return NOT_DONE_YET
     
 
+class Stats(Resource):
+    """
+    Returns runtime statistics of the coordinator as a JSON dataset.
+    """
+    def __init__(self, coordinator):
+        Resource.__init__(self)
+        self.coordinator = coordinator
+        
+    def render_GET(self, request):
+        return json.dumps(self.coordinator.get_stats())
+
+class Backup(Resource):
+    """
+    Takes a snapshot of the database and streams it to the client.
+    """
+    def __init__(self, backups):
+        Resource.__init__(self)
+        self.backups = backups
+
+    def send(self, path, request):
+        snapshot = open(path, 'rb')
+        request.setHeader('Content-Type', 'application/octet-stream')
+        request.setHeader('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(path))
+        request.setHeader('Content-Length', str(os.path.getsize(path)))
+
+        def sent(result):
+            snapshot.close()
+            request.finish()
+
+        def aborted(failure):
+            # The client went away
+            snapshot.close()
+
+        FileSender().beginFileTransfer(snapshot, request).addCallbacks(sent, aborted)
+
+    def failed(self, failure, request):
+        request.setResponseCode(500)
+        request.write(json.dumps({'error': failure.getErrorMessage()}))
+        request.finish()
+
+    def render_GET(self, request):
+        d = self.backups.snapshot()
+        d.addCallback(self.send, request)
+        d.addErrback(self.failed, request)
+        return NOT_DONE_YET
+
 class Control(Resource):
     """
     Class that manages device control.
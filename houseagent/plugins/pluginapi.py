@@ -17,9 +17,10 @@ if os.name == "nt":
         pass        
 #from twisted.python import log as twisted_log
 from twisted.internet import reactor, task, defer
-from txzmq import ZmqFactory, ZmqEndpoint, ZmqConnection, ZmqEndpointType
+from txzmq import ZmqFactory, ZmqEndpoint, ZmqConnection, ZmqEndpointType, ZmqSubConnection
 from zmq.core import constants
 from houseagent import config_file
+from houseagent.utils.codec import MessageCodec, FORMATS, crud_topic
 
 class PluginConnection(ZmqConnection):        
     '''
@@ -27,14 +28,23 @@ class PluginConnection(ZmqConnection):
     '''
     socketType = constants.XREQ
         
-    def __init__(self, factory, pluginapi, *endpoints):
+    def __init__(self, factory, pluginapi, *endpoints, **kwargs):
         '''
         Initialize a new PluginConnection instance.
         
         @param factory: an instance of ZmqFactory
         @param pluginapi: an instance of PluginAPI
+        @param socket_options: a SocketOptions instance (keyword argument)
         '''
+        socket_options = kwargs.get('socket_options')
+        if socket_options:
+            socket_options.prepare(self)
+            
         ZmqConnection.__init__(self, factory, *endpoints)
+        
+        if socket_options:
+            socket_options.apply(self)
+            
         self.pluginapi = pluginapi
         self.factory = factory
         self.endpoints = endpoints
@@ -61,6 +71,10 @@ class PluginConnection(ZmqConnection):
             if self.pluginapi.isready:
                 self.pluginapi.ready()
         
+        elif msg[1] == '\x07':
+            # Handle ready acknowledgement, this holds the negotiated options
+            self.pluginapi.handle_options(json.loads(msg[2]))
+        
         elif msg[1] == '\x04':
             # Handle RPC reply
             self.pluginapi.handle_rpc_message(msg[2], msg[3])
@@ -69,15 +83,41 @@ class PluginConnection(ZmqConnection):
 
             # Handle CRUD callback
             if self.pluginapi.crud_callback:
-                message = json.loads(msg[2])
+                message = self.pluginapi.rpc_codec.decode(msg[2])
                 self.pluginapi.crud_callback(message['type'], message['action'], message['parameters'])
 
+class NotificationConnection(ZmqSubConnection):
+    '''
+    Class that receives notifications published by the coordinator.
+    '''
+    
+    def __init__(self, factory, pluginapi, *endpoints):
+        '''
+        Initialize a new NotificationConnection instance.
+        
+        @param factory: an instance of ZmqFactory
+        @param pluginapi: an instance of PluginAPI
+        '''
+        ZmqSubConnection.__init__(self, factory, *endpoints)
+        self.pluginapi = pluginapi
+        
+    def gotMessage(self, message, tag):
+        '''
+        Function called when a notification has been received.
+        @param message: the notification
+        @param tag: the topic the notification was published under
+        '''
+        if tag.startswith('crud.') and self.pluginapi.crud_callback:
+            message = self.pluginapi.rpc_codec.decode(message)
+            self.pluginapi.crud_callback(message['type'], message['action'], message['parameters'])
+
 class PluginAPI(object):
     '''
     This is the PluginAPI for HouseAgent.
     ''' 
     
-    def __init__(self, guid, plugintype=None, broker_host='127.0.0.1', broker_port='13001', **callbacks):
+    def __init__(self, guid, plugintype=None, broker_host='127.0.0.1', broker_port='13001', 
+                 batch_size=0, batch_interval=50, socket_options=None, crud_own_devices=False, **callbacks):
         '''
         Initialize a new PluginAPI instance.
         
@@ -85,16 +125,44 @@ class PluginAPI(object):
         @param plugintype: the type of the plugin
         @param broker_host: the broker host
         @param broker_port: the broker port
+        @param batch_size: when set, value updates are accumulated and sent as one batch message after 
+                           this number of updates
+        @param batch_interval: the maximum time in milliseconds an accumulated value update is held back
+        @param socket_options: a SocketOptions instance with the high-water marks, linger and keepalive 
+                               settings of the broker connection
+        @param crud_own_devices: when set, the crud callback only receives updates of the devices of this plugin 
+                                 instead of the updates of all devices, once the coordinator publishes them on
+                                 the notification channel
         '''
         
         self.factory = ZmqFactory()
         self.guid = guid
+        self.broker_host = broker_host
+        self.notifications = None
+        
+        # By default a plugin receives the CRUD updates of all devices, like before the notification channel
+        if crud_own_devices:
+            self.crud_topics = [crud_topic('device', guid) + '\0']
+        else:
+            self.crud_topics = [crud_topic('device')]
         self.plugintype = plugintype
         self.isready = False
         
+        # Messages are sent as JSON until the coordinator selected a format during the ready handshake.
+        # Only value updates intern strings, RPC replies may be lost without breaking the connection.
+        self.codec = MessageCodec(intern=True)
+        self.rpc_codec = MessageCodec()
+        
+        # Value update accumulator
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._batch = []
+        self._batch_call = None
+        
         # Set-up connection
         self.connection = PluginConnection(self.factory, self, ZmqEndpoint(ZmqEndpointType.connect, 
-                                                                     'tcp://%s:%s' % (broker_host, broker_port)))
+                                                                     'tcp://%s:%s' % (broker_host, broker_port)),
+                                          socket_options=socket_options)
                 
         # Handle callbacks
         self.custom_callback = None
@@ -123,9 +191,10 @@ class PluginAPI(object):
             elif callback == 'dim':
                 self.dim_callback = callbacks[callback]
                 
-        # Start keep alive
-        l = task.LoopingCall(self.heartbeat)
-        l.start(30.0)
+        # Start keep alive, the coordinator may select another interval in the ready handshake
+        self.heartbeat_interval = 30
+        self._heartbeat = task.LoopingCall(self.heartbeat)
+        self._heartbeat.start(self.heartbeat_interval)
         
     def handle_rpc_message(self, message_id, message):
         '''
@@ -133,7 +202,7 @@ class PluginAPI(object):
         @param message_id: the id associated with the message.
         '''
 
-        message = json.loads(message)  
+        message = self.rpc_codec.decode(message)
 
         if message['type'] == 'custom':
             if self.custom_callback:
@@ -174,7 +243,7 @@ class PluginAPI(object):
         @param message_id: the message id associated with the RPC request
         '''
         def cb_reply(result):
-            message = [b'', chr(5), message_id, json.dumps(result)]
+            message = [b'', chr(5), message_id, self.rpc_codec.encode(result)]
             print "Sending: %r" % (message)
             self.connection.send(message)
         
@@ -191,12 +260,48 @@ class PluginAPI(object):
         @param address: the address of the device
         @param values: one or multiple values to be updated
         '''
+        if self.batch_size:
+            self._batch.append({"address": address, "values": values, "time": time.time()})
+            
+            if len(self._batch) >= self.batch_size:
+                self.flush_value_updates()
+            elif not self._batch_call:
+                self._batch_call = reactor.callLater(self.batch_interval / 1000.0, self.flush_value_updates)
+            return
+        
         content = {"address": address,
                    "values": values, 
                    "time": time.time(),
                    'plugin_id': self.guid}
     
-        self.connection.send_msg(chr(3), json.dumps(content))
+        self.connection.send_msg(chr(3), self.codec.encode(content))
+        
+    def value_update_batch(self, updates):
+        '''
+        This function is called by a plugin to send value updates for multiple devices in one message.
+        @param updates: a dictionary with the device address as key and the values to be updated as value
+        '''
+        self._send_batch([{"address": address, "values": values} for address, values in updates.iteritems()])
+        
+    def flush_value_updates(self):
+        '''
+        Send all value updates held back by the accumulator.
+        '''
+        if self._batch_call and self._batch_call.active():
+            self._batch_call.cancel()
+        self._batch_call = None
+        
+        if self._batch:
+            batch = self._batch
+            self._batch = []
+            self._send_batch(batch)
+            
+    def _send_batch(self, updates):
+        content = {"updates": updates,
+                   "time": time.time(),
+                   "plugin_id": self.guid}
+        
+        self.connection.send_msg(chr(8), self.codec.encode(content))
 
     def heartbeat(self):
         '''
@@ -211,7 +316,42 @@ class PluginAPI(object):
         Send a message on the broker about our state.
         '''
         self.isready = True
-        self.connection.send_msg(chr(1), self.guid, self.plugintype, json.dumps(self.callbacks))
+        
+        # The coordinator starts with a fresh codec on every ready message
+        self.codec = MessageCodec(intern=True)
+        self.rpc_codec = MessageCodec()
+        self.connection.send_msg(chr(1), self.guid, self.plugintype, json.dumps(self.callbacks), json.dumps(FORMATS))
+        
+    def handle_options(self, options):
+        '''
+        This function handles the options the coordinator selected in reply to a ready message.
+        @param options: a dictionary with the selected options
+        '''
+        if 'codec' in options:
+            self.codec.format = options['codec']
+            self.rpc_codec.format = options['codec']
+        
+        if options.get('heartbeat_interval', self.heartbeat_interval) != self.heartbeat_interval:
+            self.heartbeat_interval = options['heartbeat_interval']
+            self._heartbeat.stop()
+            self._heartbeat.start(self.heartbeat_interval, False)
+            
+        if 'pub_port' in options and self.crud_callback and not self.notifications:
+            # CRUD updates are published on the notification channel from now on
+            self.notifications = NotificationConnection(self.factory, self, ZmqEndpoint(ZmqEndpointType.connect, 
+                                                        'tcp://%s:%s' % (self.broker_host, options['pub_port'])))
+            for topic in self.crud_topics:
+                self.notifications.subscribe(topic)
+            
+    def subscribe_crud(self, prefix):
+        '''
+        Subscribe to additional CRUD notifications, for plugins created with crud_own_devices.
+        Subscribing to crud_topic('device', guid) + '\0' for example delivers the device updates of another plugin.
+        @param prefix: the topic prefix to subscribe to
+        '''
+        self.crud_topics.append(prefix)
+        if self.notifications:
+            self.notifications.subscribe(prefix)
                          
 class Logging():
     '''
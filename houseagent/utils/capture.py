@@ -0,0 +1,97 @@
+import struct
+
+"""
+Capture files hold raw broker traffic, so production traffic can be replayed later on.
+
+A capture file starts with the MAGIC header, followed by one record per received message:
+the receive time as a double and the number of frames, followed by each frame prefixed
+with its length. All numbers are little endian.
+"""
+
+MAGIC = 'HACAP1\n'
+
+_RECORD = struct.Struct('<dH')
+_FRAME = struct.Struct('<I')
+
+class CaptureWriter(object):
+    '''
+    Appends received messages to a capture file.
+    '''
+
+    def __init__(self, path, buffer_size=65536):
+        '''
+        Open a capture file, new records are appended to an existing capture.
+        @param path: the location of the capture file
+        @param buffer_size: the number of bytes buffered before they are written to disk
+        '''
+        self.path = path
+        self.records = 0
+        self._file = open(path, 'ab', buffer_size)
+
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def write(self, timestamp, frames):
+        '''
+        Append a message to the capture.
+        @param timestamp: the time the message was received
+        @param frames: the list of frames of the message
+        '''
+        record = [_RECORD.pack(timestamp, len(frames))]
+        for frame in frames:
+            record.append(_FRAME.pack(len(frame)))
+            record.append(frame)
+
+        self._file.write(''.join(record))
+        self.records += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+class CaptureReader(object):
+    '''
+    Reads the messages stored in a capture file.
+    '''
+
+    def __init__(self, path):
+        '''
+        Open a capture file for reading.
+        @param path: the location of the capture file
+        '''
+        self._file = open(path, 'rb')
+
+        if self._file.read(len(MAGIC)) != MAGIC:
+            self._file.close()
+            raise ValueError("%s is not a HouseAgent capture file" % path)
+
+    def __iter__(self):
+        '''
+        Iterate over the captured messages, a record cut off at the end of the file is ignored.
+
+        @return: an iterator of (timestamp, frames) tuples
+        '''
+        read = self._file.read
+
+        while True:
+            header = read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+
+            timestamp, count = _RECORD.unpack(header)
+            frames = []
+            for i in xrange(count):
+                length = read(_FRAME.size)
+                if len(length) < _FRAME.size:
+                    return
+
+                length = _FRAME.unpack(length)[0]
+                frame = read(length)
+                if len(frame) < length:
+                    return
+                frames.append(frame)
+
+            yield timestamp, frames
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,331 @@
+import json
+import struct
+
+"""
+Message encodings used between plugins and the coordinator.
+
+Two formats are supported:
+- json: the original format, human readable
+- bin1: a compact, tagged binary format (msgpack style). Floats are packed as doubles,
+  small integers in a single byte and dictionary keys can be interned, so repeating
+  keys are sent as a two byte reference after their first occurence. Value updates
+  use a dedicated frame layout with interned plugin ids, addresses and value names.
+
+Binary payloads start with a marker byte that can never start a JSON document, so a
+receiver can always decode both formats. The format is negotiated during the ready
+handshake, plugins that don't announce any formats keep using JSON.
+"""
+
+# Supported formats in order of preference
+FORMATS = ('bin1', 'json')
+
+MAGIC = '\xb1'
+
+# Keys that are used by most messages, these are interned by default and never sent
+# over the wire.
+WELL_KNOWN = ('address', 'values', 'time', 'plugin_id', 'type', 'action', 'parameters',
+              'value_id', 'level', 'temperature', 'plugin', 'name', 'location', 'updates',
+              'codec', 'pub_port', 'device')
+
+# Maximum number of interned strings per connection
+MAX_INTERNED = 0xffff
+
+# Interned strings in value update frames are referenced by a single character,
+# starting at TOKEN_BASE and staying below the UTF-16 surrogate range
+TOKEN_BASE = 0x100
+MAX_TOKENS = 0xd800 - TOKEN_BASE
+
+_DOUBLE = struct.Struct('<d')
+_INT8 = struct.Struct('<b')
+_INT32 = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+_UINT16 = struct.Struct('<H')
+_UINT32 = struct.Struct('<I')
+
+def negotiate(offered):
+    '''
+    Select the preferred format out of the formats offered by a plugin.
+    @param offered: a list of format names, or None for plugins that don't negotiate
+
+    @return: the name of the selected format
+    '''
+    if offered:
+        for name in FORMATS:
+            if name in offered:
+                return name
+    return 'json'
+
+def crud_topic(type, plugin=None):
+    '''
+    Get the topic CRUD notifications are published under.
+    @param type: the update type, for example device
+    @param plugin: the guid of the plugin the update belongs to
+
+    @return: the topic, for example crud.device.<plugin guid>
+    '''
+    topic = u'crud.%s' % type
+    if plugin:
+        topic += u'.%s' % plugin
+    return topic.encode('utf-8')
+
+class MessageCodec(object):
+    '''
+    Encoder/decoder for messages exchanged between plugins and the coordinator.
+    A codec instance holds the intern table for one direction of one connection.
+    '''
+
+    def __init__(self, format='json', intern=False):
+        '''
+        Initialize a new MessageCodec.
+        @param format: the format used to encode messages, one of FORMATS
+        @param intern: whether dictionary keys are interned while encoding. Interning requires
+                       reliable, in order delivery, so only use it on the plugin to coordinator path.
+        '''
+        self.format = format
+        self.intern = intern
+        self.reset()
+
+    def reset(self):
+        '''
+        Clear the intern tables, this must happen on both ends at the same time (the ready handshake).
+        '''
+        self._encode_table = dict((key, index) for index, key in enumerate(WELL_KNOWN))
+        self._decode_table = [unicode(key) for key in WELL_KNOWN]
+        self._tokens = {}
+        self._token_lookup = {}
+
+    def encode(self, obj):
+        '''
+        Encode an object in the selected format.
+        @param obj: the object to encode, any combination of dicts, lists, strings, numbers, booleans and None
+
+        @return: the encoded message
+        '''
+        if self.format == 'json':
+            return json.dumps(obj)
+
+        if type(obj) is dict and len(obj) == 4 and 'values' in obj:
+            frame = self._encode_value_update(obj)
+            if frame:
+                return frame
+
+        out = [MAGIC]
+        self._encode(obj, out)
+        return ''.join(out)
+
+    def decode(self, data):
+        '''
+        Decode a message, the format is detected automatically.
+        @param data: the encoded message
+
+        @return: the decoded object
+        '''
+        if data[:1] != MAGIC:
+            return json.loads(data)
+
+        if data[1:2] == 'V':
+            return self._decode_value_update(data)
+
+        obj, offset = self._decode(data, 1)
+        return obj
+
+    def _encode_value_update(self, obj):
+        '''
+        Value updates are by far the most common message, they get a dedicated frame layout:
+        the timestamp as a double followed by one NUL separated string holding the index of the
+        first new interned string, the number of new interned strings, the new strings, and the
+        plugin id, address and name/value pairs. Plugin id, address and value names are always
+        sent as a single character reference.
+        
+        @return: the encoded frame, or None if the message doesn't fit the layout
+        '''
+        time = obj.get('time')
+        plugin_id = obj.get('plugin_id')
+        address = obj.get('address')
+        values = obj['values']
+        
+        if not self.intern or type(time) is not float or type(values) is not dict:
+            return None
+        
+        # Check everything first, the intern table may only change when the frame is sent
+        names = [plugin_id, address] + values.keys()
+        new = []
+        for name in names:
+            if name not in self._tokens:
+                if not isinstance(name, basestring) or u'\x00' in name:
+                    return None
+                if name not in new:
+                    new.append(name)
+        for value in values.itervalues():
+            if not isinstance(value, basestring) or u'\x00' in value:
+                return None
+        if len(self._tokens) + len(new) > MAX_TOKENS:
+            return None
+
+        first = len(self._tokens)
+        for name in new:
+            self._tokens[name] = unichr(TOKEN_BASE + len(self._tokens))
+
+        tokens = self._tokens
+        body = [unicode(first), unicode(len(new))] + new + [tokens[plugin_id], tokens[address]]
+        for name, value in values.iteritems():
+            body.append(tokens[name])
+            body.append(value)
+
+        return MAGIC + 'V' + _DOUBLE.pack(time) + u'\x00'.join(body).encode('utf-8')
+
+    def _decode_value_update(self, data):
+        '''
+        Decode a value update frame. The index of the first new interned string has to match the
+        size of the lookup table, otherwise a frame got lost or was reordered. The tables can't be
+        trusted after that, every following value update is refused until the next reset.
+        '''
+        if self._token_lookup is None:
+            raise ValueError("Intern tables out of sync, waiting for a reset")
+        
+        parts = data[10:].decode('utf-8').split(u'\x00')
+        
+        lookup = self._token_lookup
+        first = int(parts[0])
+        if first != len(lookup):
+            self._token_lookup = None
+            raise ValueError("Intern tables out of sync, expected new strings from %d, got %d" % (len(lookup), first))
+        
+        count = int(parts[1])
+        for name in parts[2:count + 2]:
+            lookup[unichr(TOKEN_BASE + len(lookup))] = name
+        
+        body = parts[count + 2:]
+        try:
+            return {'time': _DOUBLE.unpack_from(data, 2)[0],
+                    'plugin_id': lookup[body[0]],
+                    'address': lookup[body[1]],
+                    'values': dict(zip(map(lookup.__getitem__, body[2::2]), body[3::2]))}
+        except KeyError, e:
+            # References a string defined in a frame that never arrived
+            self._token_lookup = None
+            raise ValueError("Intern tables out of sync, unknown reference %r" % e.args[0])
+
+    def _encode(self, obj, out):
+        t = type(obj)
+
+        if t is unicode or t is str:
+            if t is unicode:
+                obj = obj.encode('utf-8')
+            if len(obj) < 0x10000:
+                out.append('s' + _UINT16.pack(len(obj)) + obj)
+            else:
+                out.append('S' + _UINT32.pack(len(obj)) + obj)
+
+        elif t is float:
+            out.append('d' + _DOUBLE.pack(obj))
+
+        elif t is bool:
+            out.append('T' if obj else 'F')
+
+        elif t is int or t is long:
+            if -128 <= obj < 128:
+                out.append('b' + _INT8.pack(obj))
+            elif -0x80000000 <= obj < 0x80000000:
+                out.append('i' + _INT32.pack(obj))
+            else:
+                out.append('q' + _INT64.pack(obj))
+
+        elif obj is None:
+            out.append('N')
+
+        elif t is dict:
+            out.append('m' + _UINT32.pack(len(obj)))
+            for key, value in obj.iteritems():
+                self._encode_key(key, out)
+                self._encode(value, out)
+
+        elif t is list or t is tuple:
+            out.append('l' + _UINT32.pack(len(obj)))
+            for value in obj:
+                self._encode(value, out)
+
+        else:
+            raise TypeError("Cannot encode %r" % (obj,))
+
+    def _encode_key(self, key, out):
+        if type(key) is unicode:
+            key = key.encode('utf-8')
+        elif type(key) is not str:
+            # Same behaviour as JSON, keys are always strings
+            key = str(key)
+
+        index = self._encode_table.get(key)
+        if index is not None:
+            out.append('r' + _UINT16.pack(index))
+        elif self.intern and len(self._encode_table) < MAX_INTERNED:
+            # First occurence, define the key and assign it the next index
+            self._encode_table[key] = len(self._encode_table)
+            out.append('k' + _UINT16.pack(len(key)) + key)
+        else:
+            out.append('s' + _UINT16.pack(len(key)) + key)
+
+    def _decode(self, data, offset):
+        tag = data[offset]
+        offset += 1
+
+        if tag == 's':
+            length = _UINT16.unpack_from(data, offset)[0]
+            offset += 2
+            return data[offset:offset + length].decode('utf-8'), offset + length
+
+        elif tag == 'r':
+            return self._decode_table[_UINT16.unpack_from(data, offset)[0]], offset + 2
+
+        elif tag == 'd':
+            return _DOUBLE.unpack_from(data, offset)[0], offset + 8
+
+        elif tag == 'm':
+            count = _UINT32.unpack_from(data, offset)[0]
+            offset += 4
+            obj = {}
+            for i in xrange(count):
+                key, offset = self._decode(data, offset)
+                obj[key], offset = self._decode(data, offset)
+            return obj, offset
+
+        elif tag == 'l':
+            count = _UINT32.unpack_from(data, offset)[0]
+            offset += 4
+            obj = []
+            for i in xrange(count):
+                value, offset = self._decode(data, offset)
+                obj.append(value)
+            return obj, offset
+
+        elif tag == 'k':
+            length = _UINT16.unpack_from(data, offset)[0]
+            offset += 2
+            key = data[offset:offset + length].decode('utf-8')
+            self._decode_table.append(key)
+            return key, offset + length
+
+        elif tag == 'b':
+            return _INT8.unpack_from(data, offset)[0], offset + 1
+
+        elif tag == 'i':
+            return _INT32.unpack_from(data, offset)[0], offset + 4
+
+        elif tag == 'q':
+            return _INT64.unpack_from(data, offset)[0], offset + 8
+
+        elif tag == 'S':
+            length = _UINT32.unpack_from(data, offset)[0]
+            offset += 4
+            return data[offset:offset + length].decode('utf-8'), offset + length
+
+        elif tag == 'N':
+            return None, offset
+
+        elif tag == 'T':
+            return True, offset
+
+        elif tag == 'F':
+            return False, offset
+
+        raise ValueError("Invalid tag %r at offset %d" % (tag, offset - 1))
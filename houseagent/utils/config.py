@@ -7,7 +7,7 @@ def _getOpt(get, section, option, default = None):
     res = default
     try:
         res = get(section, option)
-    except ConfigParser.NoOptionError:
+    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
         if res == None:
             raise error.ConfigError, ("[%s]::%s" % (section,option))
 
@@ -44,6 +44,10 @@ class Config:
         self.webserver = _ConfigWebserver(parser)
         self.zmq = _ConfigZMQ(parser)
         self.embedded = _ConfigEmbedded(parser)
+        self.ingestion = _ConfigIngestion(parser)
+        self.database = _ConfigDatabase(parser)
+        self.backup = _ConfigBackup(parser)
+        self.retention = _ConfigRetention(parser)
 
 class _ConfigGeneral:
 
@@ -144,6 +148,36 @@ class _ConfigZMQ:
                 parser.get, "zmq", "broker_host", "*")
         self.broker_port = _getOpt(
                 parser.getint, "zmq", "broker_port", 13001)
+        self.rpc_timeout = _getOpt(
+                parser.getint, "zmq", "rpctimeout", 10)
+        self.rpc_max_in_flight = _getOpt(
+                parser.getint, "zmq", "rpcmaxinflight", 32)
+        self.heartbeat_interval = _getOpt(
+                parser.getint, "zmq", "heartbeatinterval", 30)
+        self.missed_heartbeats = _getOpt(
+                parser.getint, "zmq", "missedheartbeats", 3)
+        self.pub_port = _getOpt(
+                parser.getint, "zmq", "pubport", 0)
+        self.capture_file = _getOpt(
+                parser.get, "zmq", "capturefile", "")
+        self.telemetry_quantum = _getOpt(
+                parser.getint, "zmq", "telemetryquantum", 256)
+        self.telemetry_queue = _getOpt(
+                parser.getint, "zmq", "telemetryqueue", 10000)
+        self.sndhwm = _getOpt(
+                parser.getint, "zmq", "sndhwm", 1000)
+        self.rcvhwm = _getOpt(
+                parser.getint, "zmq", "rcvhwm", 1000)
+        self.linger = _getOpt(
+                parser.getint, "zmq", "linger", 100)
+        self.tcp_keepalive = _getOpt(
+                parser.getint, "zmq", "tcpkeepalive", 0)
+        self.tcp_keepalive_idle = _getOpt(
+                parser.getint, "zmq", "tcpkeepaliveidle", 60)
+        self.tcp_keepalive_interval = _getOpt(
+                parser.getint, "zmq", "tcpkeepaliveinterval", 10)
+        self.tcp_keepalive_count = _getOpt(
+                parser.getint, "zmq", "tcpkeepalivecount", 5)
         
 class _ConfigEmbedded:
     
@@ -152,3 +186,65 @@ class _ConfigEmbedded:
                 parser.getboolean, "embedded", "enabled", False)
         self.db_save_interval = _getOpt(
                 parser.getint, "embedded", "dbsaveinterval", 0)
+        self.storage = _getOpt(
+                parser.get, "embedded", "storage", "cache")
+        self.segment_dir = _getOpt(
+                parser.get, "embedded", "segmentdir", "")
+        self.segment_size = _getOpt(
+                parser.getint, "embedded", "segmentsize", 256)
+        self.sync_interval = _getOpt(
+                parser.getint, "embedded", "syncinterval", 10)
+
+class _ConfigIngestion:
+
+    def __init__(self, parser):
+        self.flush_size = _getOpt(
+                parser.getint, "ingestion", "flushsize", 500)
+        self.flush_interval = _getOpt(
+                parser.getint, "ingestion", "flushinterval", 5)
+        self.max_queue = _getOpt(
+                parser.getint, "ingestion", "maxqueue", 10000)
+        self.overload_policy = _getOpt(
+                parser.get, "ingestion", "overloadpolicy", "block")
+
+class _ConfigDatabase:
+
+    def __init__(self, parser):
+        self.profile = _getOpt(
+                parser.get, "database", "profile", "default")
+        self.synchronous = _getOpt(
+                parser.get, "database", "synchronous", "")
+        self.cache_size = _getOpt(
+                parser.getint, "database", "cachesize", 0)
+        self.mmap_size = _getOpt(
+                parser.getint, "database", "mmapsize", 0)
+        self.temp_store = _getOpt(
+                parser.get, "database", "tempstore", "")
+        self.read_connections = _getOpt(
+                parser.getint, "database", "readconnections", 3)
+        self.write_group = _getOpt(
+                parser.getint, "database", "writegroup", 256)
+        self.write_delay = _getOpt(
+                parser.getint, "database", "writedelay", 1)
+
+class _ConfigBackup:
+
+    def __init__(self, parser):
+        self.directory = _getOpt(
+                parser.get, "backup", "directory", "")
+        self.interval = _getOpt(
+                parser.getint, "backup", "interval", 0)
+        self.keep = _getOpt(
+                parser.getint, "backup", "keep", 7)
+
+class _ConfigRetention:
+
+    def __init__(self, parser):
+        self.interval = _getOpt(
+                parser.getint, "retention", "interval", 43200)
+        self.batch_size = _getOpt(
+                parser.getint, "retention", "batchsize", 1000)
+        self.batch_pause = _getOpt(
+                parser.getint, "retention", "batchpause", 50)
+        self.vacuum_pages = _getOpt(
+                parser.getint, "retention", "vacuumpages", 256)
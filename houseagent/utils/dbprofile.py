@@ -0,0 +1,81 @@
+from twisted.enterprise.adbapi import ConnectionPool
+
+# Storage profiles
+DEFAULT = 'default'
+WAL = 'wal'
+
+PROFILES = (DEFAULT, WAL)
+
+class StorageProfile(object):
+    '''
+    SQLite storage settings for the HouseAgent database.
+
+    The default profile uses the rollback journal and the writer connection for reads and writes.
+    The wal profile switches the database to write-ahead logging, writes go through the writer
+    connection and reads through a pool of reader connections, so reads no longer wait for
+    writes to complete.
+    '''
+
+    def __init__(self, profile=DEFAULT, synchronous='', cache_size=0, mmap_size=0, temp_store='',
+                 read_connections=3, write_group=256, write_delay=1):
+        '''
+        @param profile: the storage profile, default or wal
+        @param synchronous: the synchronous pragma (off, normal, full), empty leaves the SQLite default
+        @param cache_size: the cache_size pragma, negative values are in KiB, 0 leaves the SQLite default
+        @param mmap_size: the number of bytes of the database file accessed through memory mapping, 0 disables it
+        @param temp_store: the temp_store pragma (default, file, memory), empty leaves the SQLite default
+        @param read_connections: the number of reader connections of the wal profile
+        @param write_group: the maximum number of write operations committed together
+        @param write_delay: the maximum time in milliseconds a write waits for others to be committed with
+        '''
+        if profile not in PROFILES:
+            raise ValueError("Unknown storage profile '%s', use one of: %s" % (profile, ', '.join(PROFILES)))
+
+        self.profile = profile
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.temp_store = temp_store
+        self.read_connections = read_connections
+        self.write_group = write_group
+        self.write_delay = write_delay
+
+    def pragmas(self):
+        '''
+        @return: the list of PRAGMA statements run on every new connection
+        '''
+        pragmas = []
+
+        if self.profile == WAL:
+            pragmas.append("PRAGMA journal_mode=WAL")
+        if self.synchronous:
+            pragmas.append("PRAGMA synchronous=%s" % self.synchronous.upper())
+        if self.cache_size:
+            pragmas.append("PRAGMA cache_size=%d" % self.cache_size)
+        if self.mmap_size:
+            pragmas.append("PRAGMA mmap_size=%d" % self.mmap_size)
+        if self.temp_store:
+            pragmas.append("PRAGMA temp_store=%s" % self.temp_store.upper())
+
+        return pragmas
+
+    def open_connection(self, connection):
+        '''
+        Configure a new connection, used as cp_openfun of the connection pools.
+        @param connection: the new sqlite3 connection
+        '''
+        for pragma in self.pragmas():
+            connection.execute(pragma)
+
+    def create_read_pool(self, db_location):
+        '''
+        Create the connection pool used for reads.
+        @param db_location: the location of the database file
+
+        @return: a connection pool, or None when reads go through the writer connection
+        '''
+        if self.profile != WAL:
+            return None
+
+        return ConnectionPool("sqlite3", db_location, check_same_thread=False, cp_min=1,
+                              cp_max=max(1, self.read_connections), cp_openfun=self.open_connection)
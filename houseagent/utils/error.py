@@ -30,4 +30,36 @@ class ConfigFileNotFound(Error):
 
     def __repr__(self):
         return("<Configuration file not found in any of the following known locations: \"%s\">"\
-                % (self.identifier))   
\ No newline at end of file
+                % (self.identifier))   
+
+class RPCError(Error):
+    '''
+    Base class for errors of RPC requests sent to plugins.
+    '''
+    def __init__(self, identifier):
+        Error.__init__(self)
+        self.identifier = identifier
+
+    def __repr__(self):
+        return("<%s for RPC request \"%s\">" % (self.__class__.__name__, self.identifier))
+
+class RPCTimeout(RPCError):
+    '''
+    The plugin did not reply to the RPC request in time.
+    '''
+
+class RPCLimitExceeded(RPCError):
+    '''
+    Too many RPC requests are outstanding for the plugin.
+    '''
+
+class PluginOffline(Error):
+    '''
+    The plugin is not connected to the coordinator.
+    '''
+    def __init__(self, identifier):
+        Error.__init__(self)
+        self.identifier = identifier
+
+    def __repr__(self):
+        return("<PluginOffline for plugin \"%s\">" % (self.identifier))
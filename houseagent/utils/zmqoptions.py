@@ -0,0 +1,61 @@
+from zmq.core import constants
+
+class SocketOptions(object):
+    '''
+    ZeroMQ socket options for the broker and plugin connections.
+    '''
+
+    def __init__(self, sndhwm=1000, rcvhwm=1000, linger=100, tcp_keepalive=0, tcp_keepalive_idle=60,
+                 tcp_keepalive_interval=10, tcp_keepalive_count=5):
+        '''
+        @param sndhwm: the maximum number of outgoing messages queued per peer
+        @param rcvhwm: the maximum number of incoming messages queued per peer
+        @param linger: the number of milliseconds unsent messages are kept after closing the socket
+        @param tcp_keepalive: 1 enables TCP keepalive, 0 leaves the operating system default
+        @param tcp_keepalive_idle: the number of idle seconds before keepalive probes are sent
+        @param tcp_keepalive_interval: the number of seconds between keepalive probes
+        @param tcp_keepalive_count: the number of failed probes after which the connection is dropped
+        '''
+        self.sndhwm = sndhwm
+        self.rcvhwm = rcvhwm
+        self.linger = linger
+        self.tcp_keepalive = tcp_keepalive
+        self.tcp_keepalive_idle = tcp_keepalive_idle
+        self.tcp_keepalive_interval = tcp_keepalive_interval
+        self.tcp_keepalive_count = tcp_keepalive_count
+
+    def prepare(self, connection):
+        '''
+        Set the options txzmq applies while it creates the socket, call this before ZmqConnection.__init__.
+        Options of a connecting socket must be set before it connects to have any effect.
+        @param connection: the ZmqConnection that is about to be initialized
+        '''
+        connection.highWaterMark = max(self.sndhwm, self.rcvhwm)
+        connection.tcpKeepalive = self.tcp_keepalive
+        connection.tcpKeepaliveIdle = self.tcp_keepalive_idle
+        connection.tcpKeepaliveInterval = self.tcp_keepalive_interval
+        connection.tcpKeepaliveCount = self.tcp_keepalive_count
+
+    def apply(self, connection):
+        '''
+        Set the options on the socket of an initialized connection.
+        @param connection: an initialized ZmqConnection
+        '''
+        # pyzmq 13 renamed setsockopt to set on the low level socket class
+        socket = connection.socket
+        setsockopt = getattr(socket, 'setsockopt', None) or socket.set
+        
+        setsockopt(constants.LINGER, self.linger)
+
+        if hasattr(constants, 'SNDHWM'):
+            setsockopt(constants.SNDHWM, self.sndhwm)
+            setsockopt(constants.RCVHWM, self.rcvhwm)
+        else:
+            # ZeroMQ 2 has one high-water mark for both directions
+            setsockopt(constants.HWM, max(self.sndhwm, self.rcvhwm))
+
+        if self.tcp_keepalive and hasattr(constants, 'TCP_KEEPALIVE'):
+            setsockopt(constants.TCP_KEEPALIVE, self.tcp_keepalive)
+            setsockopt(constants.TCP_KEEPALIVE_IDLE, self.tcp_keepalive_idle)
+            setsockopt(constants.TCP_KEEPALIVE_INTVL, self.tcp_keepalive_interval)
+            setsockopt(constants.TCP_KEEPALIVE_CNT, self.tcp_keepalive_count)